@@ -0,0 +1,120 @@
+import backtrader as bt
+import datetime
+import importlib.util
+import os.path
+import sys
+
+from price_data import DAYS_PER_BAR, PriceArrayData, load_price_arrays, window_arrays
+from trade_excursions import TradeExcursionAnalyzer
+
+MODPATH = os.path.dirname(os.path.abspath(__file__))
+
+# Backtest script, strategy class and starting cash of each strategy
+STRATEGIES = dict(
+        simple=('simple-backtest-strategy.py', 'SimpleStrategy', 10000),
+        scalping=('scalping-backtest-strategy.py', 'ScalpingStrategy', 1000),
+        stochastic=('stochastics-macd-backtest-strategy.py', 'StochasticStrategy', 1000))
+
+TIMEFRAMES = dict(
+        daily=bt.TimeFrame.Days,
+        weekly=bt.TimeFrame.Weeks,
+        monthly=bt.TimeFrame.Months)
+
+# Window backtested by default, the same as the backtest scripts
+FROMDATE = datetime.datetime(2019, 1, 1)
+TODATE = datetime.datetime(2024, 1, 1)
+
+def load_script(filename):
+    """Import one of the backtest scripts (their file names are not valid module names)."""
+    name = os.path.splitext(filename)[0].replace('-', '_')
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(MODPATH, filename))
+        module = importlib.util.module_from_spec(spec)
+        # backtrader looks classes up through their module so it has to be registered
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+def load_strategy(strategy):
+    filename, classname, cash = STRATEGIES[strategy]
+    return getattr(load_script(filename), classname)
+
+def broker_settings(strategy):
+    """Cash, commission and sizer the backtest scripts use for a strategy."""
+    cash = STRATEGIES[strategy][2]
+    settings = dict(cash=cash, commission=0.0, sizer=None)
+    if strategy == 'simple':
+        settings['sizer'] = ('MaxCostSizer', dict(max_trade_value=cash*0.1))
+    return settings
+
+def datapath(dataname):
+    return os.path.join(MODPATH, 'data/historical-prices/{}-2019-2024.csv'.format(dataname))
+
+def run_backtest(strategy, dataname, timeframe='daily', compression=1, params=None,
+                 arrays=None, file_handle=None, keep_analyzers=False,
+                 fromdate=FROMDATE, todate=TODATE):
+    """Run one backtest without plotting and return its results.
+
+    Set up the same way as the backtest scripts. Orders are logged to
+    `file_handle` if given. Already parsed `arrays` can be passed so a
+    price file is not parsed again for every run. With `keep_analyzers` the
+    strategy's analyzers are returned too, e.g. for the per-trade excursions.
+    Only the bars from `fromdate` to `todate` are traded, with the bars the
+    strategy's indicators need to warm up read from before `fromdate`.
+    """
+    params = dict(params or {})
+    warmup = load_strategy(strategy).warmup_bars(**params) * DAYS_PER_BAR[timeframe] * compression
+    if arrays is None:
+        arrays = load_price_arrays(datapath(dataname), fromdate=fromdate, todate=todate, warmup=warmup)
+    else:
+        arrays = window_arrays(arrays, fromdate, todate, warmup)
+    settings = broker_settings(strategy)
+    cash = settings['cash']
+
+    cerebro = bt.Cerebro(stdstats=False)
+
+    f = file_handle or open(os.devnull, "w")
+    cerebro.addstrategy(load_strategy(strategy), file_handle=f, fromdate=fromdate, **params)
+
+    data = PriceArrayData(
+            arrays=arrays,
+            name=dataname.upper(),
+            todate=todate)
+    cerebro.resampledata(
+            data,
+            timeframe=TIMEFRAMES[timeframe],
+            compression=compression)
+
+    cerebro.broker.setcash(cash)
+    if settings['sizer']:
+        sizer, sizer_params = settings['sizer']
+        cerebro.addsizer(getattr(load_script(STRATEGIES[strategy][0]), sizer), **sizer_params)
+    cerebro.broker.setcommission(commission=settings['commission'])
+
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades')
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')
+    cerebro.addanalyzer(TradeExcursionAnalyzer, _name='excursions')
+
+    strat = cerebro.run()[0]
+    if file_handle is None:
+        f.close()
+
+    trades = strat.analyzers.trades.get_analysis()
+    closed = trades.get('total', {}).get('closed', 0)
+    won = trades.get('won', {}).get('total', 0)
+    result = dict(
+            strategy=strategy,
+            dataname=dataname,
+            timeframe=timeframe,
+            compression=compression,
+            params=params,
+            final_value=cerebro.broker.getvalue(),
+            profit=cerebro.broker.getvalue() - cash,
+            trades=closed,
+            won=won,
+            win_rate=won / closed if closed else 0.0,
+            max_drawdown=strat.analyzers.drawdown.get_analysis().max.drawdown,
+            excursions=strat.analyzers.excursions.get_analysis()['summary'])
+    if keep_analyzers:
+        result['analyzers'] = strat.analyzers
+    return result
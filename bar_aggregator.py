@@ -0,0 +1,171 @@
+import argparse
+import calendar
+import datetime
+import os.path
+
+import numpy as np
+
+# Fields kept for every bar in the ring buffers
+FIELDS = ('datetime', 'open', 'high', 'low', 'close', 'volume')
+DATETIME, OPEN, HIGH, LOW, CLOSE, VOLUME = range(len(FIELDS))
+
+class BarAggregator:
+    """Build 5m, 15m and custom N minute bars from a stream of 1m bars.
+
+    Bars are kept for many symbols at once in fixed size ring buffers (one
+    numpy array per timeframe, symbol x capacity x field) which are allocated
+    up front so adding a bar allocates nothing. Buckets are aligned to the
+    ASX session open so a bar never spans two sessions, 1m bars from before
+    the open are dropped and bars from the closing auction are folded into
+    the last bar of the session. A bar is completed as soon as its last
+    minute arrives (the last bar of the session once the auction is over) or
+    by `flush` once its time has passed. `on_bar` is then called with
+    (symbol index, timeframe index, ring row) to read it from `bars`.
+
+    Datetimes are seconds since the epoch in exchange local time and bars
+    are stamped with the start of their bucket like yfinance does.
+    """
+
+    def __init__(self, symbols, timeframes=(5, 15), capacity=500,
+                 session_start=datetime.time(10, 0), session_end=datetime.time(16, 0),
+                 auction_minutes=12, on_bar=None):
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.timeframes = list(timeframes)
+        self.capacity = capacity
+        self.on_bar = on_bar
+
+        self.session_start = session_start.hour * 60 + session_start.minute
+        self.session_end = session_end.hour * 60 + session_end.minute
+        self.auction_end = self.session_end + auction_minutes
+
+        size = len(self.symbols)
+        frames = len(self.timeframes)
+        self.bars = [np.zeros((size, capacity, len(FIELDS))) for timeframe in self.timeframes]
+        self.pos = np.zeros((size, frames), dtype=np.int64)
+        self.count = np.zeros((size, frames), dtype=np.int64)
+
+        # Bar being built for every symbol and timeframe, keyed by its bucket
+        self.forming = np.zeros((size, frames, len(FIELDS)))
+        self.bucket = np.full((size, frames), -1, dtype=np.int64)
+        self.bucket_end = np.zeros((size, frames), dtype=np.int64)
+
+    def update(self, symbol, timestamp, o, h, l, c, v):
+        """Add a 1m bar (stamped at its start) for a symbol index."""
+        day, seconds = divmod(int(timestamp), 86400)
+        minute = seconds // 60
+        if minute < self.session_start or minute >= self.auction_end:
+            return
+        # Closing auction prints go into the last bar of the session
+        offset = min(minute, self.session_end - 1) - self.session_start
+        forming = self.forming[symbol]
+        for tf, timeframe in enumerate(self.timeframes):
+            bucket = day * 1440 + offset // timeframe
+            if self.bucket[symbol, tf] != bucket:
+                if self.bucket[symbol, tf] >= 0:
+                    self._complete(symbol, tf)
+                start = self.session_start + (offset // timeframe) * timeframe
+                self.bucket[symbol, tf] = bucket
+                end = start + timeframe if start + timeframe < self.session_end else self.auction_end
+                self.bucket_end[symbol, tf] = day * 86400 + end * 60
+                bar = forming[tf]
+                bar[DATETIME] = day * 86400 + start * 60
+                bar[OPEN] = o
+                bar[HIGH] = h
+                bar[LOW] = l
+                bar[CLOSE] = c
+                bar[VOLUME] = v
+            else:
+                bar = forming[tf]
+                if h > bar[HIGH]:
+                    bar[HIGH] = h
+                if l < bar[LOW]:
+                    bar[LOW] = l
+                bar[CLOSE] = c
+                bar[VOLUME] += v
+
+            # The last minute of the bucket has arrived so it is complete
+            if day * 86400 + (minute + 1) * 60 >= self.bucket_end[symbol, tf]:
+                self._complete(symbol, tf)
+
+    def flush(self, timestamp):
+        """Complete every bar whose time has passed, e.g. called on a timer.
+
+        Covers symbols which did not trade in the last minute of a bucket so
+        their bars are not held back until the next trade.
+        """
+        symbols, frames = np.nonzero((self.bucket >= 0) & (self.bucket_end <= timestamp))
+        for symbol, tf in zip(symbols, frames):
+            self._complete(symbol, tf)
+
+    def _complete(self, symbol, tf):
+        row = self.pos[symbol, tf]
+        self.bars[tf][symbol, row] = self.forming[symbol, tf]
+        self.pos[symbol, tf] = (row + 1) % self.capacity
+        self.count[symbol, tf] += 1
+        self.bucket[symbol, tf] = -1
+        if self.on_bar is not None:
+            self.on_bar(symbol, tf, row)
+
+    def latest(self, symbol, tf, n=None):
+        """Copy of the last n completed bars of a symbol, oldest first."""
+        n = min(n or self.capacity, self.count[symbol, tf], self.capacity)
+        rows = (self.pos[symbol, tf] - n + np.arange(n)) % self.capacity
+        return self.bars[tf][symbol, rows]
+
+def to_timestamp(dttxt):
+    dt = datetime.datetime.strptime(dttxt[:19], "%Y-%m-%d %H:%M:%S")
+    return calendar.timegm(dt.timetuple())
+
+def rebuild_from_ticks(tickpath, timeframes, **kwargs):
+    """Batch mode: rebuild the N minute bars of a stored 1m tick file."""
+    completed = {timeframe: [] for timeframe in timeframes}
+
+    def on_bar(symbol, tf, row):
+        completed[aggregator.timeframes[tf]].append(aggregator.bars[tf][symbol, row].copy())
+
+    aggregator = BarAggregator(['tick'], timeframes, capacity=1, on_bar=on_bar, **kwargs)
+    with open(tickpath, "r") as f:
+        # Skip the header line
+        f.readline()
+        for line in f:
+            tokens = line.strip().split(',')
+            if len(tokens) < 7:
+                continue
+            aggregator.update(0, to_timestamp(tokens[0]), float(tokens[1]), float(tokens[2]),
+                              float(tokens[3]), float(tokens[4]), float(tokens[6]))
+    # Complete the last bars of the file
+    aggregator.flush(np.iinfo(np.int64).max)
+    return completed
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Rebuild N minute bars from downloaded 1m ticks')
+
+    parser.add_argument('--ticks', required=True,
+                        help='1m tick file downloaded with yfinance-download-data.py')
+
+    parser.add_argument('--timeframes', default=[5, 15], required=False, type=int, nargs='+',
+                        help='Minutes in each bar to build')
+
+    return parser.parse_args()
+
+def aggregate_ticks(args):
+    completed = rebuild_from_ticks(args.ticks, args.timeframes)
+    name = os.path.splitext(args.ticks)[0]
+    if name.endswith('-1m'):
+        name = name[:-3]
+    for timeframe, bars in completed.items():
+        f = open("{}-{}m.csv".format(name, timeframe), "w")
+        f.write("Date,Open,High,Low,Close,Adj Close,Volume\n")
+        for bar in bars:
+            date_time = (datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=bar[DATETIME])).strftime("%Y-%m-%d %H:%M:%S")
+            f.write("{},{},{},{},{},{},{}\n".format(
+                date_time, bar[OPEN], bar[HIGH], bar[LOW], bar[CLOSE], bar[CLOSE], int(bar[VOLUME])))
+        f.close()
+        print("{}m Bars: {}".format(timeframe, len(bars)))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    aggregate_ticks(args)
@@ -0,0 +1,309 @@
+import argparse
+import backtrader as bt
+import datetime
+import json
+import math
+import numpy as np
+import os
+import sys
+import tempfile
+
+from price_data import COLUMNS, window_arrays
+
+class ResumableEMA(bt.Indicator):
+    """Exponential moving average which can carry on from a saved value.
+
+    Without a seed it behaves exactly like bt.indicators.ExponentialMovingAverage
+    (SMA of the first period values as the seed). With a seed the average
+    continues from the checkpointed value straight away with no warm-up.
+    """
+    lines = ('ema',)
+
+    params = (
+            ('period', 30),
+            ('seed', None)
+        )
+
+    plotinfo = dict(subplot=False)
+
+    def __init__(self):
+        self.alpha = 2.0 / (1.0 + self.params.period)
+        self.alpha1 = 1.0 - self.alpha
+
+        # Only need the warm-up period when there is no value to carry on from
+        if self.params.seed is None:
+            self.addminperiod(self.params.period)
+
+    def nextstart(self):
+        if self.params.seed is None:
+            # Seed with the average of the first period values
+            self.lines.ema[0] = math.fsum(self.data.get(size=self.params.period)) / self.params.period
+        else:
+            self.lines.ema[0] = self.params.seed * self.alpha1 + self.data[0] * self.alpha
+
+    def next(self):
+        self.lines.ema[0] = self.lines.ema[-1] * self.alpha1 + self.data[0] * self.alpha
+
+class ResumableMACD(bt.Indicator):
+    """MACD built from ResumableEMA so each average can be seeded from a checkpoint."""
+    lines = ('macd', 'signal')
+
+    params = (
+            ('period_me1', 12),
+            ('period_me2', 26),
+            ('period_signal', 9),
+            ('seed_me1', None),
+            ('seed_me2', None),
+            ('seed_signal', None)
+        )
+
+    plotinfo = dict(plothlines=[0.0])
+    plotlines = dict(signal=dict(ls='--'))
+
+    def __init__(self):
+        self.me1 = ResumableEMA(self.data, period=self.params.period_me1, seed=self.params.seed_me1)
+        self.me2 = ResumableEMA(self.data, period=self.params.period_me2, seed=self.params.seed_me2)
+        self.lines.macd = self.me1 - self.me2
+        self.signal_ema = ResumableEMA(self.lines.macd, period=self.params.period_signal, seed=self.params.seed_signal)
+        self.lines.signal = self.signal_ema
+
+def save_checkpoint(path, strategy, flags, emas, tail_bars):
+    """Write the state needed to carry a run on over newly appended bars.
+
+    `flags` are the names of the strategy attributes to keep and `emas` maps
+    a name to each ResumableEMA whose value must be carried on. The daily
+    rows of the last `tail_bars` bars are kept so lookbacks (15 bar trends,
+    stochastic windows, swing lows) work from the first new bar. They are
+    kept as they were before resampling, starting with the first row of a
+    bar, so a weekly or monthly run resumed over them builds the same bars.
+    If an average has not warmed up before the tail then every row seen is
+    kept instead.
+    """
+    data = strategy.data
+    bars = min(tail_bars, len(data))
+    seeds = {}
+    for name, ema in emas.items():
+        seeds[name] = ema[-bars] if bars < len(data) else float('nan')
+    if any(math.isnan(seed) for seed in seeds.values()):
+        bars = len(data)
+        seeds = {name: None for name in emas}
+
+    # Resampled bars are stamped with their last row, so the rows after the bar the seeds were
+    # taken at are the rows of the tail
+    rows = data.params.arrays
+    first = np.searchsorted(rows['datetime'], data.datetime[-bars], side='right') if bars < len(data) else 0
+    last = np.searchsorted(rows['datetime'], data.datetime[0], side='right')
+    tail = {name: rows[name][first:last] for name in COLUMNS}
+
+    position = strategy.broker.getposition(data)
+    # Orders placed on the last bar are still waiting in the broker to be checked and filled
+    orders = list(strategy.broker.submitted) + list(strategy.broker.get_orders_open())
+    pending = [dict(isbuy=order.isbuy(), size=abs(order.created.size))
+               for order in orders if order.data is data and order.alive()]
+
+    # Keep the open trade so its profit is reported the same way once it closes
+    trade = None
+    trades = strategy._trades[data][0]
+    if trades and trades[-1].isopen:
+        trade = dict(size=trades[-1].size, price=trades[-1].price, long=trades[-1].long,
+                     pnl=trades[-1].pnl, commission=trades[-1].commission)
+
+    state = dict(
+            last_datetime=data.datetime[0],
+            cash=strategy.broker.get_cash(),
+            position=dict(size=position.size, price=position.price),
+            trade=trade,
+            pending_orders=pending,
+            flags={name: getattr(strategy, name) for name in flags},
+            seeds=seeds,
+            tail={name: list(values) for name, values in tail.items()}
+        )
+
+    with open(path, "w") as f:
+        json.dump(state, f)
+
+def load_checkpoint(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def resume_arrays(checkpoint, arrays):
+    """Join the checkpointed tail with the bars appended since the checkpoint."""
+    newer = arrays['datetime'] > checkpoint['last_datetime']
+    return {name: np.concatenate((np.array(checkpoint['tail'][name], dtype=np.float64), arrays[name][newer]))
+            for name in COLUMNS}
+
+def bar_starts(datetimes, timeframe='daily', compression=1):
+    """Index of the first daily row of every bar the rows are resampled into.
+
+    Rows are grouped the way backtrader's resampler does: each new week or
+    month (every row for daily bars) starts a period and every
+    `compression` periods, counted from the first row, make a bar.
+    """
+    if timeframe == 'daily':
+        periods = np.arange(len(datetimes))
+    else:
+        dates = [bt.num2date(dt).date() for dt in datetimes]
+        if timeframe == 'weekly':
+            keys = np.array([date.isocalendar()[0] * 100 + date.isocalendar()[1] for date in dates])
+        else:
+            keys = np.array([date.year * 100 + date.month for date in dates])
+        periods = np.cumsum(np.r_[False, keys[1:] != keys[:-1]])
+    bars = periods // compression
+    return np.flatnonzero(np.r_[True, bars[1:] != bars[:-1]]) if len(bars) else bars
+
+def complete_until(datetimes, timeframe='daily', compression=1):
+    """Stamp of the last bar of the rows known to be complete, None if every bar is.
+
+    A weekly or monthly bar is only known to be complete once the next one
+    starts. Daily bars are complete as soon as they are read.
+    """
+    if timeframe == 'daily' and compression == 1:
+        return None
+    starts = bar_starts(datetimes, timeframe, compression)
+    return datetimes[starts[-1] - 1] if len(starts) > 1 else None
+
+class StopAfter(bt.Analyzer):
+    """Stop the run once the bar stamped `until` has been traded.
+
+    Used to end a run which saves a checkpoint at its last complete bar.
+    The bar after it is never delivered, so nothing is traded or filled on
+    a bar still being made up (backtrader also fills orders on the last bar
+    of a resampled feed at the prices of the bar before it).
+    """
+
+    params = (
+            ('until', None),
+        )
+
+    def next(self):
+        if self.strategy.datetime[0] >= self.params.until:
+            self.strategy.env.runstop()
+
+def reopen_log(path, last_datetime=None):
+    """Open an order log to carry on writing to after a checkpoint.
+
+    The summary lines the earlier run finished with are cut off so the log
+    reads the same as one written by a run which never stopped. Lines dated
+    after `last_datetime` (written by a run which crashed before journaling
+    their bar) are cut off too, as those bars are traded again.
+    """
+    f = open(path, "r+")
+    lines = f.readlines()
+    if last_datetime is not None:
+        last_date = bt.num2date(last_datetime).date().isoformat()
+        lines = [line for line in lines if not (line[:10] > last_date and line[:4].isdigit())]
+    while lines and lines[-1].startswith(('Final Portfolio Value:', 'Total Profit:')):
+        lines.pop()
+    f.seek(0)
+    f.write(''.join(lines))
+    f.truncate()
+    return f
+
+def restore_checkpoint(strategy, checkpoint):
+    """Put the broker position and strategy flags back from a checkpoint."""
+    position = checkpoint['position']
+    if position['size']:
+        held = strategy.broker.getposition(strategy.data)
+        held.set(position['size'], position['price'])
+        # The broker charges interest on shorts from when the position last changed
+        held.datetime = bt.num2date(checkpoint['last_datetime'])
+
+    # Reopen the trade so its profit is reported when the position is closed
+    if checkpoint['trade']:
+        trade = bt.Trade(data=strategy.data, tradeid=0)
+        for name, value in checkpoint['trade'].items():
+            setattr(trade, name, value)
+        trade.value = trade.size * trade.price
+        trade.pnlcomm = trade.pnl - trade.commission
+        trade.isopen = True
+        trade.status = trade.Open
+        strategy._trades[strategy.data][0].append(trade)
+
+    for name, value in checkpoint['flags'].items():
+        setattr(strategy, name, value)
+
+def submit_pending_orders(strategy, checkpoint):
+    """Place the orders which were still pending when the checkpoint was saved."""
+    for pending in checkpoint['pending_orders']:
+        if pending['isbuy']:
+            strategy.order = strategy.buy(size=pending['size'])
+        else:
+            strategy.order = strategy.sell(size=pending['size'])
+
+def verify_resume(strategy, dataname, split, timeframe='daily', compression=1):
+    """Check a run stopped at `split` and resumed from its checkpoint logs the same as an uninterrupted run.
+
+    Both runs go through the script's own run_timeframe in a scratch folder.
+    Returns the two order logs.
+    """
+    from backtest_runner import STRATEGIES, datapath, load_script
+    from price_data import load_price_arrays
+
+    script = STRATEGIES[strategy][0]
+    module = load_script(script)
+    arrays = load_price_arrays(datapath(dataname))
+    logpath = os.path.join('order-execs', strategy, dataname, '{}-{}-{}-{}.txt'.format(strategy, dataname, compression, timeframe))
+
+    def run(folder, *options, todate=None):
+        argv = sys.argv
+        cwd = os.getcwd()
+        try:
+            sys.argv = [script, '--dataname', dataname] + list(options)
+            args = module.parse_args()
+            os.makedirs(os.path.join(folder, os.path.dirname(logpath)), exist_ok=True)
+            os.chdir(folder)
+            run_arrays = arrays if todate is None else window_arrays(arrays, todate=todate)
+            module.run_timeframe(args, run_arrays, timeframe, compression)
+        finally:
+            sys.argv = argv
+            os.chdir(cwd)
+        with open(os.path.join(folder, logpath), "r") as f:
+            return f.read()
+
+    with tempfile.TemporaryDirectory() as folder:
+        # The uninterrupted run saves a checkpoint too, so it ends at the same complete bar
+        os.makedirs(os.path.join(folder, 'full-checkpoints'))
+        full = run(os.path.join(folder, 'full'), '--checkpoint-dir', os.path.join(folder, 'full-checkpoints'))
+        checkpoints = os.path.join(folder, 'checkpoints')
+        os.makedirs(checkpoints)
+        run(os.path.join(folder, 'resumed'), '--checkpoint-dir', checkpoints, todate=split)
+        resumed = run(os.path.join(folder, 'resumed'), '--checkpoint-dir', checkpoints, '--resume')
+    return full, resumed
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Check a run resumed from a checkpoint matches one which never stopped')
+
+    parser.add_argument('--strategy', default=['scalping', 'stochastic'], required=False, nargs='+',
+                        choices=['scalping', 'stochastic'],
+                        help='Strategies to check')
+
+    parser.add_argument('--dataname', default=['cba'], required=False, nargs='+',
+                        help='Shares to check')
+
+    parser.add_argument('--timeframe', default=['daily', 'weekly', 'monthly'], required=False, nargs='+',
+                        choices=['daily', 'weekly', 'monthly'],
+                        help='Timeframes to check')
+
+    parser.add_argument('--split', default=datetime.datetime(2022, 6, 30), required=False,
+                        type=datetime.datetime.fromisoformat,
+                        help='Date the first run stops and saves its checkpoint at')
+
+    return parser.parse_args()
+
+def perform_verify(args):
+    failed = 0
+    for strategy in args.strategy:
+        for dataname in args.dataname:
+            for timeframe in args.timeframe:
+                full, resumed = verify_resume(strategy, dataname, args.split, timeframe)
+                same = full == resumed
+                failed += not same
+                print("{}, {}, {}: {}".format(strategy, dataname, timeframe, "same" if same else "DIFFERENT"))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_verify(args)
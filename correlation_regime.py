@@ -0,0 +1,197 @@
+import argparse
+import os.path
+import sys
+import time
+
+import backtrader as bt
+import numpy as np
+
+from price_data import load_price_arrays
+
+# A variance this small next to the sum of squares it came from is rounding
+# left in the running sums (e.g. by a symbol whose price never moved) so it is zero
+VARIANCE_EPS = 1e-10
+
+class RollingCorrelation:
+    """Rolling correlation and volatility of the returns of a universe of symbols.
+
+    Running sums over the last `window` bars are kept for every pair of
+    symbols (bars both had a return, sums of returns, squares and cross
+    products). Each bar adds the new returns and takes out the ones leaving
+    the window, so an update is a few N x N outer products however long the
+    window is. The sums are rebuilt from the kept returns every
+    `rebuild_every` bars so floating point error cannot build up.
+
+    Symbols without a bar pass NaN. Pairs with fewer than `min_periods`
+    common returns, or where either symbol's returns did not vary, have no
+    correlation.
+    """
+
+    def __init__(self, symbols, window=60, min_periods=20, rebuild_every=1000, crowded=0.6):
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.window = window
+        self.min_periods = min_periods
+        self.rebuild_every = rebuild_every
+        self.crowded = crowded
+
+        size = len(self.symbols)
+        # Returns in the window, with row pos the oldest
+        self.returns = np.zeros((window, size))
+        self.valid = np.zeros((window, size))
+        self.pos = 0
+        self.bars = 0
+        self.last = np.full(size, np.nan)
+
+        # count[i, j] bars both had a return, sums[i, j] / squares[i, j] of
+        # i's returns and squares over those bars, cross[i, j] of the products
+        self.count = np.zeros((size, size))
+        self.sums = np.zeros((size, size))
+        self.squares = np.zeros((size, size))
+        self.cross = np.zeros((size, size))
+
+    def _add(self, x, valid, sign):
+        self.count += sign * np.outer(valid, valid)
+        self.sums += sign * np.outer(x, valid)
+        self.squares += sign * np.outer(x * x, valid)
+        self.cross += sign * np.outer(x, x)
+
+    def update(self, closes):
+        """Add a bar of closes, one per symbol in order."""
+        closes = np.asarray(closes, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = closes / self.last - 1.0
+        valid = np.isfinite(returns)
+        self.last = np.where(np.isnan(closes), self.last, closes)
+        x = np.where(valid, returns, 0.0)
+        valid = valid.astype(np.float64)
+
+        self._add(self.returns[self.pos], self.valid[self.pos], -1.0)
+        self._add(x, valid, 1.0)
+        self.returns[self.pos] = x
+        self.valid[self.pos] = valid
+        self.pos = (self.pos + 1) % self.window
+        self.bars += 1
+        if self.bars % self.rebuild_every == 0:
+            self.rebuild()
+
+    def rebuild(self):
+        """Work the sums out again from the returns in the window."""
+        x, valid = self.returns, self.valid
+        self.count = valid.T @ valid
+        self.sums = x.T @ valid
+        self.squares = (x * x).T @ valid
+        self.cross = x.T @ x
+
+    def correlation(self):
+        """Correlation matrix of the returns in the window."""
+        count = np.where(self.count >= max(self.min_periods, 2), self.count, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = self.cross - self.sums * self.sums.T / count
+            var = self.squares - self.sums * self.sums / count
+            var = np.where(var > VARIANCE_EPS * self.squares, var, np.nan)
+            corr = cov / np.sqrt(var * var.T)
+        return np.clip(corr, -1.0, 1.0)
+
+    def volatility(self):
+        """Standard deviation of each symbol's returns in the window."""
+        count = np.diag(self.count)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            squares = np.diag(self.squares)
+            var = squares - np.diag(self.sums) ** 2 / count
+            var = np.where(var > VARIANCE_EPS * squares, var, 0.0) / (count - 1)
+        return np.where(count >= max(self.min_periods, 2), np.sqrt(var), np.nan)
+
+    def average_correlation(self):
+        """Mean correlation over every pair of different symbols."""
+        corr = self.correlation()
+        pairs = corr[~np.eye(len(self.symbols), dtype=bool)]
+        pairs = pairs[~np.isnan(pairs)]
+        return float(pairs.mean()) if len(pairs) else np.nan
+
+    def regime(self):
+        """'crowded' while the universe moves together (average correlation at or over `crowded`)."""
+        average = self.average_correlation()
+        return dict(average_correlation=average,
+                    regime='crowded' if average >= self.crowded else 'normal')
+
+    def crowding(self, symbol, exposures):
+        """Correlation weighted sum of the other symbols' exposures (signed dollars) to a symbol.
+
+        Positive when buying the symbol adds to positions which move with it,
+        negative when they would offset it.
+        """
+        row = self.correlation()[self.index[symbol]]
+        total = 0.0
+        for other, exposure in exposures.items():
+            j = self.index.get(other)
+            if j is not None and other != symbol and not np.isnan(row[j]):
+                total += row[j] * exposure
+        return total
+
+def align_closes(arrays):
+    """Closes of several shares on the union of their dates, NaN where a share has no bar."""
+    dates = np.unique(np.concatenate([columns['datetime'] for columns in arrays.values()]))
+    closes = np.full((len(dates), len(arrays)), np.nan)
+    for i, columns in enumerate(arrays.values()):
+        closes[np.searchsorted(dates, columns['datetime']), i] = columns['close']
+    return dates, closes
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Rolling correlation, volatility and crowding regime of a universe of shares')
+
+    parser.add_argument('--dataname', default=['cba', 'gmg', 'ioo', 'ndq', 'vas', 'wes'], required=False, nargs='+',
+                        help='Shares in the universe')
+
+    parser.add_argument('--window', default=60, required=False, type=int,
+                        help='Bars of returns the correlations are worked out over')
+
+    parser.add_argument('--crowded', default=0.6, required=False, type=float,
+                        help='Average correlation from which the universe is crowded')
+
+    parser.add_argument('--bench-symbols', default=None, required=False, type=int,
+                        help='Time updates of this many random symbols instead')
+
+    return parser.parse_args()
+
+def perform_correlation(args):
+    if args.bench_symbols:
+        rng = np.random.default_rng(0)
+        bars = 500
+        market = rng.normal(0, 0.01, (bars, 1))
+        closes = 100 * np.exp(np.cumsum(market + rng.normal(0, 0.01, (bars, args.bench_symbols)), axis=0))
+        rolling = RollingCorrelation(range(args.bench_symbols), window=args.window, crowded=args.crowded)
+        started = time.perf_counter()
+        for row in closes:
+            rolling.update(row)
+        seconds = time.perf_counter() - started
+        print("Symbols: {}, Bars: {}, Milliseconds/bar: {:.2f}, Average Correlation: {:.2f}".format(
+            args.bench_symbols, bars, seconds / bars * 1000, rolling.average_correlation()))
+        return
+
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    arrays = {dataname: load_price_arrays(os.path.join(modpath, './data/historical-prices/{}-2019-2024.csv'.format(dataname)))
+              for dataname in args.dataname}
+    dates, closes = align_closes(arrays)
+    rolling = RollingCorrelation([dataname.upper() for dataname in args.dataname],
+                                 window=args.window, crowded=args.crowded)
+
+    crowded = 0
+    for row in closes:
+        rolling.update(row)
+        crowded += rolling.regime()['regime'] == 'crowded'
+
+    print("Bars: {}, Crowded Bars: {} ({:.1%})".format(len(dates), crowded, crowded / len(dates)))
+    print("Correlation over the last {} bars to {}:".format(args.window, bt.num2date(dates[-1]).date()))
+    corr = rolling.correlation()
+    print("     " + "".join("{:>7}".format(symbol) for symbol in rolling.symbols))
+    for symbol, row in zip(rolling.symbols, corr):
+        print("{:<5}".format(symbol) + "".join("{:>7.2f}".format(value) for value in row))
+    print("Volatility: " + ", ".join("{} {:.2%}".format(symbol, vol) for symbol, vol in zip(rolling.symbols, rolling.volatility())))
+    print("Regime: {regime} (average correlation {average_correlation:.2f})".format(**rolling.regime()))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_correlation(args)
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import zlib
+from urllib.parse import parse_qs, urlsplit
+
+class MockQuoteServer:
+    """Local HTTP quote server to measure the ingestion service offline.
+
+    Serves GET /bars?symbols=A,B,C&count=n with the last n completed 1m bars
+    of every symbol as {"bars": {symbol: [[time, open, high, low, close,
+    volume], ...]}, "gmtoffset": seconds}. Times are seconds since the epoch
+    in UTC, stamped at the start of the minute. Prices follow a random walk
+    seeded by the symbol. Connections are kept alive between requests.
+
+    `latency` seconds are added to every response, `error_rate` of the
+    requests are answered with a 503 and `stale_symbols` stop getting new
+    bars after the server starts, to exercise retries and stale detection.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, latency=0.0, error_rate=0.0,
+                 stale_symbols=(), gmtoffset=36000, seed=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stale_symbols = set(stale_symbols)
+        self.gmtoffset = gmtoffset
+        self.random = random.Random(seed)
+        self.started = int(time.time()) // 60 * 60
+
+        # Last minute generated and its close for every symbol seen
+        self.walks = {}
+        self.requests = 0
+        self.server = None
+        self.connections = {}
+
+    def bars(self, symbol, count):
+        now = int(time.time()) // 60 * 60
+        if symbol in self.stale_symbols:
+            now = min(now, self.started)
+        if symbol not in self.walks:
+            price = 10 + zlib.crc32(symbol.encode()) % 9000 / 100
+            # The minute before the first of the `count` finished minutes up to now
+            self.walks[symbol] = (now - 60 * (count + 1), price, [])
+        last, close, history = self.walks[symbol]
+
+        walk = random.Random(zlib.crc32(symbol.encode()) ^ last)
+        minute = last
+        while minute + 60 < now:
+            minute += 60
+            o = close
+            c = round(max(o * (1 + walk.gauss(0, 0.001)), 0.01), 2)
+            h = round(max(o, c) * (1 + abs(walk.gauss(0, 0.0005))), 2)
+            l = round(min(o, c) * (1 - abs(walk.gauss(0, 0.0005))), 2)
+            history.append([minute, o, h, l, c, walk.randint(100, 10000)])
+            close = c
+        del history[:-count]
+        self.walks[symbol] = (minute, close, history)
+        return history[-count:]
+
+    async def handle(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                # Skip the headers, the requests have no body
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                method, target, version = request.decode().split()
+                url = urlsplit(target)
+                query = parse_qs(url.query)
+                if url.path != '/bars':
+                    status, body = '404 Not Found', {'error': 'not found'}
+                elif self.random.random() < self.error_rate:
+                    status, body = '503 Service Unavailable', {'error': 'busy'}
+                else:
+                    count = int(query.get('count', ['5'])[0])
+                    symbols = query.get('symbols', [''])[0].split(',')
+                    status = '200 OK'
+                    body = dict(
+                            bars={symbol: self.bars(symbol, count) for symbol in symbols if symbol},
+                            gmtoffset=self.gmtoffset)
+
+                data = json.dumps(body).encode()
+                writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+                    status, len(data)).encode() + data)
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            del self.connections[asyncio.current_task()]
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        # Port 0 picks a free port
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        # Closing the connections ends their handlers once they finish any request
+        handlers = list(self.connections)
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*handlers)
+        await self.server.wait_closed()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Serve mock 1m bars for testing live quote ingestion')
+
+    parser.add_argument('--host', default='127.0.0.1', required=False,
+                        help='Address to listen on')
+
+    parser.add_argument('--port', default=8765, required=False, type=int,
+                        help='Port to listen on')
+
+    parser.add_argument('--latency', default=0.0, required=False, type=float,
+                        help='Seconds added to every response')
+
+    parser.add_argument('--error-rate', default=0.0, required=False, type=float,
+                        help='Fraction of requests answered with a 503')
+
+    parser.add_argument('--stale', default=[], required=False, nargs='+',
+                        help='Symbols which stop getting new bars')
+
+    return parser.parse_args()
+
+async def serve(args):
+    server = await MockQuoteServer(args.host, args.port, args.latency, args.error_rate, args.stale).start()
+    print("Serving mock quotes on http://{}:{}/bars".format(server.host, server.port))
+    async with server.server:
+        await server.server.serve_forever()
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    asyncio.run(serve(args))
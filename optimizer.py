@@ -0,0 +1,209 @@
+import argparse
+import json
+import random
+
+import numpy as np
+
+from backtest_runner import TIMEFRAMES, datapath, run_backtest
+from price_data import load_price_arrays
+
+# Range of every parameter searched and a check that a parameter set makes sense
+SPACES = dict(
+        scalping=(
+            dict(ema_period_1=(5, 50), ema_period_2=(20, 100), ema_period_3=(50, 200)),
+            lambda p: p['ema_period_1'] < p['ema_period_2'] < p['ema_period_3']),
+        stochastic=(
+            dict(ema_period=(50, 300), fast_period=(5, 20), slow_period=(15, 50), signal_period=(5, 15)),
+            lambda p: p['fast_period'] < p['slow_period']))
+
+class EarlyStopper:
+    """Abort check handed to a strategy to stop a backtest which is losing.
+
+    Records the portfolio value of every bar. A run is stopped once its
+    drawdown goes over `max_drawdown` or, after `min_fraction` of the bars,
+    its value falls more than `tolerance` below the best run's value at the
+    same bar.
+    """
+
+    def __init__(self, bars, best_curve=None, tolerance=0.1, min_fraction=0.25, max_drawdown=None):
+        # Bars in the price data, the most a resampled run can have
+        self.curve = np.full(bars, np.nan)
+        self.best_curve = best_curve
+        self.tolerance = tolerance
+        self.min_fraction = min_fraction
+        self.max_drawdown = max_drawdown
+        self.peak = 0.0
+        self.aborted = False
+        # Bars of the (resampled) run seen so far
+        self.bars = 0
+
+    def __call__(self, strategy):
+        i = len(strategy) - 1
+        value = strategy.broker.getvalue()
+        self.curve[i] = value
+        self.bars = i + 1
+        self.peak = max(self.peak, value)
+
+        if self.max_drawdown is not None and (self.peak - value) / self.peak > self.max_drawdown:
+            self.aborted = True
+        elif self.best_curve is not None and i >= self.min_fraction * len(self.best_curve):
+            best = self.best_curve[i] if i < len(self.best_curve) else np.nan
+            if not np.isnan(best) and value < best - self.tolerance * abs(best):
+                self.aborted = True
+        return self.aborted
+
+class EvolutionaryOptimizer:
+    """(mu + lambda) evolution of strategy params with early pruning.
+
+    Each generation breeds children from the best parameter sets so far by
+    uniform crossover and mutation and backtests them. Every backtest is
+    stopped as soon as it falls behind the best run so far, so most bad
+    parameter sets never run to the end.
+    """
+
+    def __init__(self, strategy, dataname, timeframe='daily', compression=1,
+                 population=8, children=8, mutation=0.2, seed=0, **stopper):
+        self.strategy = strategy
+        self.dataname = dataname
+        self.timeframe = timeframe
+        self.compression = compression
+        self.space, self.valid = SPACES[strategy]
+        self.population = population
+        self.children = children
+        self.mutation = mutation
+        self.random = random.Random(seed)
+        self.stopper = stopper
+        self.arrays = load_price_arrays(datapath(dataname))
+
+        self.evaluated = {}
+        self.best = None
+        self.best_curve = None
+        self.full_runs = self.pruned_runs = 0
+        self.bars_run = 0
+        # Bars of a run which was not stopped early, after resampling to the timeframe
+        self.full_bars = 0
+
+    def sample(self):
+        while True:
+            params = {name: self.random.randint(low, high) for name, (low, high) in self.space.items()}
+            if self.valid(params):
+                return params
+
+    def breed(self, parents):
+        for attempt in range(100):
+            a, b = self.random.sample(parents, 2) if len(parents) > 1 else (parents[0], parents[0])
+            child = {}
+            for name, (low, high) in self.space.items():
+                value = a[name] if self.random.random() < 0.5 else b[name]
+                if self.random.random() < self.mutation:
+                    value += int(round(self.random.gauss(0, (high - low) * 0.1)))
+                child[name] = min(max(value, low), high)
+            if self.valid(child) and self.key(child) not in self.evaluated:
+                return child
+        # Parents have converged so start again from a random parameter set
+        return self.sample()
+
+    def key(self, params):
+        return json.dumps(params, sort_keys=True)
+
+    def evaluate(self, params):
+        stopper = EarlyStopper(self.arrays['datetime'].size, self.best_curve, **self.stopper)
+        result = run_backtest(self.strategy, self.dataname, self.timeframe, self.compression,
+                              dict(params, abort_check=stopper), arrays=self.arrays)
+        result['params'] = params
+        result['aborted'] = stopper.aborted
+        self.bars_run += stopper.bars
+
+        if stopper.aborted:
+            self.pruned_runs += 1
+            # Pruned runs are ranked below every finished run
+            result['score'] = float('-inf')
+        else:
+            self.full_runs += 1
+            self.full_bars = max(self.full_bars, stopper.bars)
+            result['score'] = result['profit']
+            if self.best is None or result['score'] > self.best['score']:
+                self.best = result
+                self.best_curve = stopper.curve
+        self.evaluated[self.key(params)] = result
+        return result
+
+    def run(self, generations=10, callback=None):
+        pool = [self.evaluate(self.sample()) for i in range(self.population)]
+        for generation in range(generations):
+            parents = [result['params'] for result in sorted(pool, key=lambda r: r['score'], reverse=True)[:self.population]]
+            pool = sorted(pool + [self.evaluate(self.breed(parents)) for i in range(self.children)],
+                          key=lambda r: r['score'], reverse=True)[:self.population]
+            if callback:
+                callback(generation, self)
+        # None if every run was pruned
+        return self.best
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Search strategy params with an evolutionary optimizer')
+
+    parser.add_argument('--strategy', default='scalping', required=False,
+                        choices=list(SPACES),
+                        help='Strategy to optimise')
+
+    parser.add_argument('--dataname', default='cba', required=False,
+                        help='Share to optimise on')
+
+    parser.add_argument('--timeframe', default='daily', required=False,
+                        choices=list(TIMEFRAMES),
+                        help='Timeframe to resample to')
+
+    parser.add_argument('--compression', default=1, required=False, type=int,
+                        help='Compress n bars into 1')
+
+    parser.add_argument('--generations', default=10, required=False, type=int,
+                        help='Number of generations to breed')
+
+    parser.add_argument('--population', default=8, required=False, type=int,
+                        help='Parameter sets kept every generation')
+
+    parser.add_argument('--children', default=8, required=False, type=int,
+                        help='Parameter sets bred every generation')
+
+    parser.add_argument('--tolerance', default=0.1, required=False, type=float,
+                        help='Fraction a run may fall below the best run before it is stopped')
+
+    parser.add_argument('--max-drawdown', default=None, required=False, type=float,
+                        help='Stop any run whose drawdown goes over this fraction')
+
+    parser.add_argument('--seed', default=0, required=False, type=int,
+                        help='Random seed')
+
+    return parser.parse_args()
+
+def perform_optimisation(args):
+    optimizer = EvolutionaryOptimizer(
+            args.strategy, args.dataname, args.timeframe, args.compression,
+            population=args.population, children=args.children, seed=args.seed,
+            tolerance=args.tolerance, max_drawdown=args.max_drawdown)
+
+    def report(generation, optimizer):
+        # Every run so far may have been pruned (e.g. by a tight --max-drawdown)
+        if optimizer.best is None:
+            print("Generation {}: No run has finished yet, all {} were pruned".format(
+                generation, optimizer.pruned_runs))
+            return
+        print("Generation {}: Best Profit: {:.2f}, Params: {}".format(
+            generation, optimizer.best['profit'], json.dumps(optimizer.best['params'], sort_keys=True)))
+
+    best = optimizer.run(args.generations, report)
+    total_bars = optimizer.full_bars * (optimizer.full_runs + optimizer.pruned_runs)
+    print("Full Runs: {}, Pruned Runs: {}, Bars Run: {}".format(
+        optimizer.full_runs, optimizer.pruned_runs,
+        "{:.0%}".format(optimizer.bars_run / total_bars) if total_bars else "unknown (no run finished)"))
+    if best is None:
+        print("No run finished, every run was pruned. Try a larger --tolerance or --max-drawdown")
+        return
+    print("Best Profit: {:.2f}, Trades: {}, Win Rate: {:.2f}, Params: {}".format(
+        best['profit'], best['trades'], best['win_rate'], json.dumps(best['params'], sort_keys=True)))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_optimisation(args)
@@ -0,0 +1,340 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zlib
+
+import backtrader as bt
+
+class JournalState:
+    """Broker and strategy state rebuilt from journal records.
+
+    Kept in the same shape as a checkpoint so `restore_checkpoint` and
+    `submit_pending_orders` can put it back into a strategy. Order refs
+    start again in every run, so orders are keyed by the session (run) that
+    placed them as well as their ref. Orders of earlier sessions are kept
+    until the run resuming from them has placed them again (a 'resubmit'
+    record), so a run which crashes before then loses none of them.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.cash = state.get('cash')
+        self.position = state.get('position', dict(size=0, price=0.0))
+        self.trade = state.get('trade')
+        self.orders = state.get('orders', {})
+        self.flags = state.get('flags', {})
+        self.last_datetime = state.get('last_datetime')
+        self.session = state.get('session')
+
+    def order_key(self, record):
+        return '{}-{}'.format(self.session, record['ref'])
+
+    def apply(self, record):
+        kind = record['type']
+        if kind == 'session':
+            self.session = record['session']
+        elif kind == 'resubmit':
+            # Orders of earlier runs went with their broker and have now been placed again by this one
+            prefix = '{}-'.format(self.session)
+            self.orders = {key: order for key, order in self.orders.items() if key.startswith(prefix)}
+        elif kind == 'submit':
+            self.orders[self.order_key(record)] = dict(isbuy=record['isbuy'], size=record['size'])
+        elif kind == 'fill':
+            if record['remaining'] and self.order_key(record) in self.orders:
+                self.orders[self.order_key(record)]['size'] = record['remaining']
+            else:
+                self.orders.pop(self.order_key(record), None)
+        elif kind == 'cancel':
+            self.orders.pop(self.order_key(record), None)
+        elif kind == 'position':
+            self.position = dict(size=record['size'], price=record['price'])
+            self.cash = record['cash']
+        elif kind == 'trade':
+            self.trade = record['trade']
+        elif kind == 'flags':
+            self.flags.update(record['flags'])
+        elif kind == 'bar':
+            self.last_datetime = record['datetime']
+
+    def to_dict(self):
+        return dict(cash=self.cash, position=self.position, trade=self.trade, orders=self.orders,
+                    flags=self.flags, last_datetime=self.last_datetime, session=self.session)
+
+    def checkpoint(self, cash=None):
+        """State as a checkpoint for restore_checkpoint and submit_pending_orders.
+
+        `cash` is the starting cash, used when nothing was filled yet.
+        """
+        return dict(cash=cash if self.cash is None else self.cash, position=dict(self.position),
+                    trade=self.trade, pending_orders=[dict(order) for order in self.orders.values()],
+                    flags=dict(self.flags), last_datetime=self.last_datetime)
+
+class OrderJournal:
+    """Append-only write-ahead journal of order state with group commit.
+
+    Records are buffered and written with a single fsync once `commit_bytes`
+    are waiting or the oldest waiting record is `commit_interval` seconds
+    old, or when `commit` is called. The age is only checked as records are
+    appended, so a record which must not wait is followed by a `commit` (the
+    journal analyzer commits orders before the broker sees them and fills as
+    soon as they are notified).
+    Every line holds a CRC so a line torn by a crash is found and cut off
+    when the journal is opened again.
+
+    The journal is a folder of segments named after their first sequence
+    number. Every `snapshot_every` records the state is written to a
+    snapshot and a new segment started, and segments the snapshot covers are
+    removed, so replay reads at most one snapshot and `snapshot_every`
+    records. A `fresh` journal drops whatever an earlier run left in the
+    folder, otherwise it carries on from it. A run writing to the journal
+    calls `start_session` first.
+    """
+
+    def __init__(self, folder, commit_interval=0.05, commit_bytes=1 << 16, snapshot_every=10000, fsync=True,
+                 fresh=False):
+        self.folder = folder
+        self.commit_interval = commit_interval
+        self.commit_bytes = commit_bytes
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        if fresh:
+            shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+
+        self.buffer = []
+        self.buffered = 0
+        self.first_buffered = None
+        self.commits = 0
+
+        self.seq, self.state = self.replay()
+        self.since_snapshot = self.seq - self.snapshot_seq
+        self.file = open(self.segment_path(self.seq + 1) if not self.segments() else self.segments()[-1], "ab")
+
+    def segment_path(self, seq):
+        return os.path.join(self.folder, 'journal-{:012d}.log'.format(seq))
+
+    def segments(self):
+        return sorted(os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                      if name.startswith('journal-') and name.endswith('.log'))
+
+    def replay(self):
+        """Load the snapshot and apply the records written after it."""
+        self.snapshot_seq = 0
+        state = JournalState()
+        path = os.path.join(self.folder, 'snapshot.json')
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                snapshot = json.load(f)
+            self.snapshot_seq = snapshot['seq']
+            state = JournalState(snapshot['state'])
+
+        seq = self.snapshot_seq
+        segments = self.segments()
+        for i, segment in enumerate(segments):
+            good = 0
+            with open(segment, "rb") as f:
+                for line in f:
+                    record = parse_line(line)
+                    if record is None:
+                        if i < len(segments) - 1:
+                            raise ValueError("Corrupt record in {} at byte {}".format(segment, good))
+                        # Cut off a record torn by a crash so new records follow the last good one
+                        with open(segment, "r+b") as tail:
+                            tail.truncate(good)
+                        break
+                    good += len(line)
+                    if record['seq'] > seq:
+                        state.apply(record)
+                        seq = record['seq']
+        return seq, state
+
+    def append(self, record):
+        """Add a record (a dict with a type) and return its sequence number."""
+        self.seq += 1
+        record = dict(record, seq=self.seq)
+        self.state.apply(record)
+        data = json.dumps(record, separators=(',', ':')).encode()
+        self.buffer.append("{:08x} ".format(zlib.crc32(data)).encode() + data + b'\n')
+        self.buffered += len(self.buffer[-1])
+        self.since_snapshot += 1
+
+        now = time.monotonic()
+        if self.first_buffered is None:
+            self.first_buffered = now
+        if self.buffered >= self.commit_bytes or now - self.first_buffered >= self.commit_interval:
+            self.commit()
+        return self.seq
+
+    def start_session(self):
+        """Mark the start of a run's records, returning its session id."""
+        self.append(dict(type='session', session=uuid.uuid4().hex[:12]))
+        self.commit()
+        return self.state.session
+
+    def commit(self):
+        """Write every buffered record with one fsync."""
+        if self.buffer:
+            self.file.write(b''.join(self.buffer))
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.commits += 1
+            self.buffer = []
+            self.buffered = 0
+            self.first_buffered = None
+        if self.since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """Save the state so far and start a new segment."""
+        path = os.path.join(self.folder, 'snapshot.json')
+        with open(path + '.tmp', "w") as f:
+            json.dump(dict(seq=self.seq, state=self.state.to_dict()), f)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        self.file.close()
+        for segment in self.segments():
+            os.remove(segment)
+        self.file = open(self.segment_path(self.seq + 1), "ab")
+        self.snapshot_seq = self.seq
+        self.since_snapshot = 0
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+def parse_line(line):
+    # A line is "<crc32 of the record> <record>", None if it is torn or corrupt
+    try:
+        crc, data = line.rstrip(b'\n').split(b' ', 1)
+        if not line.endswith(b'\n') or int(crc, 16) != zlib.crc32(data):
+            return None
+        return json.loads(data)
+    except ValueError:
+        return None
+
+class OrderJournalAnalyzer(bt.Analyzer):
+    """Journal the orders, fills, trades, position and flags of a strategy.
+
+    Orders placed in `next` are found in the broker once the strategy is
+    done with the bar and committed before the broker can fill them. Fills,
+    cancels and position changes follow through `notify_order` and are
+    committed straight away. Flags listed in the strategy's
+    `checkpoint_flags` are journaled whenever they change, and a bar where
+    anything changed is committed once it is done. Bars a resumed strategy
+    only replays (those before its `resume_until`) are not journaled again.
+    On its `resume_until` bar the strategy places the pending orders it
+    resumed from again, and they replace those of the earlier run.
+    """
+
+    params = (
+            ('journal', None),
+        )
+
+    def start(self):
+        self.journal = self.params.journal
+        self.journal.start_session()
+        self.seen = len(self.strategy.broker.orders)
+        self.flags = {}
+
+    def notify_order(self, order):
+        if order.status in [order.Partial, order.Completed]:
+            self.journal.append(dict(
+                    type='fill', ref=order.ref, size=order.executed.size, price=order.executed.price,
+                    comm=order.executed.comm, remaining=abs(order.executed.remsize)))
+            position = self.strategy.broker.getposition(order.data)
+            self.journal.append(dict(
+                    type='position', size=position.size, price=position.price,
+                    cash=self.strategy.broker.get_cash()))
+            self.journal.commit()
+        elif order.status in [order.Canceled, order.Margin, order.Rejected, order.Expired]:
+            self.journal.append(dict(type='cancel', ref=order.ref, status=order.getstatusname()))
+            self.journal.commit()
+
+    def notify_trade(self, trade):
+        state = None
+        if trade.isopen:
+            state = dict(size=trade.size, price=trade.price, long=trade.long,
+                         pnl=trade.pnl, commission=trade.commission)
+        self.journal.append(dict(type='trade', trade=state))
+
+    def next(self):
+        orders = self.strategy.broker.orders[self.seen:]
+        self.seen += len(orders)
+        resume_until = getattr(self.strategy, 'resume_until', None)
+        if resume_until is not None and self.strategy.datetime[0] < resume_until:
+            return
+        if resume_until is not None and self.strategy.datetime[0] == resume_until:
+            self.journal.append(dict(type='resubmit'))
+        for order in orders:
+            self.journal.append(dict(
+                    type='submit', ref=order.ref, isbuy=order.isbuy(), size=abs(order.created.size),
+                    price=order.created.price))
+
+        flags = {name: getattr(self.strategy, name) for name in getattr(self.strategy, 'checkpoint_flags', ())}
+        changed = {name: value for name, value in flags.items() if name not in self.flags or self.flags[name] != value}
+        if changed:
+            self.journal.append(dict(type='flags', flags=changed))
+            self.flags = flags
+
+        self.journal.append(dict(type='bar', datetime=self.strategy.datetime[0]))
+        if orders or changed:
+            self.journal.commit()
+
+    def stop(self):
+        self.journal.commit()
+
+    def get_analysis(self):
+        return self.journal.state.to_dict()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Replay an order journal or measure its commit rate')
+
+    parser.add_argument('command', choices=['replay', 'bench'],
+                        help='Rebuild the state from a journal or time appending records')
+
+    parser.add_argument('--journal-dir', default='journal', required=False,
+                        help='Folder of the journal')
+
+    parser.add_argument('--events', default=20000, required=False, type=int,
+                        help='Records to append when benchmarking')
+
+    parser.add_argument('--commit-interval', default=0.05, required=False, type=float,
+                        help='Most seconds a record waits to be committed')
+
+    return parser.parse_args()
+
+def perform_command(args):
+    if args.command == 'replay':
+        started = time.monotonic()
+        journal = OrderJournal(args.journal_dir)
+        seconds = time.monotonic() - started
+        print("Records: {}, Since Snapshot: {}, Replay Seconds: {:.3f}".format(
+            journal.seq, journal.since_snapshot, seconds))
+        print(json.dumps(journal.state.to_dict(), indent=2, sort_keys=True))
+        journal.close()
+    else:
+        # Compare an fsync per record with group commit over the same records
+        for name, interval in (('fsync per record', 0.0), ('group commit', args.commit_interval)):
+            folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(args.journal_dir)))
+            journal = OrderJournal(folder, commit_interval=interval, snapshot_every=args.events)
+            started = time.monotonic()
+            for i in range(args.events):
+                journal.append(dict(type='bar', datetime=float(i)))
+            journal.close()
+            seconds = time.monotonic() - started
+            shutil.rmtree(folder)
+            print("{}: Records/s: {:.0f}, Fsyncs: {}".format(name, args.events / seconds, journal.commits))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_command(args)
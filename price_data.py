@@ -0,0 +1,253 @@
+import backtrader as bt
+import datetime
+import numpy as np
+import os
+import tempfile
+import zlib
+from multiprocessing import shared_memory
+
+# Columns kept for every bar once a price file has been parsed
+COLUMNS = ('datetime', 'open', 'high', 'low', 'close', 'volume', 'adjclose')
+
+# Most trading days in a bar of each timeframe, to turn warm-up bars into daily bars to load
+DAYS_PER_BAR = dict(
+        daily=1,
+        weekly=5,
+        monthly=23)
+
+# Bars are stamped at the end of the session like the yahoo feed does
+SESSION_END = datetime.time(23, 59, 59, 999990)
+
+def load_price_arrays(datapath, decimals=2, fromdate=None, todate=None, warmup=0):
+    """Parse a Yahoo Finance CSV once into numpy arrays.
+
+    Prices are adjusted and rounded exactly like bt.feeds.YahooFinanceCSVData
+    does by default so runs fed from these arrays produce the same orders.
+
+    Given `fromdate` or `todate` (datetimes compared with the bar stamps the
+    way the feed's own filters do) only the bars in that window, plus
+    `warmup` bars before it, are read. The date index of the file finds
+    where they are so the rest of the file is never read.
+    """
+    with open(datapath, "rb") as f:
+        if fromdate is None and todate is None:
+            # Skip the header line
+            f.readline()
+            return parse_price_lines(f, decimals)
+
+        index = date_index(datapath)
+        first, last = window_bounds(index['datetime'], fromdate, todate, warmup)
+        if first >= last:
+            return parse_price_lines([], decimals)
+        f.seek(index['offset'][first])
+        if last < len(index['offset']):
+            return parse_price_lines(f.read(index['offset'][last] - index['offset'][first]).splitlines(), decimals)
+        return parse_price_lines(f, decimals)
+
+def parse_price_lines(lines, decimals=2):
+    """Parse lines (bytes) of a Yahoo Finance CSV, skipping rows without prices."""
+    rows = []
+    for line in lines:
+        tokens = line.decode().strip().split(',')
+        if len(tokens) < 7 or 'null' in tokens[1:]:
+            continue
+
+        dttxt = tokens[0]
+        dt = datetime.date(int(dttxt[0:4]), int(dttxt[5:7]), int(dttxt[8:10]))
+        o, h, l, c, adjustedclose = [float(tok) for tok in tokens[1:6]]
+        try:
+            v = float(tokens[6])
+        except ValueError:
+            v = 0.0
+
+        # Scale all prices back by the adjusted close
+        adjfactor = c / adjustedclose
+        o /= adjfactor
+        h /= adjfactor
+        l /= adjfactor
+        c = adjustedclose
+        v *= adjfactor
+
+        rows.append((
+            bt.date2num(datetime.datetime.combine(dt, SESSION_END)),
+            round(o, decimals), round(h, decimals), round(l, decimals),
+            round(c, decimals), round(v, 0), adjustedclose))
+
+    table = np.array(rows, dtype=np.float64).reshape(-1, len(COLUMNS))
+    return {name: table[:, i] for i, name in enumerate(COLUMNS)}
+
+def window_bounds(datetimes, fromdate=None, todate=None, warmup=0):
+    """First and one past the last position of the bars in a window, with `warmup` bars before it."""
+    first = 0 if fromdate is None else int(np.searchsorted(datetimes, bt.date2num(fromdate), side='left'))
+    last = len(datetimes) if todate is None else int(np.searchsorted(datetimes, bt.date2num(todate), side='right'))
+    return max(first - warmup, 0), last
+
+def window_arrays(arrays, fromdate=None, todate=None, warmup=0):
+    """Bars of already parsed arrays in a window, with `warmup` bars before it."""
+    first, last = window_bounds(arrays['datetime'], fromdate, todate, warmup)
+    return {name: values[first:last] for name, values in arrays.items()}
+
+def date_index(datapath):
+    """Bar stamp and byte offset of every priced row of a price file.
+
+    The index is kept next to the file (`<file>.idx.npz`) and built on first
+    use. It holds the size and modification time of the file it was built
+    from and a checksum of the header and first row. Price files are only
+    ever appended to, so once the file has grown (with the same first rows)
+    just the rows from the last complete line on are read and added. A file
+    which shrank, was rewritten at the same size or starts differently is
+    indexed again from the start.
+    """
+    path = datapath + '.idx.npz'
+    stat = os.stat(datapath)
+    with open(datapath, "rb") as f:
+        head = file_head(f)
+    index = None
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            index = {name: saved[name] for name in saved.files}
+        if 'head' not in index or int(index['head']) != head or int(index['size']) > stat.st_size:
+            index = None
+        elif int(index['size']) == stat.st_size:
+            if int(index['mtime']) == stat.st_mtime_ns:
+                return index
+            index = None
+
+    start = 0 if index is None else int(index['end'])
+    datetimes, offsets = [], []
+    with open(datapath, "rb") as f:
+        f.seek(start)
+        if not start:
+            # Skip the header line
+            f.readline()
+        offset = end = f.tell()
+        for line in f:
+            tokens = line.decode().strip().split(',')
+            if len(tokens) >= 7 and 'null' not in tokens[1:]:
+                dttxt = tokens[0]
+                dt = datetime.date(int(dttxt[0:4]), int(dttxt[5:7]), int(dttxt[8:10]))
+                datetimes.append(bt.date2num(datetime.datetime.combine(dt, SESSION_END)))
+                offsets.append(offset)
+            offset += len(line)
+            # A last line without a newline may still be written to, so it is read again next time
+            if line.endswith(b'\n'):
+                end = offset
+    # Taken once the rows are read, so a row appended meanwhile leaves the index looking out of date
+    mtime = os.stat(datapath).st_mtime_ns
+
+    if index is None:
+        index = dict(datetime=np.empty(0), offset=np.empty(0, dtype=np.int64))
+    kept = index['offset'] < start
+    index = dict(
+            datetime=np.concatenate((index['datetime'][kept], datetimes)),
+            offset=np.concatenate((index['offset'][kept], np.array(offsets, dtype=np.int64))),
+            end=np.int64(end),
+            size=np.int64(offset),
+            mtime=np.int64(mtime),
+            head=np.int64(head))
+
+    # Every build writes its own file and moves it over the index in one step, so processes building
+    # the index at once never see a torn one and whichever moves last wins
+    tmp = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)),
+                                         prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False) as f:
+            tmp = f.name
+            np.savez(f, **index)
+        os.replace(tmp, path)
+    except OSError:
+        # The index built here is good to use even if it could not be saved
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+def file_head(f):
+    # Checksum of the header and first row, which change when a file is replaced rather than appended to
+    f.seek(0)
+    return zlib.crc32(f.readline() + f.readline())
+
+class SharedPriceArrays:
+    """Price arrays of several shares held once in shared memory.
+
+    The parent process loads the arrays and passes `handles` to its worker
+    processes, which map them with `attach_price_arrays` instead of each
+    parsing and holding their own copy. Any other arrays with one value per
+    bar (e.g. precomputed indicators) can be shared alongside the prices.
+    The blocks are freed by `close`.
+    """
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.handles = {}
+        for dataname, columns in arrays.items():
+            names = list(columns)
+            bars = len(columns[names[0]])
+            block = shared_memory.SharedMemory(create=True, size=max(len(names) * bars * 8, 1))
+            # One row per column so every array is contiguous
+            table = np.ndarray((len(names), bars), dtype=np.float64, buffer=block.buf)
+            for i, name in enumerate(names):
+                table[i] = columns[name]
+            del table
+            self.blocks.append(block)
+            self.handles[dataname] = dict(name=block.name, columns=names, bars=bars)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Shared memory blocks mapped by this process, kept open while their arrays are in use
+_attached_blocks = {}
+
+def attach_price_arrays(handles):
+    """Map the arrays of shared price handles without copying them."""
+    arrays = {}
+    for dataname, handle in handles.items():
+        block = _attached_blocks.get(handle['name'])
+        if block is None:
+            block = _attached_blocks[handle['name']] = shared_memory.SharedMemory(name=handle['name'])
+        table = np.ndarray((len(handle['columns']), handle['bars']), dtype=np.float64, buffer=block.buf)
+        # Every worker sees the same memory so none of them may write to it
+        table.flags.writeable = False
+        arrays[dataname] = {name: table[i] for i, name in enumerate(handle['columns'])}
+    return arrays
+
+class PriceArrayData(bt.feed.DataBase):
+    """Data feed which replays bars from already parsed price arrays.
+
+    Several cerebro instances can share the same arrays so the price file
+    is only read and parsed once no matter how many runs use it.
+    """
+    lines = ('adjclose',)
+
+    params = (
+            ('arrays', None),
+        )
+
+    def start(self):
+        super(PriceArrayData, self).start()
+        self._idx = 0
+
+    def _load(self):
+        arrays = self.params.arrays
+        if self._idx >= len(arrays['datetime']):
+            return False
+
+        i = self._idx
+        self.lines.datetime[0] = arrays['datetime'][i]
+        self.lines.open[0] = arrays['open'][i]
+        self.lines.high[0] = arrays['high'][i]
+        self.lines.low[0] = arrays['low'][i]
+        self.lines.close[0] = arrays['close'][i]
+        self.lines.volume[0] = arrays['volume'][i]
+        self.lines.openinterest[0] = 0.0
+        self.lines.adjclose[0] = arrays['adjclose'][i]
+        self._idx += 1
+        return True
@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+from urllib.parse import quote
+
+import numpy as np
+
+from bar_aggregator import BarAggregator
+from mock_quote_server import MockQuoteServer
+
+# 1m bar published to subscribers, stamped at its start in exchange local time
+# (seconds since the epoch) like the bars BarAggregator takes
+Bar = collections.namedtuple('Bar', 'symbol datetime open high low close volume')
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections to one host, at most `size` in use at once."""
+
+    def __init__(self, host, port, size=4, ssl=False, timeout=10.0):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+        self.opened = 0
+
+    async def connect(self):
+        self.opened += 1
+        return await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.ssl or None), self.timeout)
+
+    async def get(self, path):
+        """GET a path and return (status, body, seconds).
+
+        The seconds are timed from when the request got a connection slot so
+        they do not include waiting for one.
+        """
+        async with self.slots:
+            started = time.monotonic()
+            while True:
+                reused = bool(self.idle)
+                connection = self.idle.pop() if reused else await self.connect()
+                try:
+                    status, body, keep_alive = await asyncio.wait_for(self.request(connection, path), self.timeout)
+                except TimeoutError:
+                    # A timeout is a slow server, not a closed connection, so it is not retried here
+                    # (asyncio.TimeoutError is TimeoutError, a subclass of OSError)
+                    connection[1].close()
+                    raise
+                except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, EOFError):
+                    connection[1].close()
+                    # The server may have closed a connection which sat idle so try again
+                    if not reused:
+                        raise
+                    continue
+                except BaseException:
+                    connection[1].close()
+                    raise
+                if keep_alive:
+                    self.idle.append(connection)
+                else:
+                    connection[1].close()
+                return status, body, time.monotonic() - started
+
+    async def request(self, connection, path):
+        reader, writer = connection
+        writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: Mozilla/5.0\r\nAccept: application/json\r\n"
+                     "Connection: keep-alive\r\n\r\n".format(path, self.host).encode())
+        await writer.drain()
+
+        status = int((await reader.readuntil(b'\r\n')).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            body = b''.join(chunks)
+        else:
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return status, body, headers.get('connection', '').lower() != 'close'
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+class RateLimiter:
+    """Token bucket letting through `rate` requests a second with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class MockProvider:
+    """Quotes from the mock quote server, which takes many symbols per request."""
+
+    def __init__(self, host='127.0.0.1', port=8765, batch_size=50, count=5):
+        self.host = host
+        self.port = port
+        self.ssl = False
+        self.batch_size = batch_size
+        self.count = count
+
+    def path(self, symbols):
+        return '/bars?symbols={}&count={}'.format(','.join(quote(symbol) for symbol in symbols), self.count)
+
+    def parse(self, body, symbols):
+        data = json.loads(body)
+        offset = data.get('gmtoffset', 0)
+        return {symbol: [(int(bar[0]) + offset,) + tuple(float(value) for value in bar[1:])
+                         for bar in bars]
+                for symbol, bars in data['bars'].items()}
+
+class YahooChartProvider:
+    """Quotes from the Yahoo Finance chart API, which only takes one symbol per request."""
+
+    def __init__(self):
+        self.host = 'query1.finance.yahoo.com'
+        self.port = 443
+        self.ssl = True
+        self.batch_size = 1
+
+    def path(self, symbols):
+        return '/v8/finance/chart/{}?interval=1m&range=1d'.format(quote(symbols[0]))
+
+    def parse(self, body, symbols):
+        result = json.loads(body)['chart']['result'][0]
+        offset = result['meta'].get('gmtoffset', 0)
+        quotes = result['indicators']['quote'][0]
+        # The bar of the current minute is still forming
+        current = int(time.time()) // 60 * 60
+        bars = []
+        for i, timestamp in enumerate(result.get('timestamp') or []):
+            values = [quotes[name][i] for name in ('open', 'high', 'low', 'close', 'volume')]
+            if None in values or timestamp >= current:
+                continue
+            bars.append((timestamp + offset,) + tuple(float(value) for value in values))
+        return {symbols[0]: bars}
+
+class QuoteIngestor:
+    """Poll 1m bars of many symbols and publish the new ones to subscribers.
+
+    Symbols are fetched in batches of the provider's batch size, all batches
+    at once over a pool of kept alive connections and under a rate limit.
+    Failed requests are retried with exponential backoff. Only bars newer
+    than the last one published for a symbol are passed on, so overlapping
+    polls never publish a bar twice. A symbol which has had no new bar for
+    `stale_after` seconds is reported stale through `on_stale`.
+    """
+
+    def __init__(self, provider, symbols, pool_size=4, rate=10.0, retries=3, backoff=0.5,
+                 timeout=10.0, stale_after=180, on_bar=None, on_stale=None):
+        self.provider = provider
+        self.symbols = list(symbols)
+        self.pool = ConnectionPool(provider.host, provider.port, pool_size, provider.ssl, timeout)
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.stale_after = stale_after
+        self.subscribers = [on_bar] if on_bar else []
+        self.on_stale = on_stale
+        self.random = random.Random(0)
+
+        # Time of the last bar published and when it arrived for every symbol
+        self.last_bar = {}
+        self.received = {}
+        self.started = time.time()
+        self.stale = set()
+
+        self.requests = self.retried = self.failed = self.published = 0
+        self.latencies = []
+        self.last_error = None
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    async def fetch(self, symbols):
+        """Bars of a batch of symbols, empty once every retry has failed."""
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire()
+            self.requests += 1
+            try:
+                status, body, seconds = await self.pool.get(self.provider.path(symbols))
+                if status == 200:
+                    self.latencies.append(seconds)
+                    return self.provider.parse(body, symbols)
+                self.last_error = 'HTTP {}'.format(status)
+                # Client errors do not go away by asking again
+                if 400 <= status < 500 and status != 429:
+                    break
+            except (OSError, EOFError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                self.last_error = repr(e)
+            if attempt < self.retries:
+                self.retried += 1
+                # Jitter spreads out the retries of batches which failed together
+                await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + self.random.random()))
+        self.failed += 1
+        return {}
+
+    async def poll(self):
+        """Fetch every symbol once and publish its new bars, returns the number published."""
+        size = self.provider.batch_size
+        batches = [self.symbols[i:i + size] for i in range(0, len(self.symbols), size)]
+        published = 0
+        for bars in await asyncio.gather(*[self.fetch(batch) for batch in batches]):
+            now = time.time()
+            for symbol, rows in bars.items():
+                last = self.last_bar.get(symbol)
+                for row in sorted(rows):
+                    if last is not None and row[0] <= last:
+                        continue
+                    bar = Bar(symbol, *row)
+                    for callback in self.subscribers:
+                        callback(bar)
+                    last = row[0]
+                    self.received[symbol] = now
+                    published += 1
+                self.last_bar[symbol] = last
+        self.published += published
+        self.check_stale()
+        return published
+
+    def check_stale(self):
+        now = time.time()
+        stale = set(symbol for symbol in self.symbols
+                    if now - self.received.get(symbol, self.started) > self.stale_after)
+        if self.on_stale:
+            for symbol in sorted(stale - self.stale):
+                self.on_stale(symbol)
+        self.stale = stale
+
+    async def run(self, interval=60, cycles=None, callback=None):
+        """Poll every `interval` seconds, `cycles` times or forever."""
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            started = time.monotonic()
+            published = await self.poll()
+            if callback:
+                callback(cycle, published, time.monotonic() - started)
+            cycle += 1
+            if cycles is None or cycle < cycles:
+                await asyncio.sleep(max(interval - (time.monotonic() - started), 0))
+
+    def close(self):
+        self.pool.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Ingest live 1m bars for many symbols')
+
+    parser.add_argument('--provider', default='mock', required=False,
+                        choices=['mock', 'yahoo'],
+                        help='Where to get quotes from, mock starts a local mock quote server')
+
+    parser.add_argument('--symbols', default=None, required=False, nargs='+',
+                        help='Symbols to ingest, e.g. CBA.AX WES.AX')
+
+    parser.add_argument('--mock-symbols', default=200, required=False, type=int,
+                        help='Number of made up symbols to ingest from the mock server if no symbols are given')
+
+    parser.add_argument('--port', default=None, required=False, type=int,
+                        help='Port of an already running mock quote server')
+
+    parser.add_argument('--latency', default=0.0, required=False, type=float,
+                        help='Seconds the started mock server adds to every response')
+
+    parser.add_argument('--error-rate', default=0.0, required=False, type=float,
+                        help='Fraction of requests the started mock server fails')
+
+    parser.add_argument('--batch-size', default=50, required=False, type=int,
+                        help='Symbols asked for in one request to the mock server')
+
+    parser.add_argument('--pool-size', default=4, required=False, type=int,
+                        help='Connections kept open to the provider')
+
+    parser.add_argument('--rate', default=20.0, required=False, type=float,
+                        help='Most requests a second')
+
+    parser.add_argument('--retries', default=3, required=False, type=int,
+                        help='Times a failed request is tried again')
+
+    parser.add_argument('--interval', default=60.0, required=False, type=float,
+                        help='Seconds between polls')
+
+    parser.add_argument('--cycles', default=None, required=False, type=int,
+                        help='Number of polls, forever if not given')
+
+    parser.add_argument('--stale-after', default=180.0, required=False, type=float,
+                        help='Seconds without a new bar before a symbol is reported stale')
+
+    parser.add_argument('--aggregate', default=None, required=False, type=int, nargs='+',
+                        help='Also build bars of these minutes from the ingested bars')
+
+    return parser.parse_args()
+
+async def ingest(args):
+    server = None
+    if args.provider == 'mock':
+        symbols = args.symbols or ['SYM{:04d}'.format(i) for i in range(args.mock_symbols)]
+        port = args.port
+        if port is None:
+            server = await MockQuoteServer(port=0, latency=args.latency, error_rate=args.error_rate).start()
+            port = server.port
+        provider = MockProvider(port=port, batch_size=args.batch_size)
+    else:
+        symbols = args.symbols or ['CBA.AX']
+        provider = YahooChartProvider()
+
+    ingestor = QuoteIngestor(
+            provider, symbols, pool_size=args.pool_size, rate=args.rate, retries=args.retries,
+            stale_after=args.stale_after)
+
+    if args.aggregate:
+        aggregator = BarAggregator(symbols, args.aggregate)
+        ingestor.subscribe(lambda bar: aggregator.update(
+                aggregator.index[bar.symbol], bar.datetime, bar.open, bar.high, bar.low, bar.close, bar.volume))
+
+    def report(cycle, published, seconds):
+        print("Cycle {}: Bars: {}, Stale: {}, Seconds: {:.3f}, Symbols/s: {:.0f}".format(
+            cycle, published, len(ingestor.stale), seconds, len(symbols) / seconds))
+        # Every symbol of the mock server has the requested bars of history on the first poll
+        if args.provider == 'mock' and cycle == 0 and not ingestor.failed:
+            assert published == provider.count * len(symbols), "Expected {} bars, got {}".format(
+                    provider.count * len(symbols), published)
+
+    started = time.monotonic()
+    await ingestor.run(args.interval, args.cycles, report)
+    seconds = time.monotonic() - started
+    ingestor.close()
+    if server:
+        await server.stop()
+
+    latencies = np.array(ingestor.latencies or [np.nan]) * 1000
+    print("Requests: {}, Retries: {}, Failed: {}, Connections: {}, Bars: {}, Stale: {}".format(
+        ingestor.requests, ingestor.retried, ingestor.failed, ingestor.pool.opened,
+        ingestor.published, len(ingestor.stale)))
+    print("Latency p50: {:.1f}ms, p99: {:.1f}ms, Requests/s: {:.0f}".format(
+        np.percentile(latencies, 50), np.percentile(latencies, 99), ingestor.requests / seconds))
+    if ingestor.last_error:
+        print("Last Error: {}".format(ingestor.last_error))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    asyncio.run(ingest(args))
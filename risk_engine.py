@@ -0,0 +1,163 @@
+class RiskEngine:
+    """Pre-trade risk checks kept up to date incrementally.
+
+    Every order is passed through `check_order` before it is submitted and
+    every fill and price tick is reported through `on_fill` and `on_price`.
+    Per-symbol positions and the portfolio totals (gross exposure, market
+    value, open risk to the stops, open positions) are adjusted by the change
+    each event makes, so a check costs the same no matter how many symbols
+    are open.
+
+    Limits are in dollars except `max_positions`. Any limit left as None is
+    not checked. Orders which reduce a position are always allowed.
+
+    With a RollingCorrelation as `correlation`, `max_correlated_exposure`
+    limits a symbol's position plus the correlation weighted exposure of
+    the other open positions, so entries moving with what is already held
+    are cut down (this one check sums over the open positions).
+    """
+
+    def __init__(self, cash, max_symbol_exposure=None, max_gross_exposure=None,
+                 max_trade_risk=None, max_open_risk=None, max_daily_loss=None,
+                 max_positions=None, max_correlated_exposure=None, correlation=None):
+        self.max_symbol_exposure = max_symbol_exposure
+        self.max_gross_exposure = max_gross_exposure
+        self.max_trade_risk = max_trade_risk
+        self.max_open_risk = max_open_risk
+        self.max_daily_loss = max_daily_loss
+        self.max_positions = max_positions
+        self.max_correlated_exposure = max_correlated_exposure
+        self.correlation = correlation
+
+        # Per-symbol [size, average price, last price, stop price]
+        self.positions = {}
+
+        # Portfolio totals
+        self.cash = cash
+        self.market_value = 0.0
+        self.gross_exposure = 0.0
+        self.open_risk = 0.0
+        self.open_positions = 0
+        self.day = None
+        self.day_start_equity = cash
+
+    @property
+    def equity(self):
+        return self.cash + self.market_value
+
+    @property
+    def daily_pnl(self):
+        return self.equity - self.day_start_equity
+
+    def _remove(self, position):
+        # Take a symbol's contribution out of the totals
+        size, price, last, stop = position
+        self.market_value -= size * last
+        self.gross_exposure -= abs(size) * last
+        if stop is not None:
+            self.open_risk -= abs(size) * max(last - stop if size > 0 else stop - last, 0.0)
+        if size:
+            self.open_positions -= 1
+
+    def _add(self, position):
+        # Put a symbol's contribution back into the totals
+        size, price, last, stop = position
+        self.market_value += size * last
+        self.gross_exposure += abs(size) * last
+        if stop is not None:
+            self.open_risk += abs(size) * max(last - stop if size > 0 else stop - last, 0.0)
+        if size:
+            self.open_positions += 1
+
+    def start_day(self, day):
+        """Start counting the daily loss from the current equity."""
+        self.day = day
+        self.day_start_equity = self.equity
+
+    def on_price(self, symbol, price, day=None):
+        """New price for a symbol. Passing the day rolls the daily loss over when it changes."""
+        if day is not None and day != self.day:
+            self.start_day(day)
+        position = self.positions.get(symbol)
+        if position is None:
+            return
+        self._remove(position)
+        position[2] = price
+        self._add(position)
+
+    def on_fill(self, symbol, size, price, stop=None):
+        """Apply an executed order (size is negative for sells)."""
+        position = self.positions.setdefault(symbol, [0, 0.0, price, None])
+        self._remove(position)
+
+        old = position[0]
+        new = old + size
+        if not old or (old > 0) != (new > 0) and new:
+            # Opening or reversing so the average price starts again
+            position[1] = price
+        elif abs(new) > abs(old):
+            position[1] = (old * position[1] + size * price) / new
+        position[0] = new
+        position[2] = price
+        if stop is not None:
+            position[3] = stop
+        if not new:
+            position[3] = None
+
+        self.cash -= size * price
+        self._add(position)
+
+    def set_position(self, symbol, size, price, stop=None):
+        """Take over a position already held (cash is left alone), e.g. after resuming."""
+        position = self.positions.setdefault(symbol, [0, 0.0, price, None])
+        self._remove(position)
+        position[:] = [size, price, price, stop if size else None]
+        self._add(position)
+
+    def check_order(self, symbol, size, price, stop=None):
+        """Return the size allowed for an order (0 if rejected) and the reason it was cut."""
+        position = self.positions.get(symbol)
+        held = position[0] if position else 0
+        new = held + size
+
+        # Reducing or closing a position is always allowed
+        if abs(new) <= abs(held) and (new == 0 or (new > 0) == (held > 0)):
+            return size, None
+
+        # Adding to a position is risked against the stop it already has
+        if stop is None and position is not None:
+            stop = position[3]
+
+        if self.max_daily_loss is not None and -self.daily_pnl >= self.max_daily_loss:
+            return 0, 'daily loss limit'
+        if self.max_positions is not None and not held and self.open_positions >= self.max_positions:
+            return 0, 'position limit'
+
+        # Largest number of shares that can be added under each limit. Position limits are
+        # on the position after the fill, so shares held on the other side (an order
+        # reversing the position) make room for the order instead of using it up
+        allowed = abs(size)
+        reason = None
+        limits = []
+        same_side = held if size > 0 else -held
+        if self.max_symbol_exposure is not None:
+            limits.append((self.max_symbol_exposure / price - same_side, 'symbol exposure limit'))
+        if self.max_gross_exposure is not None:
+            limits.append(((self.max_gross_exposure - self.gross_exposure) / price, 'gross exposure limit'))
+        if stop is not None and stop != price:
+            risk_per_share = abs(price - stop)
+            if self.max_trade_risk is not None:
+                limits.append((self.max_trade_risk / risk_per_share - same_side, 'trade risk limit'))
+            if self.max_open_risk is not None:
+                limits.append(((self.max_open_risk - self.open_risk) / risk_per_share, 'open risk limit'))
+        if self.max_correlated_exposure is not None and self.correlation is not None:
+            exposures = {other: position[0] * position[2] for other, position in self.positions.items()
+                         if other != symbol and position[0]}
+            correlated = self.correlation.crowding(symbol, exposures) * (1 if size > 0 else -1)
+            limits.append(((self.max_correlated_exposure - correlated) / price - same_side, 'correlated exposure limit'))
+        for limit, name in limits:
+            if limit < allowed:
+                allowed = max(int(limit), 0)
+                reason = name
+
+        return (allowed if size > 0 else -allowed), reason
@@ -0,0 +1,229 @@
+import argparse
+import ast
+import hashlib
+import json
+import os
+import time
+
+import backtrader as bt
+import numpy as np
+
+from backtest_runner import FROMDATE, MODPATH, STRATEGIES, TODATE, broker_settings, datapath, run_backtest
+
+# Modules a backtest runs code from without its script importing them (run_backtest
+# drives every run), on top of everything imported from its script
+SHARED_FILES = ('backtest_runner.py',)
+
+# Digests of files already hashed, keyed by path and invalidated by size/mtime
+_file_digests = {}
+
+def file_digest(path):
+    stat = os.stat(path)
+    cached = _file_digests.get(path)
+    if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    _file_digests[path] = ((stat.st_size, stat.st_mtime_ns), digest.hexdigest())
+    return digest.hexdigest()
+
+# Local modules each file imports, keyed by path and invalidated by size/mtime
+_file_imports = {}
+
+def local_imports(filename):
+    """Every module of this repo a file imports, directly or through other modules, itself included."""
+    found = set()
+    pending = [filename]
+    while pending:
+        name = pending.pop()
+        if name in found:
+            continue
+        found.add(name)
+        path = os.path.join(MODPATH, name)
+        stat = os.stat(path)
+        cached = _file_imports.get(path)
+        if not cached or cached[0] != (stat.st_size, stat.st_mtime_ns):
+            with open(path, "rb") as f:
+                tree = ast.parse(f.read(), filename=path)
+            modules = set()
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    modules.update(alias.name for alias in node.names)
+                elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                    modules.add(node.module)
+            imported = sorted(module.split('.')[0] + '.py' for module in modules)
+            cached = _file_imports[path] = ((stat.st_size, stat.st_mtime_ns),
+                                            [module for module in imported
+                                             if os.path.exists(os.path.join(MODPATH, module))])
+        pending.extend(cached[1])
+    return found
+
+def run_key(strategy, dataname, timeframe='daily', compression=1, params=None, fromdate=FROMDATE, todate=TODATE):
+    """Content address of a backtest.
+
+    Built from the source of the strategy script (strategy class, its
+    indicators and sizer) and every module of the repo it or the shared
+    modules import, the backtrader and numpy versions, the strategy params,
+    the broker cash/sizer/commission settings, the content of the price
+    file and the window backtested so any change to one of them gives a new key.
+    """
+    files = set()
+    for filename in (STRATEGIES[strategy][0],) + SHARED_FILES:
+        files |= local_imports(filename)
+    code = {filename: file_digest(os.path.join(MODPATH, filename)) for filename in sorted(files)}
+    inputs = dict(
+            strategy=strategy,
+            code=code,
+            versions=dict(backtrader=bt.__version__, numpy=np.__version__),
+            params=params or {},
+            settings=broker_settings(strategy),
+            data=file_digest(datapath(dataname)),
+            timeframe=timeframe,
+            compression=compression,
+            fromdate=fromdate.isoformat() if fromdate else None,
+            todate=todate.isoformat() if todate else None)
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+class RunCache:
+    """Backtest results stored on disk under their content address."""
+
+    def __init__(self, root='.run-cache'):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "r") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark the entry as used so pruning keeps it
+        os.utime(path)
+        return result
+
+    def put(self, key, result):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see half an entry
+        tmppath = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmppath, "w") as f:
+            json.dump(result, f)
+        os.replace(tmppath, path)
+
+    def entries(self):
+        """(path, last used time) of every entry."""
+        if not os.path.isdir(self.root):
+            return []
+        entries = []
+        for folder in os.listdir(self.root):
+            for filename in os.listdir(os.path.join(self.root, folder)):
+                if filename.endswith('.json'):
+                    path = os.path.join(self.root, folder, filename)
+                    entries.append((path, os.stat(path).st_mtime))
+        return entries
+
+    def invalidate(self, strategy=None, dataname=None):
+        """Remove entries of a strategy and/or share, or everything if neither is given.
+
+        Entries which cannot be read are removed whatever the filter.
+        """
+        removed = 0
+        for path, used in self.entries():
+            if strategy or dataname:
+                try:
+                    with open(path, "r") as f:
+                        result = json.load(f)
+                except (OSError, ValueError):
+                    # A corrupt entry is never served (get treats it as a miss) so it goes too
+                    result = None
+                if result is not None:
+                    if strategy and result['strategy'] != strategy:
+                        continue
+                    if dataname and result['dataname'] != dataname:
+                        continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already removed by another process
+                continue
+            removed += 1
+        return removed
+
+    def prune(self, max_entries=None, max_age_days=None):
+        """Remove entries not used for max_age_days and then the least recently used over max_entries."""
+        entries = sorted(self.entries(), key=lambda entry: entry[1], reverse=True)
+        keep = []
+        removed = 0
+        for path, used in entries:
+            if max_age_days is not None and used < time.time() - max_age_days * 86400:
+                os.remove(path)
+                removed += 1
+            else:
+                keep.append(path)
+        if max_entries is not None:
+            for path in keep[max_entries:]:
+                os.remove(path)
+                removed += 1
+        return removed
+
+def cached_backtest(cache, strategy, dataname, timeframe='daily', compression=1, params=None,
+                    fromdate=FROMDATE, todate=TODATE, **kwargs):
+    """Serve a backtest from the cache, only running it when one of its inputs changed.
+
+    Other `kwargs` go to run_backtest and must not change the result (e.g.
+    already parsed `arrays` of the price file or a `file_handle` to log to).
+    """
+    key = run_key(strategy, dataname, timeframe, compression, params, fromdate, todate)
+    result = cache.get(key)
+    if result is None:
+        result = run_backtest(strategy, dataname, timeframe, compression, params,
+                              fromdate=fromdate, todate=todate, **kwargs)
+        cache.put(key, result)
+    return result
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Manage the cache of backtest results')
+
+    parser.add_argument('command', choices=['stats', 'invalidate', 'prune'],
+                        help='Show the size of the cache, remove entries or prune it')
+
+    parser.add_argument('--cache', default='.run-cache', required=False,
+                        help='Folder of the cache')
+
+    parser.add_argument('--strategy', default=None, required=False,
+                        choices=list(STRATEGIES),
+                        help='Only invalidate runs of this strategy')
+
+    parser.add_argument('--dataname', default=None, required=False,
+                        help='Only invalidate runs of this share')
+
+    parser.add_argument('--max-entries', default=None, required=False, type=int,
+                        help='Keep at most this many of the most recently used entries')
+
+    parser.add_argument('--max-age-days', default=None, required=False, type=float,
+                        help='Remove entries not used for this many days')
+
+    return parser.parse_args()
+
+def perform_command(args):
+    cache = RunCache(args.cache)
+    if args.command == 'stats':
+        entries = cache.entries()
+        size = sum(os.path.getsize(path) for path, used in entries)
+        print("Entries: {}, Size: {} bytes".format(len(entries), size))
+    elif args.command == 'invalidate':
+        print("Removed: {}".format(cache.invalidate(args.strategy, args.dataname)))
+    else:
+        print("Removed: {}".format(cache.prune(args.max_entries, args.max_age_days)))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_command(args)
@@ -4,15 +4,39 @@ import datetime
 import os.path
 import sys
 
+from checkpoint import ResumableEMA, StopAfter, complete_until, load_checkpoint, reopen_log, restore_checkpoint, resume_arrays, save_checkpoint, submit_pending_orders
+from order_journal import OrderJournal, OrderJournalAnalyzer
+from price_data import DAYS_PER_BAR, PriceArrayData, load_price_arrays
+from risk_engine import RiskEngine
+
 class ScalpingStrategy(bt.Strategy):
     params = (
             ('exitbars', 5),
             ('file_handle', None),
             ('ema_period_1', 25),
             ('ema_period_2', 50),
-            ('ema_period_3', 100)
+            ('ema_period_3', 100),
+            ('checkpoint', None),       # Loaded checkpoint to carry on from
+            ('checkpoint_path', None),  # File to save a checkpoint to at the end of the run
+            ('checkpoint_bars', 50),    # Bars to keep so the lookbacks work after resuming
+            ('abort_check', None),      # Called every bar, returning True stops the run early
+            ('risk_engine', None),      # Pre-trade risk checks every order goes through
+            ('fromdate', None)          # Bars before this only warm up the indicators
+        )
+
+    # Strategy state kept in a checkpoint
+    checkpoint_flags = (
+            'is_uptrend', 'is_downtrend', 'is_below_25_or_50_ema', 'is_above_25_or_50_ema',
+            'stop_loss', 'take_profit', 'buy_order', 'sell_order', 'duration_for_order',
+            'buy_price', 'buy_comm'
         )
 
+    @classmethod
+    def warmup_bars(cls, **params):
+        """Bars needed before the first traded bar so the EMAs are warmed up over the 15 bar trend lookback."""
+        p = dict(cls.params._getkwargsdefault(), **params)
+        return max(p['ema_period_1'], p['ema_period_2'], p['ema_period_3']) - 1 + 15
+
     def log(self, txt, dt=None):
         dt = dt or self.datas[0].datetime.date(0)
         self.params.file_handle.write("{}, {}\n".format(dt.isoformat(), txt))
@@ -27,10 +51,17 @@ class ScalpingStrategy(bt.Strategy):
         self.buy_comm = None
         self.size = 0
 
+        # Bars up to the checkpoint were already traded so they are only replayed for the lookbacks
+        seeds = {}
+        self.resume_until = None
+        if self.params.checkpoint:
+            seeds = self.params.checkpoint.get('seeds', {})
+            self.resume_until = self.params.checkpoint['last_datetime']
+
         # Create EMAs
-        self.ema25 = bt.indicators.ExponentialMovingAverage(self.data, period=self.params.ema_period_1)
-        self.ema50 = bt.indicators.ExponentialMovingAverage(self.data, period=self.params.ema_period_2)
-        self.ema100 = bt.indicators.ExponentialMovingAverage(self.data, period=self.params.ema_period_3)
+        self.ema25 = ResumableEMA(self.data, period=self.params.ema_period_1, seed=seeds.get('ema25'))
+        self.ema50 = ResumableEMA(self.data, period=self.params.ema_period_2, seed=seeds.get('ema50'))
+        self.ema100 = ResumableEMA(self.data, period=self.params.ema_period_3, seed=seeds.get('ema100'))
 
         self.is_uptrend = self.is_downtrend = False
         self.is_below_25_or_50_ema = self.is_above_25_or_50_ema = False
@@ -40,6 +71,34 @@ class ScalpingStrategy(bt.Strategy):
         self.duration_for_order = 0
         self.max_duration = 30
 
+    def start(self):
+        if self.params.checkpoint:
+            restore_checkpoint(self, self.params.checkpoint)
+            if self.params.risk_engine is not None and self.position:
+                self.params.risk_engine.set_position(
+                        self.data._name, self.position.size, self.position.price, self.stop_loss)
+
+    def check_risk(self, size, stop_loss=None):
+        # Pass an order (negative size to sell) through the risk engine, None if it was rejected
+        if self.params.risk_engine is None:
+            return size
+        allowed, reason = self.params.risk_engine.check_order(self.data._name, size, self.data_close[0], stop_loss)
+        if reason:
+            self.log('Risk Limit, %s, Size: %d, Allowed: %d' % (reason, size, allowed))
+        return allowed or None
+
+    def check_exit(self, size):
+        # Orders closing the position are never held back by the risk limits
+        if self.position.size and (size > 0) != (self.position.size > 0):
+            return size
+        return self.check_risk(size)
+
+    def stop(self):
+        if self.params.checkpoint_path:
+            save_checkpoint(self.params.checkpoint_path, self, self.checkpoint_flags,
+                            dict(ema25=self.ema25, ema50=self.ema50, ema100=self.ema100),
+                            self.params.checkpoint_bars)
+
     def notify_order(self, order):
         if order.status in [order.Submitted, order.Accepted]:
             # Buy/Sell order submitted/accepted by broker so do nothing
@@ -47,6 +106,8 @@ class ScalpingStrategy(bt.Strategy):
 
         # Check if an order has been completed
         if order.status in [order.Completed]:
+            if self.params.risk_engine is not None:
+                self.params.risk_engine.on_fill(self.data._name, order.executed.size, order.executed.price, self.stop_loss)
             if order.isbuy():
                 self.log(
                         'BUY EXECUTED, Size: %d, Price: %.2f, Cost: %.2f, Comm %.2f' %
@@ -73,6 +134,24 @@ class ScalpingStrategy(bt.Strategy):
                     (trade.pnl, trade.pnlcomm))
 
     def next(self):
+        if self.resume_until is not None and self.datas[0].datetime[0] <= self.resume_until:
+            # Resubmit orders left pending at the checkpoint so they fill on the first new bar
+            if self.datas[0].datetime[0] == self.resume_until:
+                submit_pending_orders(self, self.params.checkpoint)
+            return
+
+        # Bars loaded before the requested window only warm up the indicators
+        if self.params.fromdate and self.datas[0].datetime.datetime(0) < self.params.fromdate:
+            return
+
+        # Stop the run once an optimizer knows these params cannot beat its best
+        if self.params.abort_check is not None and self.params.abort_check(self):
+            self.env.runstop()
+            return
+
+        if self.params.risk_engine is not None:
+            self.params.risk_engine.on_price(self.data._name, self.data_close[0], self.datas[0].datetime.date(0))
+
         self.log('Open, %.2f' % self.data_close[0])
 
         # If order is still pending we cannot place another order
@@ -100,12 +179,14 @@ class ScalpingStrategy(bt.Strategy):
                 elif self.data_close[0] > self.ema25[0] > self.ema50[0] > self.ema100[0]:
                     if self.is_below_25_or_50_ema:
                         cash = self.broker.get_cash()
-                        max_shares_to_buy = int(cash / self.data_close[0])
-                        self.order = self.buy(size=max_shares_to_buy)
-                        self.buy_order = True
+                        max_shares_to_buy = self.check_risk(int(cash / self.data_close[0]), round(self.ema50[0], 2))
+                        if max_shares_to_buy is not None:
+                            self.order = self.buy(size=max_shares_to_buy)
+                            self.buy_order = True
+                            self.stop_loss = round(self.ema50[0], 2)
+                            self.order.addinfo(stop_loss=self.stop_loss)
+                            self.take_profit = round(self.data_close[0] + (self.data_close[0] - self.stop_loss) * 1.5, 2)
                         self.is_uptrend = self.is_below_25_or_50_ema = False
-                        self.stop_loss = round(self.ema50[0], 2)
-                        self.take_profit = round(self.data_close[0] + (self.data_close[0] - self.stop_loss) * 1.5, 2)
                 else:
                     self.is_uptrend = self.is_below_25_or_50_ema = False
 
@@ -127,12 +208,14 @@ class ScalpingStrategy(bt.Strategy):
                 elif self.data_close[0] < self.ema25[0] < self.ema50[0] < self.ema100[0]:
                     if self.is_above_25_or_50_ema:
                         cash = self.broker.get_cash()
-                        max_shares_to_sell = int(cash / self.data_close[0])
-                        self.order = self.sell(size=max_shares_to_sell)
-                        self.sell_order = True
+                        max_shares_to_sell = self.check_risk(-int(cash / self.data_close[0]), round(self.ema50[0], 2))
+                        if max_shares_to_sell is not None:
+                            self.order = self.sell(size=-max_shares_to_sell)
+                            self.sell_order = True
+                            self.stop_loss = round(self.ema50[0], 2)
+                            self.order.addinfo(stop_loss=self.stop_loss)
+                            self.take_profit = round(self.data_close[0] - (self.stop_loss - self.data_close[0]) * 1.5, 2)
                         self.is_downtrend = self.is_above_25_or_50_ema = False
-                        self.stop_loss = round(self.ema50[0], 2)
-                        self.take_profit = round(self.data_close[0] - (self.stop_loss - self.data_close[0]) * 1.5, 2)
                 else:
                     self.is_downtrend = self.is_above_25_or_50_ema = False
         else:
@@ -141,18 +224,24 @@ class ScalpingStrategy(bt.Strategy):
                     self.data_close[0] >= self.take_profit or \
                     self.duration_for_order == self.max_duration and \
                     self.buy_order == True:
-                self.order = self.sell(size=self.position.size)
-                self.is_uptrend = self.is_below_25_or_50_ema = self.buy_order = False
-                self.duration_for_order = -1
+                size = self.check_exit(-abs(self.position.size))
+                # A rejected order leaves the position open so the exit is tried again next bar
+                if size is not None:
+                    self.order = self.sell(size=-size)
+                    self.is_uptrend = self.is_below_25_or_50_ema = self.buy_order = False
+                    self.duration_for_order = -1
 
             # Buy for the placed sell order
             if self.data_close[0] >= self.stop_loss or \
                     self.data_close[0] <= self.take_profit or \
                     self.duration_for_order == self.max_duration and \
                     self.sell_order == True:
-                self.order = self.buy(size=self.position.size)
-                self.is_downtrend = self.is_above_25_or_50_ema = self.sell_order = False
-                self.duration_for_order = -1
+                size = self.check_exit(abs(self.position.size))
+                # A rejected order leaves the position open so the exit is tried again next bar
+                if size is not None:
+                    self.order = self.buy(size=size)
+                    self.is_downtrend = self.is_above_25_or_50_ema = self.sell_order = False
+                    self.duration_for_order = -1
 
             self.duration_for_order += 1
 
@@ -165,38 +254,110 @@ def parse_args():
                         choices=['cba', 'gmg', 'ioo', 'ndq', 'vas', 'wes'],
                         help='File Data to Load')
 
-    parser.add_argument('--timeframe', default='daily', required=False,
+    # Several timeframes can be given to run them all over a single load of the data
+    parser.add_argument('--timeframe', default=['daily'], required=False, nargs='+',
                         choices=['daily', 'weekly', 'monthly'],
-                        help='Timeframe to resample to')
+                        help='Timeframes to resample to')
 
     # This will allow us to compress data to display customised timeframes like 1 day, 2 weeks, etc
-    parser.add_argument('--compression', default=1, required=False, type=int,
-                        help='Compress n bars into 1')
+    parser.add_argument('--compression', default=[1], required=False, type=int, nargs='+',
+                        help='Compress n bars into 1 for each given n')
+
+    # Checkpoints let a later run carry on over only the newly appended bars
+    parser.add_argument('--checkpoint-dir', default=None, required=False,
+                        help='Directory to save a checkpoint to at the end of each run')
+
+    parser.add_argument('--resume', action='store_true', required=False,
+                        help='Carry on from the checkpoint saved in the checkpoint directory')
+
+    # Risk limits in dollars, any given turns on the pre-trade risk checks
+    parser.add_argument('--max-exposure', default=None, required=False, type=float,
+                        help='Largest position value allowed')
+
+    parser.add_argument('--max-trade-risk', default=None, required=False, type=float,
+                        help='Largest loss allowed on a trade if its stop loss is hit')
+
+    parser.add_argument('--max-daily-loss', default=None, required=False, type=float,
+                        help='No new positions are opened once the day has lost this much')
+
+    # Journal every order so a live run can rebuild its state after a crash
+    parser.add_argument('--journal-dir', default=None, required=False,
+                        help='Directory to keep a write-ahead journal of orders and fills in')
+
+    parser.add_argument('--fresh-journal', action='store_true',
+                        help='Drop the journal of an earlier run instead of carrying on from it')
+
+    # Backtest a window of the price file, reading only it and the bars the indicators need before it
+    parser.add_argument('--fromdate', default=datetime.datetime(2019, 1, 1), required=False,
+                        type=datetime.datetime.fromisoformat,
+                        help='First date to trade, e.g. 2023-10-01')
+
+    parser.add_argument('--todate', default=datetime.datetime(2024, 1, 1), required=False,
+                        type=datetime.datetime.fromisoformat,
+                        help='Date to stop at')
 
     return parser.parse_args()
 
-def perform_simulation(args):
+def run_timeframe(args, arrays, timeframe, compression):
 
     # Create a cerebro entity
     cerebro = bt.Cerebro()
-    
-    f = open("./order-execs/scalping/{}/scalping-{}-{}-{}.txt".format(args.dataname, args.dataname, args.compression, args.timeframe), "w")
+
+    # Set desired cash start
+    cash = 1000
+
+    checkpoint = checkpoint_path = None
+    if args.checkpoint_dir:
+        checkpoint_path = os.path.join(
+                args.checkpoint_dir,
+                'scalping-{}-{}-{}.json'.format(args.dataname, compression, timeframe))
+        if args.resume and os.path.exists(checkpoint_path):
+            checkpoint = load_checkpoint(checkpoint_path)
+            arrays = resume_arrays(checkpoint, arrays)
+        # Only checkpoint at the end of a bar known to be complete, the bar still being made up is
+        # traded by the resumed run
+        until = complete_until(arrays['datetime'], timeframe, compression)
+        if until is not None and (checkpoint is None or until > checkpoint['last_datetime']):
+            cerebro.addanalyzer(StopAfter, until=until)
+
+    journal = None
+    if args.journal_dir:
+        # The journal of an earlier run is only dropped when asked to
+        journal = OrderJournal(os.path.join(
+                args.journal_dir,
+                'scalping-{}-{}-{}'.format(args.dataname, compression, timeframe)),
+                fresh=args.fresh_journal)
+        # With no checkpoint to resume from carry on from the last bar the journal got to. Every bar
+        # is replayed so the indicators warm up just as they did, only the trading is skipped
+        if not checkpoint and journal.state.last_datetime is not None:
+            checkpoint = journal.state.checkpoint(cash)
+
+    # Carry on writing to the same file when resuming
+    logpath = "./order-execs/scalping/{}/scalping-{}-{}-{}.txt".format(args.dataname, args.dataname, compression, timeframe)
+    f = reopen_log(logpath, checkpoint['last_datetime']) if checkpoint else open(logpath, "w")
+
+    # Check every order against the risk limits if any were given
+    risk_engine = None
+    if args.max_exposure or args.max_trade_risk or args.max_daily_loss:
+        risk_engine = RiskEngine(
+                checkpoint['cash'] if checkpoint else cash,
+                max_symbol_exposure=args.max_exposure,
+                max_trade_risk=args.max_trade_risk,
+                max_daily_loss=args.max_daily_loss)
+
     # Add a strategy
-    cerebro.addstrategy(ScalpingStrategy, file_handle=f)
+    cerebro.addstrategy(ScalpingStrategy, file_handle=f, fromdate=args.fromdate,
+                        checkpoint=checkpoint, checkpoint_path=checkpoint_path,
+                        risk_engine=risk_engine)
 
-    # Data file location
-    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
-    datapath = os.path.join(
-            modpath, 
-            './data/historical-prices/{}-2019-2024.csv'.format(args.dataname))
+    if journal:
+        cerebro.addanalyzer(OrderJournalAnalyzer, journal=journal)
 
-    # Create a data feed
-    data = bt.feeds.YahooFinanceCSVData(
-            dataname=datapath,
+    # Create a data feed over the already parsed prices
+    data = PriceArrayData(
+            arrays=arrays,
             name=args.dataname.upper(),
-            fromdate=datetime.datetime(2019, 1, 1),
-            todate=datetime.datetime(2024, 1, 1),
-            reverse=False)
+            todate=args.todate)
 
     # dictionary for argument timeframe conversion
     tframes = dict(
@@ -207,12 +368,10 @@ def perform_simulation(args):
     # Resample data to timeframe
     cerebro.resampledata(
             data,
-            timeframe=tframes[args.timeframe],
-            compression=args.compression)
-
-    # Set desired cash start
-    cash = 1000
-    cerebro.broker.setcash(cash)
+            timeframe=tframes[timeframe],
+            compression=compression)
+    
+    cerebro.broker.setcash(checkpoint['cash'] if checkpoint else cash)
 
     # Add a sizer to determine number of shares should be brought with max value for a buy trade
     # cerebro.addsizer(MaxCostSizer, max_trade_value=cash, initial_trade_value=cash)
@@ -221,10 +380,11 @@ def perform_simulation(args):
     cerebro.broker.setcommission(commission=0.0)
 
     # Write starting cash into file
-    f.write("Share Name: {}\n".format(args.dataname.upper()))
-    f.write("Starting Portfolio Value: {:.2f}\n".format(cerebro.broker.getvalue()))
-    print("Share Name: {}".format(args.dataname.upper()))
-    print("Starting Portfolio Value: {:.2f}".format(cerebro.broker.getvalue()))
+    if not checkpoint:
+        f.write("Share Name: {}\n".format(args.dataname.upper()))
+        f.write("Starting Portfolio Value: {:.2f}\n".format(cerebro.broker.getvalue()))
+    print("Share Name: {} ({} {})".format(args.dataname.upper(), compression, timeframe))
+    print("Starting Portfolio Value: {:.2f}".format(cash))
 
     # Run over everything
     cerebro.run()
@@ -234,8 +394,34 @@ def perform_simulation(args):
     print("Final Portfolio Value: {:.2f}".format(cerebro.broker.getvalue()))
     print("Total Profit: {:.2f}".format(cerebro.broker.getvalue() - cash))
     f.close()
-    # Plot the result
-    cerebro.plot()
+    if journal:
+        journal.close()
+    return cerebro
+
+def perform_simulation(args):
+
+    # Data file location
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    datapath = os.path.join(
+            modpath, 
+            './data/historical-prices/{}-2019-2024.csv'.format(args.dataname))
+
+    # Load and parse the data once and share it between every timeframe run. Each timeframe is
+    # still its own cerebro run over the arrays (one cerebro would share a single broker between
+    # the timeframes). Only the bars from the window and enough before it to warm up the longest
+    # timeframe are read
+    warmup = max(ScalpingStrategy.warmup_bars() * DAYS_PER_BAR[timeframe] * compression
+                 for timeframe in args.timeframe for compression in args.compression)
+    arrays = load_price_arrays(datapath, fromdate=args.fromdate, todate=args.todate, warmup=warmup)
+
+    cerebros = []
+    for timeframe in args.timeframe:
+        for compression in args.compression:
+            cerebros.append(run_timeframe(args, arrays, timeframe, compression))
+
+    # Plot the results
+    for cerebro in cerebros:
+        cerebro.plot()
 
 if __name__ == '__main__':
 
@@ -4,6 +4,8 @@ import datetime
 import os.path
 import sys
 
+from price_data import DAYS_PER_BAR, PriceArrayData, load_price_arrays
+
 class MaxCostSizer(bt.Sizer):
     params = (
             ('max_trade_value', 0), # Set the maximum cost per trade parameter
@@ -25,9 +27,15 @@ class MaxCostSizer(bt.Sizer):
 class SimpleStrategy(bt.Strategy):
     params = (
             ('exitbars', 5),
-            ('file_handle', None)
+            ('file_handle', None),
+            ('fromdate', None)          # Bars before this only warm up the lookbacks
         )
 
+    @classmethod
+    def warmup_bars(cls, **params):
+        """Bars needed before the first traded bar, just the previous open."""
+        return 1
+
     def log(self, txt, dt=None):
         dt = dt or self.datas[0].datetime.date(0)
         self.params.file_handle.write("{}, {}\n".format(dt.isoformat(), txt))
@@ -77,6 +85,9 @@ class SimpleStrategy(bt.Strategy):
                     (trade.pnl, trade.pnlcomm))
 
     def next(self):
+        if self.params.fromdate and self.datas[0].datetime.datetime(0) < self.params.fromdate:
+            return
+
         self.log('Open, %.2f' % self.data_open[0])
 
         # If order is still pending we cannot place another order
@@ -103,38 +114,40 @@ def parse_args():
                         choices=['cba', 'gmg', 'ioo', 'ndq', 'vas', 'wes'],
                         help='File Data to Load')
 
-    parser.add_argument('--timeframe', default='daily', required=False,
+    # Several timeframes can be given to run them all over a single load of the data
+    parser.add_argument('--timeframe', default=['daily'], required=False, nargs='+',
                         choices=['daily', 'weekly', 'monthly'],
-                        help='Timeframe to resample to')
+                        help='Timeframes to resample to')
 
     # This will allow us to compress data to display customised timeframes like 1 day, 2 weeks, etc
-    parser.add_argument('--compression', default=1, required=False, type=int,
-                        help='Compress n bars into 1')
+    parser.add_argument('--compression', default=[1], required=False, type=int, nargs='+',
+                        help='Compress n bars into 1 for each given n')
+
+    # Backtest a window of the price file, reading only it and the bars the indicators need before it
+    parser.add_argument('--fromdate', default=datetime.datetime(2019, 1, 1), required=False,
+                        type=datetime.datetime.fromisoformat,
+                        help='First date to trade, e.g. 2023-10-01')
+
+    parser.add_argument('--todate', default=datetime.datetime(2024, 1, 1), required=False,
+                        type=datetime.datetime.fromisoformat,
+                        help='Date to stop at')
 
     return parser.parse_args()
 
-def perform_simulation(args):
+def run_timeframe(args, arrays, timeframe, compression):
 
     # Create a cerebro entity
     cerebro = bt.Cerebro()
     
-    f = open("./order-execs/simple/{}/simple-{}-{}-{}.txt".format(args.dataname, args.dataname, args.compression, args.timeframe), "w")
+    f = open("./order-execs/simple/{}/simple-{}-{}-{}.txt".format(args.dataname, args.dataname, compression, timeframe), "w")
     # Add a strategy
-    cerebro.addstrategy(SimpleStrategy, file_handle=f)
-
-    # Data file location
-    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
-    datapath = os.path.join(
-            modpath, 
-            './data/historical-prices/{}-2019-2024.csv'.format(args.dataname))
+    cerebro.addstrategy(SimpleStrategy, file_handle=f, fromdate=args.fromdate)
 
-    # Create a data feed
-    data = bt.feeds.YahooFinanceCSVData(
-            dataname=datapath,
+    # Create a data feed over the already parsed prices
+    data = PriceArrayData(
+            arrays=arrays,
             name=args.dataname.upper(),
-            fromdate=datetime.datetime(2019, 1, 1),
-            todate=datetime.datetime(2024, 1, 1),
-            reverse=False)
+            todate=args.todate)
 
     # dictionary for argument timeframe conversion
     tframes = dict(
@@ -145,9 +158,9 @@ def perform_simulation(args):
     # Resample data to timeframe
     cerebro.resampledata(
             data,
-            timeframe=tframes[args.timeframe],
-            compression=args.compression)
-
+            timeframe=tframes[timeframe],
+            compression=compression)
+    
     # Set desired cash start
     cash = 10000
     cerebro.broker.setcash(cash)
@@ -161,7 +174,7 @@ def perform_simulation(args):
     # Write starting cash into file
     f.write("Share Name: {}\n".format(args.dataname.upper()))
     f.write("Starting Portfolio Value: {:.2f}\n".format(cerebro.broker.getvalue()))
-    print("Share Name: {}".format(args.dataname.upper()))
+    print("Share Name: {} ({} {})".format(args.dataname.upper(), compression, timeframe))
     print("Starting Portfolio Value: {:.2f}".format(cerebro.broker.getvalue()))
 
     # Run over everything
@@ -172,8 +185,32 @@ def perform_simulation(args):
     print("Final Portfolio Value: {:.2f}".format(cerebro.broker.getvalue()))
     print("Total Profit: {:.2f}".format(cerebro.broker.getvalue() - cash))
     f.close()
-    # Plot the result
-    cerebro.plot()
+    return cerebro
+
+def perform_simulation(args):
+
+    # Data file location
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    datapath = os.path.join(
+            modpath, 
+            './data/historical-prices/{}-2019-2024.csv'.format(args.dataname))
+
+    # Load and parse the data once and share it between every timeframe run. Each timeframe is
+    # still its own cerebro run over the arrays (one cerebro would share a single broker between
+    # the timeframes). Only the bars from the window and enough before it to warm up the longest
+    # timeframe are read
+    warmup = max(SimpleStrategy.warmup_bars() * DAYS_PER_BAR[timeframe] * compression
+                 for timeframe in args.timeframe for compression in args.compression)
+    arrays = load_price_arrays(datapath, fromdate=args.fromdate, todate=args.todate, warmup=warmup)
+
+    cerebros = []
+    for timeframe in args.timeframe:
+        for compression in args.compression:
+            cerebros.append(run_timeframe(args, arrays, timeframe, compression))
+
+    # Plot the results
+    for cerebro in cerebros:
+        cerebro.plot()
 
 if __name__ == '__main__':
 
@@ -0,0 +1,1075 @@
+import abc
+import argparse
+import datetime
+import math
+import operator
+import os.path
+import sys
+import time
+from collections import deque
+
+import backtrader as bt
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from price_data import load_price_arrays
+
+class Expr:
+    """Node of a rule expression.
+
+    Arithmetic and comparison operators build new nodes, `&`, `|` and `Not`
+    combine conditions (`and`, `or` and chained comparisons cannot be
+    overloaded so they raise) and `x.ago(n)` is the value of x n bars ago.
+    `minperiod` counts the bars a node needs before it has a value, the
+    same way backtrader counts them for indicators.
+    """
+
+    def __init__(self, *inputs):
+        self.inputs = tuple(wrap(x) for x in inputs)
+
+    @property
+    def minperiod(self):
+        return max([x.minperiod for x in self.inputs] or [1])
+
+    def ago(self, bars):
+        return Ago(self, bars)
+
+    def __bool__(self):
+        raise TypeError("Rule expressions are combined with & and |, not with and, or or chained comparisons")
+
+    __hash__ = object.__hash__
+
+    def __add__(self, other):
+        return Op(operator.add, self, other)
+
+    def __radd__(self, other):
+        return Op(operator.add, other, self)
+
+    def __sub__(self, other):
+        return Op(operator.sub, self, other)
+
+    def __rsub__(self, other):
+        return Op(operator.sub, other, self)
+
+    def __mul__(self, other):
+        return Op(operator.mul, self, other)
+
+    def __rmul__(self, other):
+        return Op(operator.mul, other, self)
+
+    def __truediv__(self, other):
+        return Op(operator.truediv, self, other)
+
+    def __rtruediv__(self, other):
+        return Op(operator.truediv, other, self)
+
+    def __neg__(self):
+        return Op(operator.neg, self)
+
+    def __lt__(self, other):
+        return Op(operator.lt, self, other)
+
+    def __le__(self, other):
+        return Op(operator.le, self, other)
+
+    def __gt__(self, other):
+        return Op(operator.gt, self, other)
+
+    def __ge__(self, other):
+        return Op(operator.ge, self, other)
+
+    def __eq__(self, other):
+        return Op(operator.eq, self, other)
+
+    def __ne__(self, other):
+        return Op(operator.ne, self, other)
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __rand__(self, other):
+        return And(other, self)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __ror__(self, other):
+        return Or(other, self)
+
+def wrap(value):
+    return value if isinstance(value, Expr) else Const(value)
+
+class Const(Expr):
+    def __init__(self, value):
+        super(Const, self).__init__()
+        self.value = value
+
+class Field(Expr):
+    """Column of the price data: open, high, low, close or volume."""
+
+    def __init__(self, name):
+        super(Field, self).__init__()
+        self.name = name
+
+class Op(Expr):
+    """Element-wise operation.
+
+    `func` works on single values, `vfunc` (defaulting to `func`) on numpy
+    arrays. Both must give bit for bit the same results so either backend
+    trades the same.
+    """
+
+    def __init__(self, func, *inputs, vfunc=None):
+        super(Op, self).__init__(*inputs)
+        self.func = func
+        self.vfunc = vfunc or func
+
+    def apply(self, *values):
+        return self.func(*values)
+
+    def vector(self, *arrays):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.vfunc(*arrays)
+
+class And(Op):
+    def __init__(self, a, b):
+        super(And, self).__init__(lambda x, y: bool(x) and bool(y), a, b, vfunc=np.logical_and)
+
+class Or(Op):
+    def __init__(self, a, b):
+        super(Or, self).__init__(lambda x, y: bool(x) or bool(y), a, b, vfunc=np.logical_or)
+
+class Not(Op):
+    def __init__(self, a):
+        super(Not, self).__init__(operator.not_, a, vfunc=np.logical_not)
+
+class Abs(Op):
+    def __init__(self, a):
+        super(Abs, self).__init__(abs, a)
+
+class Min(Op):
+    def __init__(self, a, b):
+        super(Min, self).__init__(min, a, b, vfunc=np.minimum)
+
+def round_array(x, ndigits):
+    """Python's round over an array.
+
+    numpy's round scales by 10**ndigits and rounds that, which only gives a
+    different answer than round() when the scaled value is within rounding
+    error of a half or too large to scale exactly. Those few values are
+    rounded again with round().
+    """
+    x = np.asarray(x, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        out = np.round(x, ndigits)
+        scaled = np.abs(x * 10.0 ** ndigits)
+        redo = (np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6) | (scaled >= 2.0 ** 30)
+    for i in np.nonzero(redo)[0].tolist():
+        out[i] = round(x[i].item(), ndigits)
+    return out
+
+def int_array(x):
+    """int() over an array. Bars without a finite value are left as they are."""
+    x = np.asarray(x, dtype=np.float64)
+    out = x.astype(object)
+    valid = np.isfinite(x)
+    out[valid] = x[valid].astype(np.int64).tolist()
+    return out
+
+class Round(Op):
+    """Python's round, which numpy's round does not always match."""
+
+    def __init__(self, a, ndigits=2):
+        super(Round, self).__init__(
+                lambda x: round(x, ndigits), a,
+                vfunc=lambda x: round_array(x, ndigits))
+
+class Int(Op):
+    """Truncate towards zero like int(). Bars without a value are left as NaN."""
+
+    def __init__(self, a):
+        super(Int, self).__init__(int, a, vfunc=int_array)
+
+class Indicator(Expr, metaclass=abc.ABCMeta):
+    """Node which looks back over earlier bars.
+
+    `vector` works out every bar at once from the input arrays and `stream`
+    returns a function taking the bar number and the current input values,
+    called once per bar in order.
+    """
+
+    @abc.abstractmethod
+    def vector(self, *arrays):
+        pass
+
+    @abc.abstractmethod
+    def stream(self):
+        pass
+
+class EMA(Indicator):
+    """Exponential moving average seeded with the average of the first period values, like ResumableEMA.
+
+    Each value depends on the one before, so `vector` runs the recurrence
+    over the bars in Python. Without scipy's lfilter the only array forms
+    are a cumulative sum of scaled values, which drifts from the streamed
+    average in the last bits and so could trade differently.
+    """
+
+    def __init__(self, data, period):
+        super(EMA, self).__init__(data)
+        self.period = period
+        self.alpha = 2.0 / (1.0 + period)
+        self.alpha1 = 1.0 - self.alpha
+
+    @property
+    def minperiod(self):
+        return self.inputs[0].minperiod + self.period - 1
+
+    def vector(self, x):
+        values = x.tolist()
+        out = [math.nan] * len(values)
+        start = self.minperiod - 1
+        if start < len(values):
+            ema = out[start] = math.fsum(values[start - self.period + 1:start + 1]) / self.period
+            for i in range(start + 1, len(values)):
+                ema = out[i] = ema * self.alpha1 + values[i] * self.alpha
+        return np.array(out)
+
+    def stream(self):
+        window = deque(maxlen=self.period)
+        start = self.minperiod - 1
+        ema = [math.nan]
+
+        def push(i, x):
+            if i < start:
+                window.append(x)
+            elif i == start:
+                window.append(x)
+                ema[0] = math.fsum(window) / self.period
+            else:
+                ema[0] = ema[0] * self.alpha1 + x * self.alpha
+            return ema[0]
+        return push
+
+class Window(Indicator):
+    """Value worked out over the last `period` bars of the input."""
+
+    def __init__(self, data, period):
+        super(Window, self).__init__(data)
+        self.period = period
+
+    @property
+    def minperiod(self):
+        return self.inputs[0].minperiod + self.period - 1
+
+    @abc.abstractmethod
+    def reduce(self, window):
+        pass
+
+    def vector(self, x):
+        out = np.full(len(x), np.nan)
+        start = self.minperiod - 1
+        if start < len(x):
+            out[start:] = self.reduce_windows(sliding_window_view(x, self.period)[start - self.period + 1:])
+        return out
+
+    def reduce_windows(self, windows):
+        return [self.reduce(window) for window in windows.tolist()]
+
+    def stream(self):
+        window = deque(maxlen=self.period)
+        start = self.minperiod - 1
+
+        def push(i, x):
+            window.append(x)
+            return self.reduce(window) if i >= start else math.nan
+        return push
+
+class SMA(Window):
+    """Simple moving average summed with math.fsum like backtrader's SMA."""
+
+    def reduce(self, window):
+        return math.fsum(window) / self.period
+
+class Highest(Window):
+    def reduce(self, window):
+        return max(window)
+
+    def reduce_windows(self, windows):
+        return windows.max(axis=1)
+
+class Lowest(Window):
+    def reduce(self, window):
+        return min(window)
+
+    def reduce_windows(self, windows):
+        return windows.min(axis=1)
+
+class Ago(Indicator):
+    def __init__(self, data, bars):
+        super(Ago, self).__init__(data)
+        self.bars = bars
+
+    @property
+    def minperiod(self):
+        return self.inputs[0].minperiod + self.bars
+
+    def vector(self, x):
+        out = np.full(len(x), np.nan, dtype=x.dtype if x.dtype != bool else object)
+        out[self.bars:] = x[:len(x) - self.bars]
+        return out
+
+    def stream(self):
+        window = deque(maxlen=self.bars + 1)
+
+        def push(i, x):
+            window.append(x)
+            return window[0] if len(window) > self.bars else math.nan
+        return push
+
+class Always(Indicator):
+    """True when a condition held on each of the last `bars` bars."""
+
+    def __init__(self, condition, bars):
+        super(Always, self).__init__(condition)
+        self.bars = bars
+
+    def vector(self, condition):
+        out = np.zeros(len(condition), dtype=bool)
+        if self.bars <= len(condition):
+            out[self.bars - 1:] = sliding_window_view(condition.astype(bool), self.bars).all(axis=1)
+        return out
+
+    def stream(self):
+        run = [0]
+
+        def push(i, condition):
+            run[0] = run[0] + 1 if condition else 0
+            return run[0] >= self.bars
+        return push
+
+class MinPeriod(Indicator):
+    """Hide the input until `period` bars have been seen, like addminperiod on an indicator."""
+
+    def __init__(self, data, period):
+        super(MinPeriod, self).__init__(data)
+        self.period = period
+
+    @property
+    def minperiod(self):
+        return max(self.inputs[0].minperiod, self.period)
+
+    def vector(self, x):
+        out = np.array(x, dtype=np.float64)
+        out[:self.minperiod - 1] = np.nan
+        return out
+
+    def stream(self):
+        start = self.minperiod - 1
+
+        def push(i, x):
+            return x if i >= start else math.nan
+        return push
+
+class FeedbackSMA(Indicator):
+    """Average of the input with the last period-1 values of this average.
+
+    The Stochastic indicator's %D is smoothed over its own earlier output
+    (d_smooth reads the d line it then overwrites), which this reproduces.
+    The first period-1 values are the input itself. Feeding back its own
+    output has no array form, so `vector` runs the stream over every bar.
+    """
+
+    def __init__(self, data, period):
+        super(FeedbackSMA, self).__init__(data)
+        self.period = period
+
+    @property
+    def minperiod(self):
+        return self.inputs[0].minperiod + self.period - 1
+
+    def vector(self, x):
+        push = self.stream()
+        return np.array([push(i, v) for i, v in enumerate(x.tolist())])
+
+    def stream(self):
+        start = self.inputs[0].minperiod - 1
+        last = deque(maxlen=self.period - 1)
+
+        def push(i, x):
+            if i < start:
+                return math.nan
+            value = x if i < self.minperiod - 1 else math.fsum(list(last) + [x]) / self.period
+            last.append(value)
+            return value
+        return push
+
+class SwingStop(Indicator):
+    """Nearest swing low (or high) before the bar, as the stochastic strategy places its stop loss.
+
+    The stop is the lowest (highest) of the previous `bars` values. If that
+    equals the current value the search carries on further back to the
+    first value below (above) it. `vector` works out the windows with
+    numpy and only searches further back, bar by bar, where the stop ties.
+    """
+
+    def __init__(self, data, bars=14, low=True, ndigits=2):
+        super(SwingStop, self).__init__(data)
+        self.bars = bars
+        self.low = low
+        self.ndigits = ndigits
+
+    @property
+    def minperiod(self):
+        return self.inputs[0].minperiod + self.bars
+
+    def search(self, values, i, stop):
+        # Carry on back from the window for the first value beyond the stop
+        for j in range(i - self.bars - 1, -1, -1):
+            if values[j] < stop if self.low else values[j] > stop:
+                return round(values[j], self.ndigits)
+        return stop
+
+    def vector(self, x):
+        values = x.tolist()
+        rounded = round_array(x, self.ndigits)
+        windows = sliding_window_view(rounded, self.bars)[:len(x) - self.bars]
+        out = np.full(len(x), np.nan)
+        out[self.bars:] = windows.min(axis=1) if self.low else windows.max(axis=1)
+        for i in np.nonzero(out == rounded)[0].tolist():
+            out[i] = self.search(values, i, out[i])
+        return out
+
+    def stream(self):
+        values = []
+        start = self.minperiod - 1
+
+        def push(i, x):
+            values.append(x)
+            if i < start:
+                return math.nan
+            window = [round(v, self.ndigits) for v in values[-self.bars - 1:-1]]
+            stop = min(window) if self.low else max(window)
+            if stop == round(x, self.ndigits):
+                stop = self.search(values, i, stop)
+            return stop
+        return push
+
+class Runtime(Expr, metaclass=abc.ABCMeta):
+    """Value only known while the rules run: strategy state, broker or fill."""
+
+    @abc.abstractmethod
+    def getter(self):
+        pass
+
+class State(Runtime):
+    def __init__(self, name):
+        super(State, self).__init__()
+        self.name = name
+
+    def getter(self):
+        name = self.name
+        return lambda ctx: ctx.state[name]
+
+class Position(Runtime):
+    """Size of the position held, negative when short."""
+
+    def getter(self):
+        return lambda ctx: ctx.broker.size
+
+class Cash(Runtime):
+    def getter(self):
+        return lambda ctx: ctx.broker.cash
+
+class Fill(Runtime):
+    """size, price or comm of the fill an on_buy_fill/on_sell_fill rule runs for."""
+
+    def __init__(self, name):
+        super(Fill, self).__init__()
+        self.name = name
+
+    def getter(self):
+        name = self.name
+        return lambda ctx: ctx.fill[name]
+
+class If:
+    """Run the body of the first branch whose condition holds.
+
+    If(cond, *body).Elif(cond, *body).Else(*body)
+    """
+
+    def __init__(self, condition, *body):
+        self.branches = [(wrap(condition), body)]
+        self.otherwise = ()
+
+    def Elif(self, condition, *body):
+        self.branches.append((wrap(condition), body))
+        return self
+
+    def Else(self, *body):
+        self.otherwise = body
+        return self
+
+    def compile(self, compiler):
+        branches = [(compiler.expr(condition), compiler.block(body)) for condition, body in self.branches]
+        otherwise = compiler.block(self.otherwise)
+
+        def run(ctx):
+            for condition, body in branches:
+                if condition(ctx):
+                    body(ctx)
+                    return
+            otherwise(ctx)
+        return run
+
+class Set:
+    """Assign strategy state in the order given, each value seeing the ones set before it."""
+
+    def __init__(self, **assignments):
+        self.assignments = [(name, wrap(value)) for name, value in assignments.items()]
+
+    def compile(self, compiler):
+        assignments = [(name, compiler.expr(value)) for name, value in self.assignments]
+
+        def run(ctx):
+            for name, value in assignments:
+                ctx.state[name] = value(ctx)
+        return run
+
+class Buy:
+    """Market order for `size` shares filled at the next bar's open. A size of 0 places nothing."""
+
+    sign = 1
+
+    def __init__(self, size):
+        self.size = wrap(size)
+
+    def compile(self, compiler):
+        size = compiler.expr(self.size)
+        sign = self.sign
+
+        def run(ctx):
+            shares = size(ctx)
+            if shares:
+                ctx.broker.order(sign * shares, ctx.price)
+        return run
+
+class Sell(Buy):
+    sign = -1
+
+class RuleStrategy:
+    """A strategy written as rules.
+
+    `rules` run on every bar once the `indicators` have warmed up, with the
+    strategy state starting from `state`. `on_buy_fill` and `on_sell_fill`
+    run for every fill before the bar's rules. `log_field` is the price
+    logged for each bar.
+    """
+
+    def __init__(self, name, rules, state=None, indicators=(), on_buy_fill=(), on_sell_fill=(),
+                 log_field='close', cash=1000):
+        self.name = name
+        self.rules = rules
+        self.state = dict(state or {})
+        self.indicators = indicators
+        self.on_buy_fill = on_buy_fill
+        self.on_sell_fill = on_sell_fill
+        self.log_field = log_field
+        self.cash = cash
+
+    @property
+    def warmup(self):
+        return max([indicator.minperiod for indicator in self.indicators] or [1])
+
+class VectorBackend:
+    """Work out every indicator over the whole price history with numpy before the rules run.
+
+    EMA and FeedbackSMA feed on their own earlier values and are still
+    worked out bar by bar, as is SwingStop's search past a tied window.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.arrays = {}
+
+    def array(self, node):
+        if id(node) not in self.arrays:
+            if isinstance(node, Field):
+                array = self.columns[node.name]
+            elif isinstance(node, Const):
+                array = node.value
+            else:
+                array = node.vector(*[self.array(x) for x in node.inputs])
+            self.arrays[id(node)] = array
+        return self.arrays[id(node)]
+
+    def getter(self, node):
+        values = np.asarray(self.array(node)).tolist()
+        return lambda ctx: values[ctx.t]
+
+    def next(self, t, bar):
+        pass
+
+class StreamBackend:
+    """Update every indicator one bar at a time, as bars arrive when trading live."""
+
+    def __init__(self, columns):
+        self.slots = {}
+        self.current = []
+        self.fields = []
+        self.updates = []
+
+    def slot(self, node):
+        if id(node) not in self.slots:
+            inputs = [self.slot(x) for x in node.inputs]
+            slot = self.slots[id(node)] = len(self.current)
+            if isinstance(node, Field):
+                self.current.append(math.nan)
+                self.fields.append((slot, node.name))
+            elif isinstance(node, Const):
+                self.current.append(node.value)
+            else:
+                self.current.append(math.nan)
+                push = node.stream() if isinstance(node, Indicator) else (lambda i, *values, apply=node.apply: apply(*values))
+                self.updates.append((slot, push, inputs))
+        return self.slots[id(node)]
+
+    def getter(self, node):
+        current = self.current
+        slot = self.slot(node)
+        return lambda ctx: current[slot]
+
+    def next(self, t, bar):
+        current = self.current
+        for slot, name in self.fields:
+            current[slot] = bar[name]
+        for slot, push, inputs in self.updates:
+            current[slot] = push(t, *[current[i] for i in inputs])
+
+BACKENDS = dict(vector=VectorBackend, stream=StreamBackend)
+
+class RuleCompiler:
+    """Turn expressions and statements into functions of the run context.
+
+    Expressions which only depend on prices come from the backend. Those
+    mixing in strategy state, the broker or a fill are worked out when a
+    rule reaches them.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.runtime = {}
+
+    def is_runtime(self, node):
+        if id(node) not in self.runtime:
+            self.runtime[id(node)] = isinstance(node, Runtime) or any(self.is_runtime(x) for x in node.inputs)
+            if self.runtime[id(node)] and isinstance(node, Indicator):
+                raise ValueError("{} cannot look back over strategy state".format(type(node).__name__))
+        return self.runtime[id(node)]
+
+    def expr(self, node):
+        if isinstance(node, Const):
+            value = node.value
+            return lambda ctx: value
+        if isinstance(node, Runtime):
+            return node.getter()
+        if not self.is_runtime(node):
+            return self.backend.getter(node)
+
+        apply = node.apply
+        inputs = [self.expr(x) for x in node.inputs]
+        if len(inputs) == 1:
+            a, = inputs
+            return lambda ctx: apply(a(ctx))
+        a, b = inputs
+        return lambda ctx: apply(a(ctx), b(ctx))
+
+    def block(self, statements):
+        steps = [statement.compile(self) for statement in statements]
+
+        def run(ctx):
+            for step in steps:
+                step(ctx)
+        return run
+
+class RuleBroker:
+    """Cash and position of a single share traded with market orders.
+
+    Follows bt.brokers.BackBroker with its default settings and no
+    commission: orders placed on a bar are checked against the cash left
+    after them at the bar's close and filled at the next bar's open, or
+    only their closing part is filled if opening the rest would take the
+    cash below zero. Shorting adds the sale to the cash.
+    """
+
+    def __init__(self, cash):
+        self.cash = cash
+        self.size = 0
+        self.price = 0.0
+        self.submitted = []
+        # Size, price and profit of the open trade
+        self.trade = [0, 0.0, 0.0]
+
+    def order(self, size, price):
+        self.submitted.append((size, price))
+
+    @staticmethod
+    def update(size, price, change, at):
+        # Position.update: returns the new size, price and the opened and closed parts of change
+        new = size + change
+        if not new:
+            return new, 0.0, 0, change
+        if not size:
+            return new, at, change, 0
+        if (size > 0) == (change > 0):
+            return new, (price * size + change * at) / new, change, 0
+        if (size > 0) == (new > 0):
+            return new, price, 0, change
+        return new, at, new, -size
+
+    def next(self, open_price):
+        """Fill the orders placed on the last bar. Returns the order and trade notifications."""
+        orders, trades = [], []
+        accepted = []
+
+        # Every order is checked after the ones before it, at the price it was placed at
+        cash, size, price = self.cash, self.size, self.price
+        for order in self.submitted:
+            change, at = order
+            size, price, opened, closed = self.update(size, price, change, at)
+            if closed:
+                cash += -closed * at
+            if opened:
+                cash -= opened * at
+            if cash >= 0.0:
+                accepted.append(order)
+            else:
+                orders.append(('margin', None))
+        self.submitted = []
+
+        for change, at in accepted:
+            at = open_price
+            price_orig = self.price
+            size, price, opened, closed = self.update(self.size, self.price, change, at)
+            pnl = -closed * (at - price_orig)
+            cash = self.cash
+            closedvalue = openedvalue = 0.0
+            if closed:
+                closedvalue = -closed * price_orig
+                cash += closedvalue + pnl
+                self.cash = cash
+            wanted = opened
+            if opened:
+                openedvalue = opened * at
+                cash -= openedvalue
+                if cash < 0.0:
+                    # Not enough cash to open - only the closing part is filled
+                    opened = 0
+                    openedvalue = 0.0
+                else:
+                    self.cash = cash
+
+            executed = closed + opened
+            if executed:
+                self.size, self.price, _, _ = self.update(self.size, self.price, executed, at)
+                orders.append(('fill', dict(
+                        size=executed, price=(executed * at) / executed,
+                        value=closedvalue + openedvalue, comm=0.0)))
+                trades.extend(self.update_trade(closed, opened, at))
+            if wanted and not opened:
+                orders.append(('margin', None))
+        return orders, trades
+
+    def update_trade(self, closed, opened, at):
+        # Trade.update for the closed and then opened parts, returning the profit of a closed trade
+        closes = []
+        for change in (closed, opened):
+            if not change:
+                continue
+            size, price, pnl = self.trade
+            new = size + change
+            if abs(new) > abs(size):
+                price = (size * price + change * at) / new
+            else:
+                pnl += -change * (at - price)
+            self.trade = [new, price, pnl]
+            if size and not new:
+                closes.append(pnl)
+                self.trade = [0, 0.0, 0.0]
+        return closes
+
+    def value(self, close):
+        return self.cash + (0.0 + self.size * close)
+
+class RuleContext:
+    def __init__(self, state, broker):
+        self.state = state
+        self.broker = broker
+        self.fill = None
+        self.t = 0
+        self.price = math.nan
+
+class RuleRunner:
+    """Backtest a RuleStrategy over price arrays with either backend.
+
+    The log is written line for line like the backtest scripts write to
+    order-execs so the two can be compared.
+    """
+
+    def __init__(self, strategy, columns, backend='vector', cash=None, name=''):
+        self.strategy = strategy
+        self.columns = columns
+        self.name = name
+        self.cash = strategy.cash if cash is None else cash
+        self.broker = RuleBroker(self.cash)
+        self.ctx = RuleContext(dict(strategy.state), self.broker)
+
+        self.backend = BACKENDS[backend](columns)
+        compiler = RuleCompiler(self.backend)
+        self.rules = compiler.block(strategy.rules)
+        self.on_fill = (compiler.block(strategy.on_sell_fill), compiler.block(strategy.on_buy_fill))
+        self.lines = []
+
+    def log(self, t, txt):
+        self.lines.append("{}, {}\n".format(bt.num2date(self.dates[t]).date().isoformat(), txt))
+
+    def run(self):
+        columns = self.columns
+        self.dates = columns['datetime'].tolist()
+        bars = [dict(zip(('open', 'high', 'low', 'close', 'volume'), row)) for row in zip(
+                *[columns[name].tolist() for name in ('open', 'high', 'low', 'close', 'volume')])]
+        logged = columns[self.strategy.log_field].tolist()
+        start = self.strategy.warmup - 1
+        ctx = self.ctx
+
+        self.lines = ["Share Name: {}\n".format(self.name.upper()),
+                      "Starting Portfolio Value: {:.2f}\n".format(self.cash)]
+        for t, bar in enumerate(bars):
+            self.backend.next(t, bar)
+            ctx.t = t
+
+            # Fills of the last bar's orders are reported before the bar's rules run
+            orders, trades = self.broker.next(bar['open'])
+            for kind, fill in orders:
+                if kind == 'margin':
+                    self.log(t, 'Order Canceled/Margin/Rejected')
+                    continue
+                self.log(t, '%s EXECUTED, Size: %d, Price: %.2f, Cost: %.2f, Comm %.2f' % (
+                        'BUY' if fill['size'] > 0 else 'SELL', fill['size'], fill['price'], fill['value'], fill['comm']))
+                ctx.fill = fill
+                self.on_fill[fill['size'] > 0](ctx)
+            for pnl in trades:
+                self.log(t, 'OPERATION PROFIT, GROSS %.2f, NET %.2f' % (pnl, pnl))
+
+            if t >= start:
+                self.log(t, 'Open, %.2f' % logged[t])
+                ctx.price = bar['close']
+                self.rules(ctx)
+
+        value = self.broker.value(bars[-1]['close']) if bars else self.cash
+        self.lines.append("Final Portfolio Value: {:.2f}\n".format(value))
+        self.lines.append("Total Profit: {:.2f}\n".format(value - self.cash))
+        return self.lines
+
+def simple_rules(cash=10000):
+    """SimpleStrategy with MaxCostSizer: buy when the open drops, sell once the open is above the buy price."""
+    open_ = Field('open')
+    return RuleStrategy(
+            'simple',
+            rules=[
+                If(Position() == 0,
+                    If(open_ < open_.ago(1),
+                        Buy(Min(Int(State('max_trade_value') / open_), Int(Cash() / open_)))))
+                .Else(
+                    If(open_ * State('size') > State('buy_price') * State('size'),
+                        # Max trade value is 10% of cash in account for the next buy
+                        Set(max_trade_value=Cash() * 0.1),
+                        Sell(Position())))
+            ],
+            state=dict(max_trade_value=cash * 0.1, buy_price=None, size=0),
+            on_buy_fill=[Set(buy_price=Fill('price'), size=Fill('size'))],
+            log_field='open',
+            cash=cash)
+
+def exit_rules(max_duration, buy_flags, sell_flags):
+    # Close at the stop loss, take profit or after max_duration bars (the exits of both trend strategies)
+    close = Field('close')
+    stop_loss, take_profit, duration = State('stop_loss'), State('take_profit'), State('duration_for_order')
+    return [
+        If((close <= stop_loss) | (close >= take_profit) | ((duration == max_duration) & (State('buy_order') == True)),
+            Sell(Abs(Position())),
+            Set(**dict({flag: False for flag in buy_flags}, buy_order=False, duration_for_order=-1))),
+        If((close >= stop_loss) | (close <= take_profit) | ((duration == max_duration) & (State('sell_order') == True)),
+            Buy(Abs(Position())),
+            Set(**dict({flag: False for flag in sell_flags}, sell_order=False, duration_for_order=-1))),
+        Set(duration_for_order=duration + 1)
+    ]
+
+def scalping_rules(ema_period_1=25, ema_period_2=50, ema_period_3=100, trend_bars=15, max_duration=30, cash=1000):
+    """ScalpingStrategy: pullbacks to the 25/50 EMA in a trend of stacked 25/50/100 EMAs."""
+    close = Field('close')
+    ema25, ema50, ema100 = EMA(close, ema_period_1), EMA(close, ema_period_2), EMA(close, ema_period_3)
+    rising = (ema25 >= ema25.ago(1)) & (ema50 >= ema50.ago(1)) & (ema100 >= ema100.ago(1))
+    falling = (ema25 <= ema25.ago(1)) & (ema50 <= ema50.ago(1)) & (ema100 <= ema100.ago(1))
+    above = (close > ema25) & (ema25 > ema50) & (ema50 > ema100)
+    below = (close < ema25) & (ema25 < ema50) & (ema50 < ema100)
+    S = State
+
+    return RuleStrategy(
+            'scalping',
+            rules=[
+                If(Position() == 0,
+                    # Check if in uptrend
+                    If((S('is_uptrend') == False) & (S('is_downtrend') == False) & (S('buy_order') == False),
+                        Set(is_uptrend=Always(rising & above, trend_bars)))
+                    .Elif((S('is_uptrend') == True) & (S('buy_order') == False),
+                        If((close <= ema25) & (close > ema100),
+                            Set(is_below_25_or_50_ema=True))
+                        .Elif(above,
+                            If(S('is_below_25_or_50_ema'),
+                                Buy(Int(Cash() / close)),
+                                Set(buy_order=True, stop_loss=Round(ema50, 2)),
+                                Set(take_profit=Round(close + (close - S('stop_loss')) * 1.5, 2),
+                                    is_uptrend=False, is_below_25_or_50_ema=False)))
+                        .Else(
+                            Set(is_uptrend=False, is_below_25_or_50_ema=False))),
+
+                    # Check if in downtrend
+                    If((S('is_uptrend') == False) & (S('is_downtrend') == False) & (S('sell_order') == False),
+                        Set(is_downtrend=Always(falling & below, trend_bars)))
+                    .Elif((S('is_downtrend') == True) & (S('sell_order') == False),
+                        If((close >= ema25) & (close < ema100),
+                            Set(is_above_25_or_50_ema=True))
+                        .Elif(below,
+                            If(S('is_above_25_or_50_ema'),
+                                Sell(Int(Cash() / close)),
+                                Set(sell_order=True, stop_loss=Round(ema50, 2)),
+                                Set(take_profit=Round(close - (S('stop_loss') - close) * 1.5, 2),
+                                    is_downtrend=False, is_above_25_or_50_ema=False)))
+                        .Else(
+                            Set(is_downtrend=False, is_above_25_or_50_ema=False))))
+                .Else(*exit_rules(
+                        max_duration, ('is_uptrend', 'is_below_25_or_50_ema'),
+                        ('is_downtrend', 'is_above_25_or_50_ema')))
+            ],
+            state=dict(is_uptrend=False, is_downtrend=False, is_below_25_or_50_ema=False,
+                       is_above_25_or_50_ema=False, stop_loss=0, take_profit=0, buy_order=False,
+                       sell_order=False, duration_for_order=0),
+            indicators=[ema25, ema50, ema100],
+            cash=cash)
+
+def stochastic(period_k=14, period_d=3, smooth_d=3):
+    """%K and smoothed %D lines of the Stochastic indicator in stochastics-macd-backtest-strategy.py."""
+    high, low, close = Field('high'), Field('low'), Field('close')
+    highest_high, lowest_low = Highest(high, period_k), Lowest(low, period_k)
+    k = MinPeriod(100 * (close - lowest_low) / (highest_high - lowest_low), period_k + period_d + smooth_d - 2)
+    return k, FeedbackSMA(SMA(k, period_d), smooth_d)
+
+def stochastic_rules(ema_period=200, fast_period=12, slow_period=26, signal_period=9, trend_bars=15,
+                     oversold=20, overbrought=80, swing_bars=14, max_duration=30, cash=1000):
+    """StochasticStrategy: stochastic leaving oversold/overbrought with a MACD cross, in a trend over the 200 EMA."""
+    close = Field('close')
+    ema200 = EMA(close, ema_period)
+    k, d = stochastic()
+    macd = EMA(close, fast_period) - EMA(close, slow_period)
+    signal = EMA(macd, signal_period)
+    S = State
+
+    return RuleStrategy(
+            'stochastic',
+            rules=[
+                If((Position() == 0) & (S('buy_order') == False) & (S('sell_order') == False),
+                    # Check if in uptrend
+                    If((S('is_uptrend') == False) & (S('is_downtrend') == False) & (S('buy_order') == False),
+                        Set(is_uptrend=Always(close > ema200, trend_bars)))
+                    .Elif((S('is_uptrend') == True) & (S('buy_order') == False),
+                        If((k <= oversold) & (d <= oversold),
+                            Set(stochastic_at_oversold=True))
+                        .Elif((k > oversold) & (d > oversold) & (S('stochastic_at_oversold') == True),
+                            If(macd >= signal,
+                                Set(stop_loss=SwingStop(close, swing_bars, low=True)),
+                                Buy(Int(Cash() / close)),
+                                Set(buy_order=True, take_profit=Round(close + (close - S('stop_loss')) * 2, 2),
+                                    is_uptrend=False, stochastic_at_oversold=False)))),
+
+                    # Check if in downtrend
+                    If((S('is_uptrend') == False) & (S('is_downtrend') == False) & (S('sell_order') == False),
+                        Set(is_downtrend=Always(close < ema200, trend_bars)))
+                    .Elif((S('is_downtrend') == True) & (S('sell_order') == False),
+                        If((k >= overbrought) & (d >= overbrought),
+                            Set(stochastic_at_overbrought=True))
+                        .Elif((k < overbrought) & (d < overbrought) & (S('stochastic_at_overbrought') == True),
+                            If(macd <= signal,
+                                Set(stop_loss=SwingStop(close, swing_bars, low=False)),
+                                Sell(Int(Cash() / close)),
+                                Set(sell_order=True, take_profit=Round(close - (S('stop_loss') - close) * 2, 2),
+                                    is_downtrend=False, stochastic_at_overbrought=False)))))
+                .Else(*exit_rules(
+                        max_duration, ('is_uptrend', 'stochastic_at_oversold'),
+                        ('is_downtrend', 'stochastic_at_overbrought')))
+            ],
+            state=dict(is_uptrend=False, is_downtrend=False, stochastic_at_oversold=False,
+                       stochastic_at_overbrought=False, stop_loss=0, take_profit=0, buy_order=False,
+                       sell_order=False, duration_for_order=0),
+            indicators=[k, d, ema200, macd, signal],
+            cash=cash)
+
+STRATEGIES = dict(simple=simple_rules, scalping=scalping_rules, stochastic=stochastic_rules)
+
+def select_dates(arrays, fromdate, todate):
+    # Bars between the dates the backtest scripts run over
+    dates = arrays['datetime']
+    mask = (dates >= bt.date2num(fromdate)) & (dates <= bt.date2num(todate))
+    return {name: values[mask] for name, values in arrays.items()}
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Backtest the strategies written as rules')
+
+    parser.add_argument('--strategy', default=['scalping'], required=False, nargs='+',
+                        choices=sorted(STRATEGIES),
+                        help='Strategies to run')
+
+    parser.add_argument('--dataname', default=['cba'], required=False, nargs='+',
+                        choices=['cba', 'gmg', 'ioo', 'ndq', 'vas', 'wes'],
+                        help='File Data to Load')
+
+    parser.add_argument('--backend', default='vector', required=False,
+                        choices=sorted(BACKENDS),
+                        help='Work out the indicators with numpy up front or one bar at a time')
+
+    parser.add_argument('--verify', action='store_true', required=False,
+                        help='Compare the log with the daily order executions of the backtest script')
+
+    return parser.parse_args()
+
+def perform_rules(args):
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    for dataname in args.dataname:
+        datapath = os.path.join(modpath, './data/historical-prices/{}-2019-2024.csv'.format(dataname))
+        arrays = select_dates(load_price_arrays(datapath),
+                              datetime.datetime(2019, 1, 1), datetime.datetime(2024, 1, 1))
+
+        for name in args.strategy:
+            started = time.perf_counter()
+            lines = RuleRunner(STRATEGIES[name](), arrays, backend=args.backend, name=dataname).run()
+            seconds = time.perf_counter() - started
+            print("{} {}: {} Seconds: {:.3f}".format(name, dataname, lines[-2].strip(), seconds))
+
+            if args.verify:
+                path = os.path.join(modpath, 'order-execs', name, dataname, '{}-{}-1-daily.txt'.format(name, dataname))
+                with open(path, "r") as f:
+                    expected = f.readlines()
+                differs = [i for i, (a, b) in enumerate(zip(lines, expected)) if a != b]
+                if not differs and len(lines) == len(expected):
+                    print("  Matches {}".format(path))
+                else:
+                    i = differs[0] if differs else min(len(lines), len(expected))
+                    print("  Differs from {} at line {}:\n    rules:  {}    script: {}".format(
+                        path, i + 1, lines[i] if i < len(lines) else '<end>\n',
+                        expected[i] if i < len(expected) else '<end>\n'))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_rules(args)
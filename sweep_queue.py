@@ -0,0 +1,454 @@
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+import traceback
+
+from backtest_runner import STRATEGIES, TIMEFRAMES, datapath, run_backtest
+from price_data import SharedPriceArrays, attach_price_arrays, load_price_arrays
+from run_cache import RunCache, run_key
+from sweep_summary import METRICS, SweepSummary
+
+def job_key(spec):
+    """Identify a backtest by everything that goes into it."""
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def make_sweep(strategies, datanames, timeframes, compressions, grid):
+    """Expand a sweep into one job spec per strategy, share, timeframe and parameter set."""
+    names = sorted(grid)
+    specs = []
+    for strategy, dataname, timeframe, compression in itertools.product(strategies, datanames, timeframes, compressions):
+        for values in itertools.product(*[grid[name] for name in names]):
+            specs.append(dict(
+                    strategy=strategy,
+                    dataname=dataname,
+                    timeframe=timeframe,
+                    compression=compression,
+                    params=dict(zip(names, values))))
+    return specs
+
+class SQLiteJobQueue:
+    """Work queue of backtest shards kept in a SQLite file.
+
+    A coordinator splits a sweep into shards and workers (processes on this
+    or other machines sharing the file) claim a shard at a time under a
+    lease. Workers renew the lease between jobs. A shard whose lease runs out
+    (a slow or dead worker) can be claimed again by another worker and a
+    shard which raised is put back until it has failed `max_attempts` times.
+    Results are stored per sweep and job key so merging them is idempotent
+    no matter how many times a shard ends up being run.
+
+    The default `journal_mode` DELETE keeps the file safe to share over a
+    network filesystem. WAL is quicker but needs every process on one host,
+    as its shared memory index does not work over NFS or SMB.
+
+    A sweep submitted with `top_k` keeps no results per job. Each shard is
+    summarized by the worker (quantile sketches plus the top k runs of each
+    metric with their order logs) and merged into the sweep's one summary
+    row as the shard is completed, so the database stays the same size
+    however many jobs the sweep has. Such a shard is run again from the
+    start if its worker loses it.
+    """
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3, journal_mode='DELETE'):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode={}".format(journal_mode))
+        self._migrate_results()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_id TEXT PRIMARY KEY,
+                sweep TEXT NOT NULL,
+                specs TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                job_key TEXT NOT NULL,
+                sweep TEXT NOT NULL,
+                shard_id TEXT NOT NULL,
+                worker TEXT,
+                result TEXT NOT NULL,
+                PRIMARY KEY (sweep, job_key)
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                sweep TEXT PRIMARY KEY,
+                summary TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS shards_status ON shards (status);
+            CREATE INDEX IF NOT EXISTS results_sweep ON results (sweep);
+        """)
+
+    def _migrate_results(self):
+        # Results used to be keyed by job key alone, so the same job in two sweeps clashed
+        columns = self.conn.execute("PRAGMA table_info(results)").fetchall()
+        if [column[1] for column in columns if column[5]] != ['job_key']:
+            return
+        self.conn.executescript("""
+            BEGIN IMMEDIATE;
+            ALTER TABLE results RENAME TO results_old;
+            DROP INDEX IF EXISTS results_sweep;
+            CREATE TABLE results (
+                job_key TEXT NOT NULL,
+                sweep TEXT NOT NULL,
+                shard_id TEXT NOT NULL,
+                worker TEXT,
+                result TEXT NOT NULL,
+                PRIMARY KEY (sweep, job_key)
+            );
+            INSERT INTO results SELECT job_key, sweep, shard_id, worker, result FROM results_old;
+            DROP TABLE results_old;
+            COMMIT;
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    def submit(self, sweep, specs, shard_size=10, top_k=None):
+        """Split the job specs into shards. Submitting the same sweep again adds nothing.
+
+        With `top_k` the sweep is summarized instead of keeping every result.
+        """
+        shards = 0
+        self.conn.execute("BEGIN IMMEDIATE")
+        if top_k:
+            self.conn.execute(
+                    "INSERT OR IGNORE INTO summaries (sweep, summary) VALUES (?, ?)",
+                    (sweep, json.dumps(SweepSummary(top_k).to_dict())))
+        for i in range(0, len(specs), shard_size):
+            shard = specs[i:i + shard_size]
+            shard_id = job_key(dict(sweep=sweep, jobs=[job_key(spec) for spec in shard]))
+            cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO shards (shard_id, sweep, specs) VALUES (?, ?, ?)",
+                    (shard_id, sweep, json.dumps(shard)))
+            shards += cursor.rowcount
+        self.conn.execute("COMMIT")
+        return shards
+
+    def reset(self, sweep):
+        """Drop a sweep's shards and results so it can be run again."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute("DELETE FROM shards WHERE sweep = ?", (sweep,))
+        self.conn.execute("DELETE FROM results WHERE sweep = ?", (sweep,))
+        self.conn.execute("DELETE FROM summaries WHERE sweep = ?", (sweep,))
+        self.conn.execute("COMMIT")
+
+    def claim(self, worker):
+        """Lease the next pending (or expired) shard to a worker, None if there is nothing to do."""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        row = self.conn.execute(
+                """SELECT shard_id, sweep, specs FROM shards
+                   WHERE (status = 'pending' OR (status = 'running' AND lease_expires < ?))
+                   AND attempts < ? ORDER BY rowid LIMIT 1""",
+                (now, self.max_attempts)).fetchone()
+        if row is None:
+            # Shards which ran out of lease on their last attempt are given up on
+            self.conn.execute(
+                    """UPDATE shards SET status = 'failed', error = 'lease expired'
+                       WHERE status = 'running' AND lease_expires < ? AND attempts >= ?""",
+                    (now, self.max_attempts))
+            self.conn.execute("COMMIT")
+            return None
+
+        self.conn.execute(
+                """UPDATE shards SET status = 'running', worker = ?, lease_expires = ?,
+                   attempts = attempts + 1 WHERE shard_id = ?""",
+                (worker, now + self.lease_seconds, row[0]))
+        self.conn.execute("COMMIT")
+        return dict(shard_id=row[0], sweep=row[1], specs=json.loads(row[2]))
+
+    def heartbeat(self, shard_id, worker):
+        """Renew the lease, returns False if the shard was handed to another worker."""
+        cursor = self.conn.execute(
+                """UPDATE shards SET lease_expires = ?
+                   WHERE shard_id = ? AND worker = ? AND status = 'running'""",
+                (time.time() + self.lease_seconds, shard_id, worker))
+        return cursor.rowcount == 1
+
+    def done_keys(self, sweep, keys):
+        rows = self.conn.execute(
+                "SELECT job_key FROM results WHERE sweep = ? AND job_key IN ({})".format(','.join('?' * len(keys))),
+                [sweep] + list(keys)).fetchall()
+        return set(row[0] for row in rows)
+
+    def add_result(self, shard, worker, spec, result):
+        # The first result stored for a job wins so reruns merge idempotently
+        self.conn.execute(
+                "INSERT OR IGNORE INTO results (job_key, sweep, shard_id, worker, result) VALUES (?, ?, ?, ?, ?)",
+                (job_key(spec), shard['sweep'], shard['shard_id'], worker, json.dumps(result)))
+
+    def complete(self, shard_id, worker=None, summary=None):
+        """Mark a shard done, merging its `summary` into the sweep's.
+
+        A summary is only merged while the worker still holds the shard so no
+        shard is ever counted twice.
+        """
+        if summary is None:
+            self.conn.execute(
+                    "UPDATE shards SET status = 'done', lease_expires = NULL, error = NULL WHERE shard_id = ?",
+                    (shard_id,))
+            return
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        cursor = self.conn.execute(
+                """UPDATE shards SET status = 'done', lease_expires = NULL, error = NULL
+                   WHERE shard_id = ? AND worker = ? AND status = 'running'""",
+                (shard_id, worker))
+        if cursor.rowcount == 1:
+            sweep = self.conn.execute("SELECT sweep FROM shards WHERE shard_id = ?", (shard_id,)).fetchone()[0]
+            merged = self.summary(sweep).merge(summary)
+            self.conn.execute(
+                    "UPDATE summaries SET summary = ? WHERE sweep = ?", (json.dumps(merged.to_dict()), sweep))
+        self.conn.execute("COMMIT")
+
+    def fail(self, shard_id, worker, error):
+        """Put a shard back to be retried, or mark it failed once out of attempts."""
+        self.conn.execute(
+                """UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                   lease_expires = NULL, error = ? WHERE shard_id = ? AND worker = ?""",
+                (self.max_attempts, error, shard_id, worker))
+
+    def status(self, sweep):
+        rows = self.conn.execute(
+                "SELECT status, COUNT(*) FROM shards WHERE sweep = ? GROUP BY status", (sweep,)).fetchall()
+        return dict(rows)
+
+    def datanames(self):
+        """Shares used by the shards still to be run."""
+        rows = self.conn.execute("SELECT specs FROM shards WHERE status IN ('pending', 'running')").fetchall()
+        return sorted(set(spec['dataname'] for row in rows for spec in json.loads(row[0])))
+
+    def summary(self, sweep):
+        """Summary of a sweep submitted with top_k, None for sweeps keeping every result."""
+        row = self.conn.execute("SELECT summary FROM summaries WHERE sweep = ?", (sweep,)).fetchone()
+        return SweepSummary.from_dict(json.loads(row[0])) if row else None
+
+    def results(self, sweep):
+        rows = self.conn.execute("SELECT result FROM results WHERE sweep = ?", (sweep,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+def run_job(spec, arrays, cache=None, file_handle=None):
+    """Run one job spec, parsing each price file only once per worker.
+
+    Orders are logged to `file_handle` if given (nothing is logged for a
+    result served from the cache).
+    """
+    if cache is not None:
+        key = run_key(**spec)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    if spec['dataname'] not in arrays:
+        arrays[spec['dataname']] = load_price_arrays(datapath(spec['dataname']))
+    result = run_backtest(arrays=arrays[spec['dataname']], file_handle=file_handle, **spec)
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+def run_worker(path, worker=None, poll=1.0, exit_when_idle=True, lease_seconds=300, max_attempts=3,
+               cache=None, shared=None, journal_mode='DELETE'):
+    """Claim and run shards until the queue is empty.
+
+    With a `cache` folder unchanged backtests are served from the run cache.
+    `shared` handles of SharedPriceArrays are mapped instead of parsing those
+    price files again in this process.
+    """
+    worker = worker or '{}-{}'.format(socket.gethostname(), os.getpid())
+    queue = SQLiteJobQueue(path, lease_seconds=lease_seconds, max_attempts=max_attempts, journal_mode=journal_mode)
+    cache = RunCache(cache) if cache else None
+    arrays = attach_price_arrays(shared) if shared else {}
+    while True:
+        shard = queue.claim(worker)
+        if shard is None:
+            if exit_when_idle:
+                break
+            time.sleep(poll)
+            continue
+
+        try:
+            summary = queue.summary(shard['sweep'])
+            if summary is not None:
+                run_summary_shard(queue, shard, worker, summary, arrays, cache)
+                continue
+
+            # Skip jobs a previous attempt of this shard already finished
+            done = queue.done_keys(shard['sweep'], [job_key(spec) for spec in shard['specs']])
+            for spec in shard['specs']:
+                if job_key(spec) in done:
+                    continue
+                queue.add_result(shard, worker, spec, run_job(spec, arrays, cache))
+                if not queue.heartbeat(shard['shard_id'], worker):
+                    # Lease was lost to another worker which will finish the shard
+                    break
+            else:
+                queue.complete(shard['shard_id'])
+        except Exception:
+            queue.fail(shard['shard_id'], worker, traceback.format_exc())
+    queue.close()
+
+def run_summary_shard(queue, shard, worker, summary, arrays, cache=None):
+    """Run a shard of a summarized sweep, keeping the order logs of only the runs in a top k."""
+    shard_summary = SweepSummary(summary.k, summary.sketch_k)
+    for spec in shard['specs']:
+        key = job_key(spec)
+        log = io.StringIO()
+        result = run_job(spec, arrays, cache, file_handle=log)
+        # Runs which would not beat the sweep's top k so far are only sketched
+        detail = None
+        if summary.wants(key, result):
+            if cache is not None and not log.getvalue():
+                # A result served from the cache logged nothing, so run it again for its orders
+                run_job(spec, arrays, file_handle=log)
+            detail = log.getvalue() or None
+        if shard_summary.add(key, result, detail):
+            summary.add(key, result)
+        if not queue.heartbeat(shard['shard_id'], worker):
+            return
+    queue.complete(shard['shard_id'], worker, shard_summary)
+
+def print_result(result):
+    print("{}, {}, {} {}, {}, Profit: {:.2f}, Trades: {}, Win Rate: {:.2f}, Max Drawdown: {:.2f}%".format(
+        result['strategy'], result['dataname'], result['compression'], result['timeframe'],
+        json.dumps(result['params'], sort_keys=True), result['profit'], result['trades'],
+        result['win_rate'], result['max_drawdown']))
+
+def parse_grid(values):
+    """Turn name=v1,v2 arguments into a parameter grid."""
+    grid = {}
+    for value in values or []:
+        name, options = value.split('=', 1)
+        grid[name] = [int(option) if option.lstrip('-').isdigit() else float(option)
+                      for option in options.split(',')]
+    return grid
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run backtest sweeps through a shared work queue')
+
+    parser.add_argument('command', choices=['submit', 'worker', 'status', 'results'],
+                        help='Submit a sweep, run workers or look at a sweep')
+
+    parser.add_argument('--db', default='sweep.db', required=False,
+                        help='SQLite file holding the queue (on storage shared by every worker)')
+
+    parser.add_argument('--journal-mode', default='DELETE', required=False, type=str.upper,
+                        choices=['DELETE', 'WAL'],
+                        help='SQLite journal mode, WAL is quicker but only safe when every worker runs on this host')
+
+    parser.add_argument('--sweep', default='sweep', required=False,
+                        help='Name of the sweep')
+
+    parser.add_argument('--strategy', default=['scalping'], required=False, nargs='+',
+                        choices=list(STRATEGIES),
+                        help='Strategies to sweep')
+
+    parser.add_argument('--dataname', default=['cba'], required=False, nargs='+',
+                        help='Shares to sweep')
+
+    parser.add_argument('--timeframe', default=['daily'], required=False, nargs='+',
+                        choices=list(TIMEFRAMES),
+                        help='Timeframes to sweep')
+
+    parser.add_argument('--compression', default=[1], required=False, type=int, nargs='+',
+                        help='Compressions to sweep')
+
+    parser.add_argument('--param', default=None, required=False, nargs='+',
+                        help='Strategy parameter values to sweep, e.g. ema_period_1=20,25,30')
+
+    parser.add_argument('--shard-size', default=10, required=False, type=int,
+                        help='Number of backtests in each shard')
+
+    parser.add_argument('--processes', default=1, required=False, type=int,
+                        help='Number of worker processes to start on this machine')
+
+    parser.add_argument('--lease', default=300, required=False, type=float,
+                        help='Seconds a worker holds a shard before it can be reassigned')
+
+    parser.add_argument('--max-attempts', default=3, required=False, type=int,
+                        help='Times a shard is tried before it is marked as failed')
+
+    parser.add_argument('--rerun', action='store_true', required=False,
+                        help='Drop the results of a sweep already submitted and run it again')
+
+    parser.add_argument('--cache', default=None, required=False,
+                        help='Run cache folder so workers only run backtests whose inputs changed')
+
+    parser.add_argument('--top-k', default=None, required=False, type=int,
+                        help='Keep only the best k runs per metric and quantiles of the rest instead of every result')
+
+    parser.add_argument('--logs', default=None, required=False,
+                        help='Folder to write the order logs of the top runs of a summarized sweep to')
+
+    return parser.parse_args()
+
+def perform_command(args):
+    if args.command == 'submit':
+        specs = make_sweep(args.strategy, args.dataname, args.timeframe, args.compression, parse_grid(args.param))
+        queue = SQLiteJobQueue(args.db, journal_mode=args.journal_mode)
+        if args.rerun:
+            queue.reset(args.sweep)
+        shards = queue.submit(args.sweep, specs, args.shard_size, args.top_k)
+        print("Submitted {} jobs in {} new shards".format(len(specs), shards))
+    elif args.command == 'worker':
+        # Parse each price file once and share it with every worker process
+        queue = SQLiteJobQueue(args.db, journal_mode=args.journal_mode)
+        shared = SharedPriceArrays({dataname: load_price_arrays(datapath(dataname)) for dataname in queue.datanames()})
+        queue.close()
+        with shared:
+            workers = [multiprocessing.Process(target=run_worker, args=(args.db,),
+                                               kwargs=dict(lease_seconds=args.lease, max_attempts=args.max_attempts,
+                                                           cache=args.cache, shared=shared.handles,
+                                                           journal_mode=args.journal_mode))
+                       for i in range(args.processes)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    elif args.command == 'status':
+        queue = SQLiteJobQueue(args.db, journal_mode=args.journal_mode)
+        print("Shards: {}".format(queue.status(args.sweep)))
+        summary = queue.summary(args.sweep)
+        print("Results: {}".format(summary.runs if summary else len(queue.results(args.sweep))))
+    else:
+        queue = SQLiteJobQueue(args.db, journal_mode=args.journal_mode)
+        summary = queue.summary(args.sweep)
+        if summary is None:
+            results = sorted(queue.results(args.sweep), key=lambda result: result['profit'], reverse=True)
+            for result in results:
+                print_result(result)
+            return
+
+        print("Runs: {}".format(summary.runs))
+        for metric, largest in METRICS:
+            print("{}: {}".format(metric, ", ".join(
+                "p{:g} {:.2f}".format(q * 100, value) for q, value in summary.quantiles(metric) if value is not None)))
+        for metric, largest in METRICS:
+            print("Top {} by {}:".format(summary.k, metric))
+            for run in summary.best(metric):
+                print_result(run['result'])
+                if args.logs and run['detail']:
+                    result = run['result']
+                    os.makedirs(args.logs, exist_ok=True)
+                    path = os.path.join(args.logs, '{}-{}-{}-{}-{}.txt'.format(
+                        result['strategy'], result['dataname'], result['compression'], result['timeframe'],
+                        run['key'][:8]))
+                    with open(path, "w") as f:
+                        f.write(run['detail'])
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_command(args)
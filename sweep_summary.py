@@ -0,0 +1,255 @@
+import argparse
+import heapq
+import math
+import random
+import time
+
+# Metrics the sweep summary ranks runs and sketches the distribution of,
+# True where a larger value is better
+METRICS = (
+        ('profit', True),
+        ('max_drawdown', False),
+        ('win_rate', True))
+
+class QuantileSketch:
+    """Streaming quantiles of a stream of values in bounded memory.
+
+    A KLL sketch: values go into the bottom of a stack of buffers, each level
+    standing for values of twice the weight of the one below. A full buffer
+    is sorted and every other value (starting from the first or the second
+    at random) moves up a level, so the sketch keeps about 3 * `k` values
+    however many are added and a quantile is out by around 1.7 / `k` in rank.
+    Sketches of the same `k` can be merged, e.g. the sketches of the shards
+    of a sweep.
+    """
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.random = random.Random(seed)
+        self.levels = [[]]
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def _capacity(self, level):
+        # Buffers shrink by 2/3 for every level under the top one
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.k * (2 / 3) ** depth)), 2)
+
+    def add(self, value):
+        if value is None or math.isnan(value):
+            return
+        self.levels[0].append(value)
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.levels[0]) >= self._capacity(0):
+            self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) >= self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                values = sorted(self.levels[level])
+                # An odd value out stays behind so no weight is lost
+                self.levels[level] = values[-1:] if len(values) % 2 else []
+                values = values[:len(values) - len(values) % 2]
+                self.levels[level + 1].extend(values[self.random.getrandbits(1)::2])
+                # A new top level shrinks the capacities, so start again from the bottom
+                level = 0
+                continue
+            level += 1
+
+    def merge(self, other):
+        """Add the values of another sketch to this one."""
+        if other.k != self.k:
+            raise ValueError("Cannot merge sketches of k {} and {}".format(self.k, other.k))
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, values in enumerate(other.levels):
+            self.levels[level].extend(values)
+        self.count += other.count
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """Value at quantile q (0 to 1), None for an empty sketch."""
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        weighted = sorted((value, 1 << level) for level, values in enumerate(self.levels) for value in values)
+        total = sum(weight for value, weight in weighted)
+        rank = q * total
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen >= rank:
+                return value
+        return self.max
+
+    def size(self):
+        return sum(len(values) for values in self.levels)
+
+    def to_dict(self):
+        return dict(k=self.k, levels=self.levels, count=self.count, min=self.min, max=self.max)
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['k'])
+        sketch.levels = [list(values) for values in state['levels']]
+        sketch.count = state['count']
+        sketch.min = state['min']
+        sketch.max = state['max']
+        return sketch
+
+class TopK:
+    """The `k` best runs by one metric, kept in a min-heap of the worst of them on top.
+
+    Runs are told apart by their key, so adding or merging in a run already
+    held changes nothing and ties are broken the same way whatever order the
+    runs come in.
+    """
+
+    def __init__(self, k=10, largest=True):
+        self.k = k
+        self.largest = largest
+        self.heap = []
+        self.keys = set()
+
+    def _score(self, value):
+        return value if self.largest else -value
+
+    def accepts(self, key, value):
+        """Would a run with this value make it into the top k."""
+        if value is None or math.isnan(value) or key in self.keys:
+            return False
+        if len(self.heap) < self.k:
+            return True
+        return (self._score(value), key) > self.heap[0][:2]
+
+    def add(self, key, value, run):
+        """Add a run, returns the key of the run pushed out (or None) and whether it was kept."""
+        if not self.accepts(key, value):
+            return None, False
+        entry = (self._score(value), key, run)
+        self.keys.add(key)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+            return None, True
+        dropped = heapq.heapreplace(self.heap, entry)[1]
+        self.keys.discard(dropped)
+        return dropped, True
+
+    def runs(self):
+        """Runs best first."""
+        return [run for score, key, run in sorted(self.heap, key=lambda entry: entry[:2], reverse=True)]
+
+class SweepSummary:
+    """Aggregate of a sweep kept in constant space however many runs it has.
+
+    Every run goes into a quantile sketch of each metric and a top-k heap
+    per metric. Only the runs held in a top-k keep their full result and
+    detail (the order log), the rest are dropped once sketched.
+    """
+
+    def __init__(self, k=10, sketch_k=200):
+        self.k = k
+        self.sketch_k = sketch_k
+        self.runs = 0
+        self.top = {metric: TopK(k, largest) for metric, largest in METRICS}
+        self.sketches = {metric: QuantileSketch(sketch_k, seed=0) for metric, largest in METRICS}
+
+    def wants(self, key, result):
+        """Would the run be kept in any top k, so its detail is worth holding on to."""
+        return any(top.accepts(key, result.get(metric)) for metric, top in self.top.items())
+
+    def add(self, key, result, detail=None):
+        """Sketch a run and keep it if it is in a top k. Returns whether it was kept."""
+        self.runs += 1
+        for metric, sketch in self.sketches.items():
+            sketch.add(result.get(metric))
+        run = dict(key=key, result=result, detail=detail)
+        kept = False
+        for metric, top in self.top.items():
+            kept |= top.add(key, result.get(metric), run)[1]
+        return kept
+
+    def merge(self, other):
+        """Add another summary (e.g. of one shard) to this one."""
+        self.runs += other.runs
+        for metric, sketch in self.sketches.items():
+            sketch.merge(other.sketches[metric])
+        for metric, top in self.top.items():
+            for run in other.top[metric].runs():
+                top.add(run['key'], run['result'].get(metric), run)
+        return self
+
+    def quantiles(self, metric, qs=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        return [(q, self.sketches[metric].quantile(q)) for q in qs]
+
+    def best(self, metric):
+        return self.top[metric].runs()
+
+    def to_dict(self):
+        return dict(k=self.k, sketch_k=self.sketch_k, runs=self.runs,
+                    top={metric: top.runs() for metric, top in self.top.items()},
+                    sketches={metric: sketch.to_dict() for metric, sketch in self.sketches.items()})
+
+    @classmethod
+    def from_dict(cls, state):
+        summary = cls(state['k'], state['sketch_k'])
+        summary.runs = state['runs']
+        for metric, top in summary.top.items():
+            for run in state['top'][metric]:
+                top.add(run['key'], run['result'].get(metric), run)
+        summary.sketches = {metric: QuantileSketch.from_dict(sketch) for metric, sketch in state['sketches'].items()}
+        return summary
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Time the sweep summary and check its quantiles on random runs')
+
+    parser.add_argument('--runs', default=1000000, required=False, type=int,
+                        help='Random runs to add')
+
+    parser.add_argument('--top-k', default=10, required=False, type=int,
+                        help='Best runs kept per metric')
+
+    parser.add_argument('--sketch-k', default=200, required=False, type=int,
+                        help='Size of the quantile sketches')
+
+    return parser.parse_args()
+
+def perform_bench(args):
+    rng = random.Random(0)
+    summary = SweepSummary(args.top_k, args.sketch_k)
+    profits = []
+    started = time.perf_counter()
+    for i in range(args.runs):
+        result = dict(profit=rng.gauss(100, 400), max_drawdown=abs(rng.gauss(10, 5)), win_rate=rng.random())
+        summary.add(str(i), result, detail='log' if summary.wants(str(i), result) else None)
+        profits.append(result['profit'])
+    seconds = time.perf_counter() - started
+
+    profits.sort()
+    print("Runs: {}, Seconds: {:.2f}, Runs/s: {:.0f}, Sketch Values: {}, Runs Kept: {}".format(
+        args.runs, seconds, args.runs / seconds, sum(sketch.size() for sketch in summary.sketches.values()),
+        len(set(run['key'] for metric, largest in METRICS for run in summary.best(metric)))))
+    for q, value in summary.quantiles('profit'):
+        exact = profits[min(int(q * len(profits)), len(profits) - 1)]
+        print("Profit p{:g}: {:.2f} (exact {:.2f})".format(q * 100, value, exact))
+    print("Best Profit: {:.2f} (exact {:.2f})".format(summary.best('profit')[0]['result']['profit'], profits[-1]))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_bench(args)
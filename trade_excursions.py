@@ -0,0 +1,268 @@
+import argparse
+import os.path
+import sys
+import time
+
+import backtrader as bt
+import numpy as np
+
+from price_data import load_price_arrays
+
+# Fields of every trade the excursions are worked out from, one array each
+TRADE_FIELDS = ('entry_bar', 'exit_bar', 'entry_price', 'exit_price', 'size', 'stop')
+
+def excursions(high, low, entry_bar, exit_bar, entry_price, exit_price, size, stop=None, chunk_bars=1 << 22):
+    """Maximum adverse and favourable excursion of every closed trade.
+
+    A trade is filled at the open of `entry_bar` and closed at `exit_price`,
+    the open of `exit_bar`, so it is exposed to the whole range of bars
+    entry_bar to exit_bar - 1 plus the exit price. `size` is negative for
+    shorts. The High/Low slices of all trades are gathered into one flat
+    array (in chunks of about `chunk_bars` bars) and reduced per trade with
+    reduceat, so millions of trades take no Python loop per trade.
+
+    Excursions are per share and never negative. Bars to the MFE/MAE count
+    from the entry bar to the first bar reaching it. R multiples are in
+    units of the risk to `stop` (NaN when a trade has no stop).
+    """
+    high = np.asarray(high, dtype=np.float64)
+    low = np.asarray(low, dtype=np.float64)
+    entry_bar = np.asarray(entry_bar, dtype=np.int64)
+    exit_bar = np.asarray(exit_bar, dtype=np.int64)
+    entry_price = np.asarray(entry_price, dtype=np.float64)
+    exit_price = np.asarray(exit_price, dtype=np.float64)
+    size = np.asarray(size, dtype=np.float64)
+    stop = np.full(len(size), np.nan) if stop is None else np.asarray(stop, dtype=np.float64)
+
+    count = len(entry_bar)
+    highest = np.full(count, -np.inf)
+    lowest = np.full(count, np.inf)
+    bars_to_high = np.zeros(count, dtype=np.int64)
+    bars_to_low = np.zeros(count, dtype=np.int64)
+    held = exit_bar - entry_bar
+
+    # Split the trades so no chunk gathers many more than chunk_bars bars
+    lengths = np.maximum(held, 0)
+    ends = np.cumsum(lengths)
+    bounds = np.searchsorted(ends, np.arange(chunk_bars, ends[-1] if count else 0, chunk_bars), side='left')
+    for first, last in zip(np.r_[0, bounds], np.r_[bounds, count]):
+        _reduce_chunk(high, low, entry_bar[first:last], lengths[first:last],
+                      highest[first:last], lowest[first:last], bars_to_high[first:last], bars_to_low[first:last])
+
+    # The exit price is the last price the trade was exposed to
+    exit_higher = exit_price > highest
+    highest[exit_higher] = exit_price[exit_higher]
+    bars_to_high[exit_higher] = held[exit_higher]
+    exit_lower = exit_price < lowest
+    lowest[exit_lower] = exit_price[exit_lower]
+    bars_to_low[exit_lower] = held[exit_lower]
+
+    long = size > 0
+    mfe = np.maximum(np.where(long, highest - entry_price, entry_price - lowest), 0.0)
+    mae = np.maximum(np.where(long, entry_price - lowest, highest - entry_price), 0.0)
+    move = np.where(long, exit_price - entry_price, entry_price - exit_price)
+    shares = np.abs(size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        risk = np.abs(entry_price - stop)
+        risk[risk == 0] = np.nan
+
+        return dict(
+                bars_held=held,
+                pnl=move * shares,
+                mae=mae,
+                mfe=mfe,
+                mae_value=mae * shares,
+                mfe_value=mfe * shares,
+                bars_to_mae=np.where(long, bars_to_low, bars_to_high),
+                bars_to_mfe=np.where(long, bars_to_high, bars_to_low),
+                r_multiple=move / risk,
+                mae_r=mae / risk,
+                mfe_r=mfe / risk)
+
+def _reduce_chunk(high, low, starts, lengths, highest, lowest, bars_to_high, bars_to_low):
+    # Highest high and lowest low of each trade's bars and the first bar they were reached on
+    held = lengths > 0
+    starts, lengths = starts[held], lengths[held]
+    if not len(starts):
+        return
+    offsets = np.cumsum(lengths) - lengths
+    # Bar number within its trade for every gathered bar
+    local = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+    bars = np.repeat(starts, lengths) + local
+
+    for prices, extreme, out, out_bars in ((high, np.maximum, highest, bars_to_high),
+                                           (low, np.minimum, lowest, bars_to_low)):
+        gathered = prices[bars]
+        values = extreme.reduceat(gathered, offsets)
+        reached = np.where(gathered == np.repeat(values, lengths), local, np.iinfo(np.int64).max)
+        out[held] = values
+        out_bars[held] = np.minimum.reduceat(reached, offsets)
+
+def summarize(result):
+    """Count, win rate and the median / 90th percentile of the excursions of a set of trades."""
+    summary = dict(trades=int(len(result['pnl'])))
+    if not len(result['pnl']):
+        return summary
+    summary['win_rate'] = float(np.mean(result['pnl'] > 0))
+    for name in ('mae', 'mfe', 'bars_to_mfe', 'r_multiple', 'mae_r', 'mfe_r'):
+        values = np.asarray(result[name], dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values):
+            summary[name + '_median'] = float(np.median(values))
+            summary[name + '_p90'] = float(np.percentile(values, 90))
+    # Losing trades which were at least 1R in profit first
+    losers = result['pnl'] < 0
+    if np.any(losers & ~np.isnan(result['mfe_r'])):
+        summary['losers_up_1r'] = float(np.mean(result['mfe_r'][losers] >= 1.0))
+    return summary
+
+class TradeExcursionAnalyzer(bt.Analyzer):
+    """Collect every closed trade of a strategy and work out its excursions at the end of the run.
+
+    The stop of a trade is the `stop_loss` the strategy attached to the
+    order which opened it (`order.addinfo(stop_loss=...)`), NaN when that
+    order carried none. Entry price is the average price of the trade and
+    size the largest size it reached.
+    """
+
+    def start(self):
+        self.trades = {name: [] for name in TRADE_FIELDS}
+        self.current = None
+        self.last_price = None
+        self.last_stop = None
+
+    def notify_order(self, order):
+        if order.status in [order.Partial, order.Completed]:
+            self.last_price = order.executed.price
+            # Trades are notified after the order which filled them
+            self.last_stop = order.info.get('stop_loss')
+
+    def notify_trade(self, trade):
+        if trade.justopened:
+            self.current = dict(size=trade.size, stop=np.nan if self.last_stop is None else self.last_stop)
+        if self.current is None:
+            return
+        if abs(trade.size) > abs(self.current['size']):
+            self.current['size'] = trade.size
+        self.current['entry_price'] = trade.price
+        if trade.isclosed:
+            self.trades['entry_bar'].append(trade.baropen - 1)
+            self.trades['exit_bar'].append(trade.barclose - 1)
+            self.trades['entry_price'].append(self.current['entry_price'])
+            self.trades['exit_price'].append(self.last_price)
+            self.trades['size'].append(self.current['size'])
+            self.trades['stop'].append(self.current['stop'])
+            self.current = None
+
+    def stop(self):
+        bars = len(self.data)
+        self.result = excursions(np.asarray(self.data.high.get(size=bars)), np.asarray(self.data.low.get(size=bars)),
+                                 **self.trades)
+        self.dates = [bt.num2date(dt).date() for dt in self.data.datetime.get(size=bars)]
+
+    def get_analysis(self):
+        return dict(trades=self.trades, excursions=self.result, summary=summarize(self.result))
+
+def trades_from_log(path, dates):
+    """Closed trades from an order-execs log, with `dates` the bar dates of the run.
+
+    Fills are matched into trades the way backtrader does: a trade opens from
+    a flat position and closes when it is flat again. Logs hold no stops so
+    the R multiples of these trades are NaN.
+    """
+    index = {date.isoformat(): i for i, date in enumerate(dates)}
+    trades = {name: [] for name in TRADE_FIELDS}
+    position = price = 0
+    largest = entry = None
+    with open(path, "r") as f:
+        for line in f:
+            tokens = line.strip().split(', ')
+            if len(tokens) < 4 or not tokens[1].endswith('EXECUTED'):
+                continue
+            bar = index[tokens[0]]
+            size = int(tokens[2][len('Size: '):])
+            fill = float(tokens[3][len('Price: '):])
+
+            new = position + size
+            if not position:
+                entry, price, largest = bar, fill, new
+            elif (position > 0) == (size > 0):
+                price = (price * position + size * fill) / new
+            if abs(new) > abs(largest):
+                largest = new
+            if position and (not new or (new > 0) != (position > 0)):
+                trades['entry_bar'].append(entry)
+                trades['exit_bar'].append(bar)
+                trades['entry_price'].append(price)
+                trades['exit_price'].append(fill)
+                trades['size'].append(largest)
+                trades['stop'].append(np.nan)
+                # A reversal opens the next trade with the rest of the fill
+                entry, price, largest = bar, fill, new
+            position = new
+    return trades
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Maximum adverse/favourable excursion of backtest trades')
+
+    parser.add_argument('command', choices=['report', 'bench'],
+                        help='Report the trades of a backtest or time the excursions of random trades')
+
+    parser.add_argument('--strategy', default='scalping', required=False,
+                        choices=['simple', 'scalping', 'stochastic'],
+                        help='Strategy to backtest')
+
+    parser.add_argument('--dataname', default='cba', required=False,
+                        choices=['cba', 'gmg', 'ioo', 'ndq', 'vas', 'wes'],
+                        help='File Data to Load')
+
+    parser.add_argument('--log', default=None, required=False,
+                        help='Read the trades from an order-execs log instead of running the backtest')
+
+    parser.add_argument('--trades', default=1000000, required=False, type=int,
+                        help='Random trades to time when benchmarking')
+
+    return parser.parse_args()
+
+def perform_command(args):
+    if args.command == 'bench':
+        rng = np.random.default_rng(0)
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, 5000)))
+        high, low = close * 1.005, close * 0.995
+        entry_bar = rng.integers(0, len(close) - 60, args.trades)
+        exit_bar = entry_bar + rng.integers(1, 60, args.trades)
+        size = rng.choice([-10, 10], args.trades)
+        started = time.perf_counter()
+        result = excursions(high, low, entry_bar, exit_bar, close[entry_bar], close[exit_bar], size,
+                            close[entry_bar] * (1 - 0.02 * np.sign(size)))
+        seconds = time.perf_counter() - started
+        print("Trades: {}, Bars: {}, Seconds: {:.3f}, Trades/s: {:.0f}".format(
+            args.trades, int(result['bars_held'].sum()), seconds, args.trades / seconds))
+        return
+
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    if args.log:
+        arrays = load_price_arrays(os.path.join(modpath, './data/historical-prices/{}-2019-2024.csv'.format(args.dataname)))
+        dates = [bt.num2date(dt).date() for dt in arrays['datetime']]
+        trades = trades_from_log(args.log, dates)
+        result = excursions(arrays['high'], arrays['low'], **trades)
+    else:
+        from backtest_runner import run_backtest
+        analyzer = run_backtest(args.strategy, args.dataname, keep_analyzers=True)['analyzers'].excursions
+        trades, result, dates = analyzer.trades, analyzer.result, analyzer.dates
+
+    print("Entry, Exit, Size, Entry Price, Exit Price, PnL, MAE, MFE, Bars to MFE, R, MAE R, MFE R")
+    for i in range(len(trades['entry_bar'])):
+        print("{}, {}, {}, {:.2f}, {:.2f}, {:.2f}, {:.2f}, {:.2f}, {}, {:.2f}, {:.2f}, {:.2f}".format(
+            dates[trades['entry_bar'][i]], dates[trades['exit_bar'][i]], trades['size'][i],
+            trades['entry_price'][i], trades['exit_price'][i], result['pnl'][i], result['mae'][i],
+            result['mfe'][i], result['bars_to_mfe'][i], result['r_multiple'][i], result['mae_r'][i],
+            result['mfe_r'][i]))
+    for name, value in summarize(result).items():
+        print("{}: {}".format(name, round(value, 4)))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_command(args)
@@ -0,0 +1,309 @@
+import argparse
+import glob
+import os.path
+import sys
+
+import backtrader as bt
+import numpy as np
+
+from price_data import load_price_arrays
+
+class VectorEMA:
+    """Exponential moving average kept for every symbol at once.
+
+    Seeded like backtrader's EMA with the average of the first period values
+    of each symbol, then updated with one vectorized step per bar.
+    """
+
+    def __init__(self, size, period):
+        self.period = period
+        self.alpha = 2.0 / (1.0 + period)
+        self.alpha1 = 1.0 - self.alpha
+        self.value = np.full(size, np.nan)
+        self.prev = np.full(size, np.nan)
+        self.total = np.zeros(size)
+        self.count = np.zeros(size, dtype=np.int64)
+
+    def update(self, x, mask):
+        """Add a new value for every symbol in mask."""
+        self.prev[mask] = self.value[mask]
+        self.count[mask] += 1
+
+        # Still building up the seed value
+        seeding = mask & (self.count <= self.period)
+        self.total[seeding] += x[seeding]
+        seeded = seeding & (self.count == self.period)
+        self.value[seeded] = self.total[seeded] / self.period
+
+        running = mask & (self.count > self.period)
+        self.value[running] = self.value[running] * self.alpha1 + x[running] * self.alpha
+
+class VectorWindow:
+    """Fixed size window of the latest values of every symbol."""
+
+    def __init__(self, size, period):
+        self.period = period
+        self.values = np.full((size, period), np.nan)
+        self.pos = np.zeros(size, dtype=np.int64)
+        self.count = np.zeros(size, dtype=np.int64)
+
+    def update(self, x, mask):
+        rows = np.nonzero(mask)[0]
+        self.values[rows, self.pos[rows]] = x[rows]
+        self.pos[rows] = (self.pos[rows] + 1) % self.period
+        self.count[rows] += 1
+
+    @property
+    def full(self):
+        return self.count >= self.period
+
+class UniverseScanner:
+    """Scan a whole universe of symbols for scalping and stochastic setups.
+
+    The latest `window` bars of every symbol are held in 2-D (symbol x time)
+    ring buffers written in place, and every new bar updates the EMA stacks, 15 bar trend conditions,
+    stochastic oversold/overbought state and MACD crosses for all symbols in
+    one vectorized step. The setup states follow ScalpingStrategy and
+    StochasticStrategy while the strategy is out of the market.
+    """
+
+    def __init__(self, symbols, window=250, trend_bars=15,
+                 ema_periods=(25, 50, 100), ema_trend_period=200,
+                 period_k=14, period_d=3, smooth_d=3, oversold=20, overbrought=80,
+                 fast_period=12, slow_period=26, signal_period=9):
+        self.symbols = list(symbols)
+        size = len(self.symbols)
+        self.window = window
+        self.trend_bars = trend_bars
+        self.oversold = oversold
+        self.overbrought = overbrought
+
+        # Latest bars of every symbol, with column pos the next to be written
+        self.open = np.full((size, window), np.nan)
+        self.high = np.full((size, window), np.nan)
+        self.low = np.full((size, window), np.nan)
+        self.close = np.full((size, window), np.nan)
+        self.pos = 0
+
+        # Scalping indicators and state
+        self.ema25, self.ema50, self.ema100 = [VectorEMA(size, period) for period in ema_periods]
+        self.up_run = np.zeros(size, dtype=np.int64)
+        self.down_run = np.zeros(size, dtype=np.int64)
+        self.is_uptrend = np.zeros(size, dtype=bool)
+        self.is_downtrend = np.zeros(size, dtype=bool)
+        self.is_below_25_or_50_ema = np.zeros(size, dtype=bool)
+        self.is_above_25_or_50_ema = np.zeros(size, dtype=bool)
+        self.scalping_buy = np.zeros(size, dtype=bool)
+        self.scalping_sell = np.zeros(size, dtype=bool)
+
+        # Stochastic indicators and state
+        self.ema200 = VectorEMA(size, ema_trend_period)
+        self.highs = VectorWindow(size, period_k)
+        self.lows = VectorWindow(size, period_k)
+        self.k = np.full(size, np.nan)
+        self.k_window = VectorWindow(size, period_d)
+        self.d = np.full(size, np.nan)
+        self.d_window = VectorWindow(size, smooth_d)
+        self.d_smooth = np.full(size, np.nan)
+        self.stoch_d = np.full(size, np.nan)
+        self.fast = VectorEMA(size, fast_period)
+        self.slow = VectorEMA(size, slow_period)
+        self.signal = VectorEMA(size, signal_period)
+        self.macd = np.full(size, np.nan)
+        self.prev_macd = np.full(size, np.nan)
+        self.macd_cross_up = np.zeros(size, dtype=bool)
+        self.macd_cross_down = np.zeros(size, dtype=bool)
+        self.above_run = np.zeros(size, dtype=np.int64)
+        self.below_run = np.zeros(size, dtype=np.int64)
+        self.stoch_uptrend = np.zeros(size, dtype=bool)
+        self.stoch_downtrend = np.zeros(size, dtype=bool)
+        self.stochastic_at_oversold = np.zeros(size, dtype=bool)
+        self.stochastic_at_overbrought = np.zeros(size, dtype=bool)
+        self.stochastic_buy = np.zeros(size, dtype=bool)
+        self.stochastic_sell = np.zeros(size, dtype=bool)
+
+    def update(self, open, high, low, close):
+        """Add the next bar of every symbol. Symbols without a bar pass NaN."""
+        close = np.asarray(close, dtype=np.float64)
+        mask = ~np.isnan(close)
+
+        for bars, values in ((self.open, open), (self.high, high), (self.low, low), (self.close, close)):
+            bars[:, self.pos] = values
+        self.pos = (self.pos + 1) % self.window
+
+        self._update_scalping(close, mask)
+        self._update_stochastic(np.asarray(high, dtype=np.float64), np.asarray(low, dtype=np.float64), close, mask)
+
+    def history(self, bars):
+        """One of the bar buffers (e.g. self.close) in time order, oldest first."""
+        return np.roll(bars, -self.pos, axis=1)
+
+    def _update_scalping(self, close, mask):
+        for ema in (self.ema25, self.ema50, self.ema100):
+            ema.update(close, mask)
+        e25, e50, e100 = self.ema25.value, self.ema50.value, self.ema100.value
+
+        # Count the bars in a row every EMA is rising and the candles sit above the stack
+        with np.errstate(invalid='ignore'):
+            stack_up = (close > e25) & (e25 > e50) & (e50 > e100)
+            stack_down = (close < e25) & (e25 < e50) & (e50 < e100)
+            rising = (e25 >= self.ema25.prev) & (e50 >= self.ema50.prev) & (e100 >= self.ema100.prev)
+            falling = (e25 <= self.ema25.prev) & (e50 <= self.ema50.prev) & (e100 <= self.ema100.prev)
+            pullback_up = (close <= e25) & (close > e100)
+            pullback_down = (close >= e25) & (close < e100)
+        self.up_run[mask] = np.where((rising & stack_up)[mask], self.up_run[mask] + 1, 0)
+        self.down_run[mask] = np.where((falling & stack_down)[mask], self.down_run[mask] + 1, 0)
+
+        # Uptrend setup: a pullback below the 25 EMA then a close back above the stack
+        idle = mask & ~self.is_uptrend & ~self.is_downtrend
+        in_uptrend = mask & self.is_uptrend
+        self.scalping_buy = in_uptrend & ~pullback_up & stack_up & self.is_below_25_or_50_ema
+        self.is_below_25_or_50_ema |= in_uptrend & pullback_up
+        cancel = in_uptrend & ~pullback_up & (~stack_up | self.scalping_buy)
+        self.is_uptrend[cancel] = self.is_below_25_or_50_ema[cancel] = False
+        self.is_uptrend |= idle & (self.up_run >= self.trend_bars)
+
+        # Downtrend setup only looked for while there is no uptrend
+        idle = mask & ~self.is_uptrend & ~self.is_downtrend
+        in_downtrend = mask & self.is_downtrend
+        self.scalping_sell = in_downtrend & ~pullback_down & stack_down & self.is_above_25_or_50_ema
+        self.is_above_25_or_50_ema |= in_downtrend & pullback_down
+        cancel = in_downtrend & ~pullback_down & (~stack_down | self.scalping_sell)
+        self.is_downtrend[cancel] = self.is_above_25_or_50_ema[cancel] = False
+        self.is_downtrend |= idle & (self.down_run >= self.trend_bars)
+
+    def _update_stochastic(self, high, low, close, mask):
+        self.ema200.update(close, mask)
+        self.highs.update(high, mask)
+        self.lows.update(low, mask)
+
+        # %K over the window then %D and the smoothed %D
+        with np.errstate(invalid='ignore', divide='ignore'):
+            highest_high = self.highs.values.max(axis=1)
+            lowest_low = self.lows.values.min(axis=1)
+            ready = mask & self.highs.full
+            self.k[ready] = 100 * (close[ready] - lowest_low[ready]) / (highest_high[ready] - lowest_low[ready])
+            self.k_window.update(self.k, ready)
+            ready &= self.k_window.full
+            self.d[ready] = self.k_window.values[ready].mean(axis=1)
+            self.d_window.update(self.d, ready)
+            ready &= self.d_window.full
+            # The strategy's Stochastic indicator reports the smoothed %D one bar late
+            self.stoch_d[mask] = self.d_smooth[mask]
+            self.d_smooth[ready] = self.d_window.values[ready].mean(axis=1)
+
+        # MACD and crosses of its signal line
+        self.fast.update(close, mask)
+        self.slow.update(close, mask)
+        macd_ready = mask & (self.slow.count >= self.slow.period)
+        self.prev_macd[mask] = self.macd[mask]
+        self.macd[macd_ready] = self.fast.value[macd_ready] - self.slow.value[macd_ready]
+        self.signal.update(self.macd, macd_ready)
+        with np.errstate(invalid='ignore'):
+            histogram = self.macd - self.signal.value
+            prev_histogram = self.prev_macd - self.signal.prev
+            self.macd_cross_up = mask & (histogram >= 0) & (prev_histogram < 0)
+            self.macd_cross_down = mask & (histogram <= 0) & (prev_histogram > 0)
+
+            k, d = self.k, self.stoch_d
+            self.above_run[mask] = np.where((close > self.ema200.value)[mask], self.above_run[mask] + 1, 0)
+            self.below_run[mask] = np.where((close < self.ema200.value)[mask], self.below_run[mask] + 1, 0)
+            at_oversold = (k <= self.oversold) & (d <= self.oversold)
+            left_oversold = (k > self.oversold) & (d > self.oversold)
+            at_overbrought = (k >= self.overbrought) & (d >= self.overbrought)
+            left_overbrought = (k < self.overbrought) & (d < self.overbrought)
+            macd_above = self.macd >= self.signal.value
+            macd_below = self.macd <= self.signal.value
+
+        # Uptrend setup: stochastic leaves oversold with the MACD above its signal
+        idle = mask & ~self.stoch_uptrend & ~self.stoch_downtrend
+        in_uptrend = mask & self.stoch_uptrend
+        self.stochastic_buy = in_uptrend & ~at_oversold & left_oversold & self.stochastic_at_oversold & macd_above
+        self.stochastic_at_oversold |= in_uptrend & at_oversold
+        self.stoch_uptrend[self.stochastic_buy] = self.stochastic_at_oversold[self.stochastic_buy] = False
+        self.stoch_uptrend |= idle & (self.above_run >= self.trend_bars)
+
+        # Downtrend setup only looked for while there is no uptrend
+        idle = mask & ~self.stoch_uptrend & ~self.stoch_downtrend
+        in_downtrend = mask & self.stoch_downtrend
+        self.stochastic_sell = in_downtrend & ~at_overbrought & left_overbrought & self.stochastic_at_overbrought & macd_below
+        self.stochastic_at_overbrought |= in_downtrend & at_overbrought
+        self.stoch_downtrend[self.stochastic_sell] = self.stochastic_at_overbrought[self.stochastic_sell] = False
+        self.stoch_downtrend |= idle & (self.below_run >= self.trend_bars)
+
+    def scan(self, include_setups=False):
+        """Rank the symbols meeting an entry (or setup) criteria on the latest bar.
+
+        Returns (symbol, strategy, side, state, score) tuples with entries
+        first and then by score. The score is the distance between the close
+        and the slowest average of the strategy relative to the close so the
+        strongest trends come first.
+        """
+        close = self.close[:, (self.pos - 1) % self.window]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scalping_score = np.abs(close - self.ema100.value) / close
+            stochastic_score = np.abs(close - self.ema200.value) / close
+
+        candidates = [
+            ('scalping', 'buy', 'entry', self.scalping_buy, scalping_score),
+            ('scalping', 'sell', 'entry', self.scalping_sell, scalping_score),
+            ('stochastic', 'buy', 'entry', self.stochastic_buy, stochastic_score),
+            ('stochastic', 'sell', 'entry', self.stochastic_sell, stochastic_score),
+        ]
+        if include_setups:
+            candidates += [
+                ('scalping', 'buy', 'setup', self.is_uptrend & self.is_below_25_or_50_ema, scalping_score),
+                ('scalping', 'sell', 'setup', self.is_downtrend & self.is_above_25_or_50_ema, scalping_score),
+                ('stochastic', 'buy', 'setup', self.stoch_uptrend & self.stochastic_at_oversold, stochastic_score),
+                ('stochastic', 'sell', 'setup', self.stoch_downtrend & self.stochastic_at_overbrought, stochastic_score),
+            ]
+
+        results = []
+        for strategy, side, state, matches, score in candidates:
+            for i in np.nonzero(matches)[0]:
+                results.append((self.symbols[i], strategy, side, state, float(score[i])))
+        results.sort(key=lambda result: (result[3] != 'entry', -result[4]))
+        return results
+
+def load_universe(datadir):
+    """Load every price file in a folder into (symbol x time) arrays aligned on date."""
+    paths = sorted(glob.glob(os.path.join(datadir, '*.csv')))
+    symbols = [os.path.basename(path).split('-')[0].upper() for path in paths]
+    loaded = [load_price_arrays(path) for path in paths]
+
+    dates = np.unique(np.concatenate([arrays['datetime'] for arrays in loaded]))
+    table = {name: np.full((len(symbols), len(dates)), np.nan) for name in ('open', 'high', 'low', 'close')}
+    for i, arrays in enumerate(loaded):
+        cols = np.searchsorted(dates, arrays['datetime'])
+        for name in table:
+            table[name][i, cols] = arrays[name]
+    return symbols, dates, table
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Scan a universe of shares for scalping and stochastic setups')
+
+    parser.add_argument('--datadir', default='./data/historical-prices', required=False,
+                        help='Folder of price files to scan, one per share')
+
+    parser.add_argument('--setups', action='store_true', required=False,
+                        help='Also list shares waiting in a setup for an entry')
+
+    return parser.parse_args()
+
+def perform_scan(args):
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    symbols, dates, table = load_universe(os.path.join(modpath, args.datadir))
+
+    scanner = UniverseScanner(symbols)
+    for t in range(len(dates)):
+        scanner.update(table['open'][:, t], table['high'][:, t], table['low'][:, t], table['close'][:, t])
+
+    print("Scan Date: {}".format(bt.num2date(dates[-1]).date().isoformat()))
+    for symbol, strategy, side, state, score in scanner.scan(include_setups=args.setups):
+        print("{}, {} {} {}, Score: {:.4f}".format(symbol, strategy, side, state, score))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    perform_scan(args)